@@ -19,14 +19,25 @@ def batched_softmax(x):
     """
     :param x: A Tensor3
     This function computes the batched softmax
+
+    The softmax over the last axis is computed by one softmax op on a
+    (batch * n_groups, n_classes) matrix rather than with a scan over
+    the batch. The input is kept in `tag.logits` of the result so the
+    cost can use `batched_log_softmax` on it.
     """
-                
-    result, updates = theano.scan(fn=lambda x_mat:
-            T.nnet.softmax(x_mat),
-            outputs_info=None,
-            sequences=[x],
-            non_sequences=None)
+    shape = x.shape
+    result = T.nnet.softmax(x.reshape((shape[0] * shape[1], shape[2])))
+    result = result.reshape(shape, ndim=3)
+    result.tag.logits = x
     return result
+
+def batched_log_softmax(x):
+    """
+    :param x: A Tensor3
+    Numerically stable log of the batched softmax
+    """
+    x = x - x.max(axis=2, keepdims=True)
+    return x - T.log(T.exp(x).sum(axis=2, keepdims=True))
                 
 class MatrixSpace(Space):
     """A space whose points are defined as fixed-length vectors."""
@@ -237,7 +248,10 @@ class MultiSoftmax(Layer):
         return cost_matrix.sum(axis=2).mean()
 
     def cost_matrix(self, Y, Y_hat):
-        return -Y * T.log(Y_hat+0.000001)
+        logits = getattr(Y_hat.tag, 'logits', None)
+        if logits is None:
+            return -Y * T.log(Y_hat+0.000001)
+        return -Y * batched_log_softmax(logits)
 
     def get_weight_decay(self, coeff):
         if isinstance(coeff, str):
@@ -0,0 +1,64 @@
+import numpy
+import theano
+import theano.tensor as T
+from emotiw.abhi.kpd import Multisoftmax
+
+def scan_batched_softmax(x):
+    # the previous implementation, one softmax per example
+    result, updates = theano.scan(fn=lambda x_mat:
+            T.nnet.softmax(x_mat),
+            outputs_info=None,
+            sequences=[x],
+            non_sequences=None)
+    return result
+
+def random_logits(scale=1.):
+    rng = numpy.random.RandomState(1)
+    return numpy.asarray(scale * rng.randn(5, 4, 3), theano.config.floatX)
+
+def random_targets():
+    rng = numpy.random.RandomState(2)
+    yval = numpy.zeros((5, 4, 3), theano.config.floatX)
+    for i in xrange(5):
+        for j in xrange(4):
+            yval[i, j, rng.randint(3)] = 1
+    return yval
+
+def test_batched_softmax():
+    x = T.tensor3()
+    r = T.tensor3()
+    xval = random_logits()
+    rval = random_targets()
+    fused = Multisoftmax.batched_softmax(x)
+    scanned = scan_batched_softmax(x)
+    fn = theano.function([x, r], [fused, scanned,
+            T.grad((fused * r).sum(), x),
+            T.grad((scanned * r).sum(), x)])
+    out, ref, grad, ref_grad = fn(xval, rval)
+    numpy.testing.assert_array_almost_equal(out, ref)
+    numpy.testing.assert_array_almost_equal(out.sum(axis=2), 1)
+    numpy.testing.assert_array_almost_equal(grad, ref_grad)
+
+def test_cost_gradient():
+    x = T.tensor3()
+    y = T.tensor3()
+    layer = Multisoftmax.MultiSoftmax(n_groups=4, n_classes=3,
+                                      layer_name='y', irange=.05)
+    cost = layer.cost(y, Multisoftmax.batched_softmax(x))
+    ref_cost = (-y * T.log(scan_batched_softmax(x))).sum(axis=2).mean()
+    fn = theano.function([x, y], [cost, ref_cost,
+            T.grad(cost, x), T.grad(ref_cost, x)])
+    out, ref, grad, ref_grad = fn(random_logits(), random_targets())
+    numpy.testing.assert_approx_equal(out, ref)
+    numpy.testing.assert_array_almost_equal(grad, ref_grad)
+
+def test_cost_large_logits():
+    x = T.tensor3()
+    y = T.tensor3()
+    layer = Multisoftmax.MultiSoftmax(n_groups=4, n_classes=3,
+                                      layer_name='y', irange=.05)
+    cost = layer.cost(y, Multisoftmax.batched_softmax(x))
+    fn = theano.function([x, y], [cost, T.grad(cost, x)])
+    out, grad = fn(random_logits(1000.), random_targets())
+    assert numpy.isfinite(out)
+    assert numpy.all(numpy.isfinite(grad))
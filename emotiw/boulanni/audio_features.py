@@ -1,11 +1,15 @@
 from collections import defaultdict
-import cPickle
+import functools
 import glob
+import hashlib
+import multiprocessing
 import numpy
 import os
 import sys
 import yaafelib
 
+from emotiw.common.datasets.audio_store import AudioFeatureStore
+
 
 
 # online PCA for large datasets
@@ -26,6 +30,21 @@ class PCA:
     self.covariance += covariance + numpy.outer(difference, difference) * len(x)*self.num_frames / float(len(x) + self.num_frames)
     self.mean += difference * len(x) / float(len(x) + self.num_frames)
     self.num_frames += len(x)
+
+  def merge(self, other):
+    # combine the statistics of two disjoint sets of frames, as if all
+    # the frames had been added to this object
+    if not hasattr(other, 'ndim') or other.num_frames == 0:
+      return self
+    if not hasattr(self, 'ndim'):
+      self.start(other.ndim)
+    assert self.ndim == other.ndim
+    total = float(self.num_frames + other.num_frames)
+    difference = other.mean - self.mean
+    self.covariance += other.covariance + numpy.outer(difference, difference) * self.num_frames*other.num_frames / total
+    self.mean += difference * other.num_frames / total
+    self.num_frames += other.num_frames
+    return self
     
   def pca(self, keep_variance=1.0, add_variance=1e-7, diagonal=False):
     covariance = 0.5 * (self.covariance + self.covariance.T) / (self.num_frames-1)
@@ -44,94 +63,313 @@ class PCA:
     return numpy.dot(x-self.mean, self.transform)
 
 
-def file_create(name):
-  directory = os.path.dirname(name)
-  if not os.path.exists(directory):
-    os.makedirs(directory)
-  return file(name, 'w')
+# incremental truncated SVD for high dimensional features, the memory
+# used is O((rank + chunk_size) * ndim) instead of O(ndim**2)
+class IncrementalPCA:
+  def __init__(self, rank=256, chunk_size=4096):
+    self.rank = rank
+    self.chunk_size = chunk_size
 
+  def start(self, ndim):
+    self.ndim = ndim
+    self.mean = numpy.zeros(self.ndim, dtype='float64')
+    # per dimension sum of squared deviations, gives the total variance
+    # and the diagonal PCA
+    self.scatter = numpy.zeros(self.ndim, dtype='float64')
+    self.singular_values = numpy.zeros(0, dtype='float64')
+    self.components = numpy.zeros((0, self.ndim), dtype='float64')
+    self.num_frames = 0
+    self.buffer = []
+    self.buffered = 0
 
-def export_features(path='../audios', out='../audio_features'):
-  # prepare the FeaturePlan
-  plan = yaafelib.FeaturePlan(sample_rate=48000, normalize=0.99)
-  size_info = 'blockSize=1248 stepSize=624'
-
-  features = [
-    'ZCR',
-    'TemporalShapeStatistics',
-    'Energy',
-    'MagnitudeSpectrum',
-    'SpectralVariation',
-    'SpectralSlope',
-    'SpectralRolloff',
-    'SpectralShapeStatistics',
-    'SpectralFlux',
-    'SpectralFlatness',
-    'SpectralDecrease',
-    'SpectralFlatnessPerBand',
-    'SpectralCrestFactorPerBand',
-    'AutoCorrelation',
-    'LPC',
-    'LSF',
-    'ComplexDomainOnsetDetection',
-    'MelSpectrum',
-    'MFCC: MFCC CepsNbCoeffs=22',
-    'MFCC_d1: MFCC %s > Derivate DOrder=1',
-    'MFCC_d2: MFCC %s > Derivate DOrder=2',
-    'Envelope',
-    'EnvelopeShapeStatistics',
-    'AmplitudeModulation',
-    'Loudness',
-    'PerceptualSharpness',
-    'PerceptualSpread',
-    'OBSI',
-    'OBSIR']
+  def add(self, x):
+    if not hasattr(self, 'ndim'):
+      self.start(x.shape[1])
+    self.buffer.append(numpy.asarray(x, dtype='float64'))
+    self.buffered += len(x)
+    if self.buffered >= self.chunk_size:
+      self.flush()
+
+  def flush(self):
+    if not hasattr(self, 'ndim') or self.buffered == 0:
+      return
+    x = numpy.concatenate(self.buffer)
+    self.buffer = []
+    self.buffered = 0
+    mean = x.mean(axis=0)
+    self._update(len(x), mean, ((x - mean)**2).sum(axis=0), x - mean)
+
+  def _update(self, num_frames, mean, scatter, centered):
+    # combine with a set of frames of given mean and per dimension
+    # scatter, described by the rows of `centered`
+    total = float(self.num_frames + num_frames)
+    difference = mean - self.mean
+    self.scatter += scatter + difference**2 * self.num_frames*num_frames / total
+    stacked = numpy.vstack([self.singular_values[:, None] * self.components,
+                            centered,
+                            numpy.sqrt(self.num_frames*num_frames / total) * difference])
+    self.mean += difference * num_frames / total
+    self.num_frames += num_frames
+    _, values, vectors = numpy.linalg.svd(stacked, full_matrices=False)
+    self.singular_values = values[:self.rank]
+    self.components = vectors[:self.rank]
+
+  def merge(self, other):
+    other.flush()
+    if not hasattr(other, 'ndim') or other.num_frames == 0:
+      return self
+    if not hasattr(self, 'ndim'):
+      self.start(other.ndim)
+    assert self.ndim == other.ndim
+    self.flush()
+    self._update(other.num_frames, other.mean, other.scatter,
+                 other.singular_values[:, None] * other.components)
+    return self
+
+  def pca(self, keep_variance=1.0, add_variance=1e-7, diagonal=False):
+    self.flush()
+    variances = self.scatter / (self.num_frames-1)
+    if diagonal:
+      # the `rank` dimensions of largest variance
+      indices = variances.argsort()[::-1][:self.rank]
+      values = variances[indices]
+      vectors = numpy.eye(self.ndim)[:, indices]
+    else:
+      values = self.singular_values**2 / (self.num_frames-1)
+      vectors = self.components.T
+    # the ratios are relative to the total variance, not only to the
+    # variance captured by the kept components
+    cutoff = (values.cumsum() / variances.sum()).searchsorted(keep_variance, side='right')
+    cutoff = min(cutoff, len(values))
+    print 'kept %i/%i (%.2f%%) dimensions, %.2f%% of the variance' % (cutoff, self.ndim, 100.0*cutoff/self.ndim, 100.0*values[:cutoff].sum()/variances.sum())
+    values = values[:cutoff]
+    vectors = vectors[:, :cutoff]
+    self.transform = vectors / numpy.sqrt(values + add_variance)
+
+  def feature(self, x, chunk_size=65536):
+    # project `x` by chunks, `x` can be a memory map over a whole archive
+    rval = numpy.empty((len(x), self.transform.shape[1]), dtype='float32')
+    for start in xrange(0, len(x), chunk_size):
+      rval[start:start+chunk_size] = numpy.dot(x[start:start+chunk_size]-self.mean, self.transform)
+    return rval
+
+
+SIZE_INFO = 'blockSize=1248 stepSize=624'
+
+FEATURES = [
+  'ZCR',
+  'TemporalShapeStatistics',
+  'Energy',
+  'MagnitudeSpectrum',
+  'SpectralVariation',
+  'SpectralSlope',
+  'SpectralRolloff',
+  'SpectralShapeStatistics',
+  'SpectralFlux',
+  'SpectralFlatness',
+  'SpectralDecrease',
+  'SpectralFlatnessPerBand',
+  'SpectralCrestFactorPerBand',
+  'AutoCorrelation',
+  'LPC',
+  'LSF',
+  'ComplexDomainOnsetDetection',
+  'MelSpectrum',
+  'MFCC: MFCC CepsNbCoeffs=22',
+  'MFCC_d1: MFCC %s > Derivate DOrder=1',
+  'MFCC_d2: MFCC %s > Derivate DOrder=2',
+  'Envelope',
+  'EnvelopeShapeStatistics',
+  'AmplitudeModulation',
+  'Loudness',
+  'PerceptualSharpness',
+  'PerceptualSpread',
+  'OBSI',
+  'OBSIR']
+
+SUBSETS = {
+  'raw': ['MagnitudeSpectrum'],
+  'minimal': ['MFCC', 'MFCC_d1', 'Energy', 'AutoCorrelation', 'Loudness', 'PerceptualSharpness', 'PerceptualSpread', 'SpectralVariation', 'SpectralSlope', 'SpectralFlux'],
+  'full': 'full'}
 
 
+def feature_definition(f, size_info=SIZE_INFO):
+  # return the name and the complete yaafe definition of a feature
+  if ':' not in f: f = '%s: %s' % (f, f)
+  if '%s' not in f: f += ' %s'
+  f = f % size_info
+  name, definition = [item.strip() for item in f.split(':', 1)]
+  return name, definition
+
+
+def create_engine(features=FEATURES, size_info=SIZE_INFO):
+  # prepare the FeaturePlan
+  plan = yaafelib.FeaturePlan(sample_rate=48000, normalize=0.99)
   for f in features:
-    if ':' not in f: f = '%s: %s' % (f, f)
-    if '%s' not in f: f += ' %s'
-    plan.addFeature(f % size_info)
+    plan.addFeature('%s: %s' % feature_definition(f, size_info))
 
   dataflow = plan.getDataFlow()
   engine = yaafelib.Engine()
   engine.load(dataflow)
-  processor = yaafelib.AudioFileProcessor()
+  return engine
+
+
+# every yaafe output is cached separately, in
+# <cache>/<name>/<hash of the definition>/<hash of the audio file>.npy
+# so adding a feature or changing the block size only computes the
+# missing (file, feature) pairs
+def file_hash(name, block_size=1<<20):
+  sha = hashlib.sha1()
+  with open(name, 'rb') as f:
+    block = f.read(block_size)
+    while block:
+      sha.update(block)
+      block = f.read(block_size)
+  return sha.hexdigest()
+
+
+def cache_file(cache, name, definition, audio_hash):
+  directory = os.path.join(cache, name, hashlib.sha1(definition).hexdigest()[:16])
+  return os.path.join(directory, '%s.npy' % audio_hash)
+
+
+def cache_save(filename, definition, value):
+  directory = os.path.dirname(filename)
+  if not os.path.exists(directory):
+    try:
+      os.makedirs(directory)
+    except OSError:
+      # created by another worker
+      pass
+    with open(os.path.join(directory, 'definition.txt'), 'w') as f:
+      f.write(definition + '\n')
+  # write then rename, an interrupted run never leaves a partial file
+  tmp = '%s.%d.tmp.npy' % (filename[:-len('.npy')], os.getpid())
+  numpy.save(tmp, value)
+  os.rename(tmp, filename)
+
+
+# yaafe engines cannot be pickled, every worker process builds its own,
+# one per set of missing features
+_worker = {}
+
+def _init_worker():
+  _worker['engines'] = {}
+  _worker['processor'] = yaafelib.AudioFileProcessor()
+
 
-  subsets = {
-    'raw': ['MagnitudeSpectrum'],
-    'minimal': ['MFCC', 'MFCC_d1', 'Energy', 'AutoCorrelation', 'Loudness', 'PerceptualSharpness', 'PerceptualSpread', 'SpectralVariation', 'SpectralSlope', 'SpectralFlux'],
-    'full': 'full'}
+def _compute(audiofile, features, size_info):
+  key = (tuple(sorted(features)), size_info)
+  if key not in _worker['engines']:
+    _worker['engines'][key] = create_engine(features, size_info)
+  engine = _worker['engines'][key]
+  _worker['processor'].processFile(engine, audiofile)
+  return engine.readAllOutputs()
 
-  pca = defaultdict(PCA)
-  audiofiles = glob.glob('%s/*/*/*.mp3' % path)
 
-  # extract features from audio files
+def load_features(audiofile, features, size_info, cache):
+  # return the outputs of all `features` for an audio file, only the
+  # features missing from the cache are computed
+  audio_hash = file_hash(audiofile)
+  files = {}
+  missing = []
+  for f in features:
+    name, definition = feature_definition(f, size_info)
+    files[name] = (cache_file(cache, name, definition, audio_hash), definition)
+    if not os.path.isfile(files[name][0]):
+      missing.append(f)
+
+  rval = {}
+  if missing:
+    outputs = _compute(audiofile, missing, size_info)
+    for name, value in outputs.iteritems():
+      cache_save(files[name][0], files[name][1], value)
+      rval[name] = value
+  for name, (filename, _) in files.iteritems():
+    if name not in rval:
+      rval[name] = numpy.load(filename)
+  return rval
+
+
+def make_reducer(rank=None):
+  # online PCA, or incremental PCA keeping `rank` components
+  if rank is None:
+    return PCA()
+  return IncrementalPCA(rank)
+
+
+def fit_projection(reducer, keep_variance=1.0, diagonal=None):
+  # compute the projection of a reducer made by make_reducer. The diagonal
+  # PCA is the default with the full covariance, with a rank it would
+  # throw away the components the incremental PCA computed
+  if diagonal is None:
+    diagonal = not isinstance(reducer, IncrementalPCA)
+  reducer.pca(keep_variance=keep_variance, diagonal=diagonal)
+  return reducer.mean, reducer.transform
+
+
+def _extract(job):
+  # extract features from a chunk of audio files, returns the features
+  # and the partial PCA statistics of the training files of the chunk
+  audiofiles, rank, features, subsets, size_info, cache = job
+  pca = defaultdict(functools.partial(make_reducer, rank))
+  outputs = []
   for audiofile in audiofiles:
-    processor.processFile(engine, audiofile)
-    features = engine.readAllOutputs()
+    values = load_features(audiofile, features, size_info, cache)
+    output = {}
     for subset, keys in subsets.iteritems():
       if keys == 'full':
-        keys = sorted(features.keys())
-      output = numpy.concatenate([features[k].T for k in keys]).T
+        keys = sorted(values.keys())
+      output[subset] = numpy.concatenate([values[k].T for k in keys]).T.astype('float32')
       if 'Train' in audiofile:
-        pca[subset].add(output)
-      pickle_file = audiofile.replace('.mp3', '.%s.pkl' % subset).replace(path, out)
-      cPickle.dump(output, file_create(pickle_file), cPickle.HIGHEST_PROTOCOL)
+        pca[subset].add(output[subset])
+    outputs.append((audiofile, output))
+  return dict(pca), outputs
 
-  for subset in subsets.iterkeys():
-    pca[subset].pca(diagonal=True)
-    cPickle.dump(pca[subset], file_create('%s/%s.pca' % (out, subset)))
 
-  print 'Rewriting PCA data...'
-  sys.stdout.flush()
+def chunks(items, n_chunks):
+  return [items[i::n_chunks] for i in range(n_chunks) if items[i::n_chunks]]
 
-  for audiofile in audiofiles:
-    for subset in subsets.iterkeys():
-      pickle_file = audiofile.replace('.mp3', '.%s.pkl' % subset).replace(path, out)
-      matrix = cPickle.load(file(pickle_file))
-      matrix = pca[subset].feature(matrix)
-      cPickle.dump(matrix, file_create(pickle_file.replace('.pkl', '.pca.pkl')), cPickle.HIGHEST_PROTOCOL)
 
+def export_features(path='../audios', out='../audio_features', n_jobs=None, rank=None,
+                    features=FEATURES, subsets=SUBSETS, size_info=SIZE_INFO, cache=None,
+                    keep_variance=1.0, diagonal=None):
+  # all the features are written in a single AudioFeatureStore in `out`,
+  # give a `rank` to use IncrementalPCA instead of the full covariance,
+  # the projections then keep at most `rank` dimensions.
+  # `keep_variance` and `diagonal` are passed to fit_projection.
+  # yaafe outputs are cached in `cache`, `out`/cache by default
+  if cache is None:
+    cache = os.path.join(out, 'cache')
+  if n_jobs is None:
+    n_jobs = multiprocessing.cpu_count()
+  audiofiles = sorted(glob.glob('%s/*/*/*.mp3' % path))
+  # a few chunks per worker to balance the load, each chunk returns its
+  # own PCA statistics
+  jobs = chunks(audiofiles, 4 * n_jobs)
 
+  store = AudioFeatureStore(out, mode='w')
+  pool = multiprocessing.Pool(n_jobs, _init_worker)
+  try:
+    pca = defaultdict(functools.partial(make_reducer, rank))
+    for partial, outputs in pool.imap(_extract, [(job, rank, features, subsets, size_info, cache) for job in jobs]):
+      for subset, stats in partial.iteritems():
+        pca[subset].merge(stats)
+      for audiofile, output in outputs:
+        split, label, clip = audiofile.replace('.mp3', '').split('/')[-3:]
+        store.append(clip, split, label, output)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  store.close()
 
+  print 'Projecting PCA data...'
+  sys.stdout.flush()
+
+  for subset in subsets.iterkeys():
+    mean, transform = fit_projection(pca[subset], keep_variance, diagonal)
+    store.set_pca(subset, mean, transform)
+    store.project(subset)
@@ -0,0 +1,38 @@
+import numpy
+from emotiw.boulanni import audio_features
+
+def random_frames(n_frames=300, ndim=10):
+    rng = numpy.random.RandomState(0)
+    scales = numpy.linspace(1., 5., ndim)
+    return numpy.asarray(rng.randn(n_frames, ndim) * scales, 'float32')
+
+def fit(rank, **kwargs):
+    reducer = audio_features.make_reducer(rank)
+    x = random_frames()
+    # two partial reducers, as given by the export workers
+    reducer.add(x[:100])
+    other = audio_features.make_reducer(rank)
+    other.add(x[100:])
+    reducer.merge(other)
+    mean, transform = audio_features.fit_projection(reducer, **kwargs)
+    return reducer, mean, transform
+
+def test_projection_width_follows_rank():
+    for rank in [1, 3, 7]:
+        for diagonal in [None, False, True]:
+            reducer, mean, transform = fit(rank, diagonal=diagonal)
+            assert mean.shape == (10,)
+            assert transform.shape == (10, rank)
+            assert reducer.feature(random_frames(20)).shape == (20, rank)
+
+def test_projection_without_rank():
+    reducer, mean, transform = fit(None)
+    assert transform.shape == (10, 10)
+    # the diagonal PCA only reorders and scales the dimensions
+    assert ((transform != 0).sum(axis=0) == 1).all()
+    assert ((transform != 0).sum(axis=1) == 1).all()
+
+def test_projection_keep_variance():
+    _, _, full = fit(7)
+    _, _, kept = fit(7, keep_variance=0.5)
+    assert kept.shape[1] < full.shape[1]
@@ -0,0 +1,218 @@
+"""
+Packed storage of the audio features of the AFEW clips.
+
+Every feature subset ('raw', 'minimal', 'full') is a single contiguous
+float32 (n_frames, n_dims) array holding the frames of all the clips
+one after the other. An index keeps for every clip its id, split
+('Train' or 'Val'), label and offset in the frame arrays, so the frames
+of a clip are a slice of a memory map.
+
+PCA is stored once per subset as its mean and transform. It is applied
+lazily when reading a clip, unless a projected copy of the subset was
+written with `AudioFeatureStore.project`.
+
+Layout of a store directory:
+    index.pkl: clip ids, splits, labels, offsets and subset dimensions
+    <subset>.bin: float32 frames of a subset
+    <subset>.pca.npz: mean and transform of the PCA of a subset
+    <subset>.pca.bin: float32 PCA projected frames of a subset
+"""
+import cPickle
+import os
+
+import numpy as np
+
+
+class AudioFeatureStore(object):
+    def __init__(self, path, mode='r'):
+        """
+        :param path: String
+            Store directory
+        :param mode: String
+            'r' to read, 'w' to create a new store
+        """
+        assert mode in ('r', 'w')
+        self.path = path
+        self.mode = mode
+        self.index_path = os.path.join(path, 'index.pkl')
+        self._data = {}
+        self._pca = {}
+
+        if mode == 'r':
+            if not os.path.isfile(self.index_path):
+                raise IOError("No audio feature store found in %s" % path)
+            index = cPickle.load(open(self.index_path, 'rb'))
+            self.clips = index['clips']
+            self.splits = index['splits']
+            self.labels = index['labels']
+            self.offsets = np.asarray(index['offsets'], dtype='int64')
+            self.dims = index['dims']
+            self._out = None
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.clips = []
+            self.splits = []
+            self.labels = []
+            self.offsets = [0]
+            self.dims = {}
+            self._out = {}
+
+    def __len__(self):
+        return len(self.clips)
+
+    @property
+    def subsets(self):
+        return sorted(self.dims.keys())
+
+    def _file(self, subset, pca=False):
+        if pca:
+            return os.path.join(self.path, '%s.pca.bin' % subset)
+        return os.path.join(self.path, '%s.bin' % subset)
+
+    def append(self, clip, split, label, features):
+        """
+        Add the features of a clip.
+
+        :param features: dict
+            Maps every subset to a (n_frames, n_dims) array. All the
+            subsets have the same number of frames.
+        """
+        assert self.mode == 'w'
+        n_frames = None
+        for subset, frames in features.iteritems():
+            if n_frames is None:
+                n_frames = frames.shape[0]
+            if frames.shape[0] != n_frames:
+                raise ValueError("All the subsets of clip %s should have "
+                                 "the same number of frames" % clip)
+            if subset not in self.dims:
+                if len(self.clips) > 0:
+                    raise ValueError("Unknown subset %s" % subset)
+                self.dims[subset] = frames.shape[1]
+                self._out[subset] = open(self._file(subset), 'wb')
+            if frames.shape[1] != self.dims[subset]:
+                raise ValueError("Expected %d dimensions for subset %s, "
+                                 "got %d" % (self.dims[subset], subset,
+                                             frames.shape[1]))
+            np.asarray(frames, dtype='float32').tofile(self._out[subset])
+        if set(features.keys()) != set(self.dims.keys()):
+            raise ValueError("Clip %s does not have all the subsets %s"
+                             % (clip, self.subsets))
+
+        self.clips.append(clip)
+        self.splits.append(split)
+        self.labels.append(label)
+        self.offsets.append(self.offsets[-1] + n_frames)
+
+    def close(self):
+        if self.mode != 'w' or self._out is None:
+            return
+        for out in self._out.values():
+            out.close()
+        self._out = None
+        index = {'clips': self.clips,
+                 'splits': self.splits,
+                 'labels': self.labels,
+                 'offsets': np.asarray(self.offsets, dtype='int64'),
+                 'dims': self.dims}
+        tmp_path = self.index_path + '.tmp'
+        cPickle.dump(index, open(tmp_path, 'wb'), cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.index_path)
+        self.offsets = index['offsets']
+        self.mode = 'r'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def set_pca(self, subset, mean, transform):
+        """
+        Save the PCA of a subset, `x` is projected as
+        `dot(x - mean, transform)`.
+
+        A projected copy written with a previous PCA is removed, call
+        `project` again to rewrite it.
+        """
+        assert self.mode == 'r', "close the store before adding a PCA"
+        if self.has_projection(subset):
+            os.remove(self._file(subset, pca=True))
+        np.savez(os.path.join(self.path, '%s.pca.npz' % subset),
+                 mean=mean, transform=transform)
+        self._pca.pop(subset, None)
+        self._data.pop((subset, True), None)
+
+    def get_pca(self, subset):
+        """
+        Return the (mean, transform) of the PCA of a subset.
+        """
+        if subset not in self._pca:
+            pca = np.load(os.path.join(self.path, '%s.pca.npz' % subset))
+            self._pca[subset] = (pca['mean'].astype('float32'),
+                                 pca['transform'].astype('float32'))
+        return self._pca[subset]
+
+    def project(self, subset, chunk_size=100000):
+        """
+        Write the PCA projected copy of a subset, so that reading
+        projected frames does not need a matrix product anymore.
+        """
+        mean, transform = self.get_pca(subset)
+        data = self.data(subset)
+        with open(self._file(subset, pca=True), 'wb') as out:
+            for start in xrange(0, data.shape[0], chunk_size):
+                chunk = np.dot(data[start:start + chunk_size] - mean,
+                               transform)
+                chunk.astype('float32').tofile(out)
+        self._data.pop((subset, True), None)
+
+    def data(self, subset, pca=False):
+        """
+        Memory map over all the frames of a subset.
+
+        With `pca=True` this is only available once `project` was called.
+        """
+        key = (subset, pca)
+        if key not in self._data:
+            if pca:
+                n_dims = self.get_pca(subset)[1].shape[1]
+            else:
+                n_dims = self.dims[subset]
+            n_frames = int(self.offsets[-1])
+            if n_frames == 0:
+                return np.zeros((0, n_dims), dtype='float32')
+            self._data[key] = np.memmap(self._file(subset, pca),
+                                        dtype='float32', mode='r',
+                                        shape=(n_frames, n_dims))
+        return self._data[key]
+
+    def has_projection(self, subset):
+        return os.path.isfile(self._file(subset, pca=True))
+
+    def get(self, idx, subset, pca=False):
+        """
+        Frames of the clip number `idx` as a (n_frames, n_dims) array.
+
+        Projected frames come from the projected copy if it exists,
+        otherwise the PCA is applied on the fly.
+        """
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        if pca and not self.has_projection(subset):
+            mean, transform = self.get_pca(subset)
+            return np.dot(self.data(subset)[start:end] - mean, transform)
+        return self.data(subset, pca)[start:end]
+
+    def select(self, split=None):
+        """
+        Indices of the clips of a split, all the clips if None.
+        """
+        return [i for i, s in enumerate(self.splits)
+                if split is None or s == split]
+
+    def sequences(self, subset, pca=False, split=None):
+        """
+        List of the (n_frames, n_dims) arrays of the clips of a split.
+        """
+        return [self.get(i, subset, pca) for i in self.select(split)]
@@ -0,0 +1,156 @@
+"""
+Local contrast normalization (LCN) of images.
+
+The Gaussian window is separable, so it is applied as two 1-D filters
+(along the rows then the columns) instead of a 2-D convolution. Images
+can have any shape: the last two axes are the spatial ones and all the
+leading axes (images, channels, ...) are normalized independently.
+
+Two backends with the same semantics are provided:
+    lcn: NumPy, to preprocess whole datasets offline (Theano is not
+        imported)
+    lcn_symbolic: Theano, to normalize inside a graph
+
+The result of both is `(x - mean) / max(std, mean(std))`, where `mean`
+and `std` are the local Gaussian weighted mean and standard deviation
+(zero padding at the borders) and `mean(std)` is averaged over each
+image. The local variance is either
+    'centered': the local mean of (x - mean) ** 2
+    'moments': the local mean of x ** 2 minus mean ** 2
+"""
+import numpy
+
+
+def gaussian_1d(size, sigma):
+    """
+    Unnormalized Gaussian window of `size` taps, centered on the window
+    and with a standard deviation of `sigma * size` taps.
+    """
+    pos = numpy.arange(size) + .5 - size / 2.
+    return numpy.exp(-.5 * (pos / (sigma * size)) ** 2)
+
+
+def gaussian(size, sigma):
+    """
+    Unnormalized (size, size) Gaussian kernel, the outer product of two
+    `gaussian_1d` windows.
+    """
+    g = gaussian_1d(size, sigma)
+    return numpy.outer(g, g)
+
+
+def _default_sigma(size):
+    return 1.591 / size
+
+
+def _window(size, sigma):
+    if sigma is None:
+        sigma = _default_sigma(size)
+    g = gaussian_1d(size, sigma)
+    return (g / g.sum()).astype('float32')
+
+
+def filter_1d(x, g, axis):
+    """
+    Zero padded convolution of `x` with the window `g` along `axis`, the
+    output has the shape of `x`.
+    """
+    size = len(g)
+    x = numpy.asarray(x)
+    n = x.shape[axis]
+    left = size - 1 - size // 2
+    pad = [(0, 0)] * x.ndim
+    pad[axis] = (left, size // 2)
+    xp = numpy.pad(x, pad, mode='constant')
+    rval = numpy.zeros(x.shape, dtype=numpy.result_type(x, g))
+    index = [slice(None)] * x.ndim
+    for k in xrange(size):
+        start = size // 2 - k + left
+        index[axis] = slice(start, start + n)
+        rval += g[k] * xp[tuple(index)]
+    return rval
+
+
+def gaussian_filter(x, size=9, sigma=None):
+    """
+    Normalized Gaussian smoothing of the last two axes of `x`.
+    """
+    g = _window(size, sigma)
+    return filter_1d(filter_1d(x, g, -1), g, -2)
+
+
+def lcn(x, size=9, sigma=None, variance='centered'):
+    """
+    NumPy local contrast normalization of the last two axes of `x`.
+
+    :param x: array of shape (..., height, width)
+    :param size: int, width of the Gaussian window
+    :param sigma: float, standard deviation of the window relative to
+        `size`, 1.591 / size by default
+    :param variance: 'centered' or 'moments', see the module docstring
+    :rval: float32 array with the shape of `x`
+    """
+    x = numpy.asarray(x, dtype='float32')
+    mean = gaussian_filter(x, size, sigma)
+    centered = x - mean
+    if variance == 'centered':
+        var = gaussian_filter(centered ** 2, size, sigma)
+    elif variance == 'moments':
+        var = gaussian_filter(x ** 2, size, sigma) - mean ** 2
+    else:
+        raise ValueError("Unknown variance %s" % variance)
+    std = numpy.sqrt(numpy.maximum(var, 0))
+    std_mean = std.mean(axis=-1).mean(axis=-1)[..., None, None]
+    return (centered / numpy.maximum(std, std_mean)).astype('float32')
+
+
+def filter_1d_symbolic(x, g, axis):
+    """
+    Symbolic `filter_1d` for a 4-tensor `x` of shape
+    (n, 1, height, width), along axis 2 or 3.
+    """
+    import theano.tensor as TT
+    from theano.tensor.nnet import conv
+
+    size = len(g)
+    if axis == 3:
+        kernel = g.reshape((1, 1, 1, size))
+    else:
+        kernel = g.reshape((1, 1, size, 1))
+    out = conv.conv2d(x, TT.constant(kernel), None, kernel.shape, 'full')
+    crop = slice(size // 2, size // 2 + x.shape[axis])
+    if axis == 3:
+        return out[:, :, :, crop]
+    return out[:, :, crop, :]
+
+
+def gaussian_filter_symbolic(x, size=9, sigma=None):
+    """
+    Symbolic `gaussian_filter` for a 4-tensor (n, 1, height, width)
+    """
+    g = _window(size, sigma)
+    return filter_1d_symbolic(filter_1d_symbolic(x, g, 3), g, 2)
+
+
+def lcn_symbolic(x, size=9, sigma=None, variance='centered'):
+    """
+    Symbolic local contrast normalization of the last two axes of the
+    tensor `x`, see `lcn`.
+    """
+    import theano.tensor as TT
+
+    shape = x.shape
+    p = x.reshape((TT.prod(shape[:-2]), 1, shape[-2], shape[-1]))
+    mean = gaussian_filter_symbolic(p, size, sigma)
+    centered = p - mean
+    if variance == 'centered':
+        var = gaussian_filter_symbolic(TT.sqr(centered), size, sigma)
+    elif variance == 'moments':
+        var = gaussian_filter_symbolic(TT.sqr(p), size, sigma) - \
+                TT.sqr(mean)
+    else:
+        raise ValueError("Unknown variance %s" % variance)
+    std = TT.sqrt(TT.maximum(var, 0))
+    std_mean = std.mean(axis=3).mean(axis=2).dimshuffle(0, 1, 'x', 'x')
+    out = centered / TT.maximum(std, std_mean)
+    return out.reshape(shape, ndim=x.ndim)
@@ -0,0 +1,98 @@
+"""
+Helpers to run sequence models on minibatches of variable-length clips.
+
+Minibatches are (time, batch, features) tensors padded with zeros along
+with a (time, batch) mask which is 1 for the steps of a sequence and 0
+for the padding. Sequences are left aligned.
+"""
+import hashlib
+import os
+
+import numpy
+
+
+def pad_sequences(sequences, dtype='float32'):
+    """
+    :param sequences: list of (n_steps, n_features) arrays
+    :rval: (x, mask), x is (max_steps, n_sequences, n_features) and mask
+    (max_steps, n_sequences)
+    """
+    lengths = [len(seq) for seq in sequences]
+    n_features = sequences[0].shape[1]
+    x = numpy.zeros((max(lengths), len(sequences), n_features), dtype=dtype)
+    mask = numpy.zeros((max(lengths), len(sequences)), dtype=dtype)
+    for i, seq in enumerate(sequences):
+        x[:lengths[i], i] = seq
+        mask[:lengths[i], i] = 1
+    return x, mask
+
+
+def length_buckets(sequences, batch_size):
+    """
+    Split the indices of `sequences` in minibatches of at most
+    `batch_size` sequences of similar lengths.
+
+    :rval: list of arrays of indices, from the shortest sequences to the
+    longest
+    """
+    # sorting by length keeps the padding small
+    order = numpy.argsort([len(seq) for seq in sequences], kind='mergesort')
+    return [order[start:start + batch_size]
+            for start in xrange(0, len(order), batch_size)]
+
+
+def hash_arrays(arrays):
+    """
+    Hash of the content and shapes of a list of arrays.
+    """
+    sha = hashlib.sha1()
+    for array in arrays:
+        array = numpy.ascontiguousarray(array)
+        sha.update(str(array.shape) + str(array.dtype))
+        sha.update(array.data)
+    return sha.hexdigest()
+
+
+def predict_in_batches(fn, sequences, batch_size=64, params=None,
+                       cache_dir=None, dtype='float32'):
+    """
+    Apply a compiled function to all the sequences, by minibatches of
+    sequences of similar lengths.
+
+    :param fn: function taking (x, mask) and returning a list of arrays
+    with one row per sequence of the minibatch
+    :param sequences: list of (n_steps, n_features) arrays
+    :param params: list of the parameter values of the model. If given
+    along with `cache_dir`, the outputs are saved there, keyed by the
+    parameters and the sequences, and loaded back instead of being
+    computed again.
+    :rval: list of arrays with one row per sequence, in the order of
+    `sequences`
+    """
+    if cache_dir is not None and params is not None:
+        key = hash_arrays(list(params) + list(sequences))
+        cache_file = os.path.join(cache_dir, '%s.npz' % key)
+        if os.path.isfile(cache_file):
+            cached = numpy.load(cache_file)
+            return [cached['out_%d' % i] for i in xrange(len(cached.files))]
+    else:
+        cache_file = None
+
+    outputs = None
+    for indices in length_buckets(sequences, batch_size):
+        x, mask = pad_sequences([sequences[i] for i in indices], dtype)
+        rvals = fn(x, mask)
+        if outputs is None:
+            outputs = [numpy.zeros((len(sequences),) + rval.shape[1:],
+                                   dtype=rval.dtype) for rval in rvals]
+        for out, rval in zip(outputs, rvals):
+            out[indices] = rval
+
+    if cache_file is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = cache_file[:-len('.npz')] + '.tmp.npz'
+        numpy.savez(tmp_file, **dict(('out_%d' % i, out)
+                                     for i, out in enumerate(outputs)))
+        os.rename(tmp_file, cache_file)
+    return outputs
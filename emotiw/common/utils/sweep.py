@@ -0,0 +1,354 @@
+"""
+Hyperparameter sweeps on a single machine, without a database server.
+
+Jobs are dicts of hyperparameters, expanded from a grid of values
+(`produit_cartesien_jobs`) or sampled (`random_jobs`), and are inserted
+in a SQLite file along with the experiment to run, given as
+"module.function" like jobman's EXPERIMENT_PATH. The function is called
+as `function(state, channel)`, where `state` is the job (with attribute
+access, like jobman's DD) and `channel.save()` records the current state
+in the file, so the entry points written for jobman run unchanged.
+
+`run` executes the queued jobs, `n_workers` at a time. Every job runs in
+a fresh Python process limited to `n_threads` BLAS/OpenMP threads, in its
+own working directory <sweep file>.jobs/<id>, so jobs saving files in
+their current directory do not overwrite each other. `view` prints the
+jobs as a table.
+
+From the command line:
+    python -m emotiw.common.utils.sweep run <sweep file> [n_workers [n_threads]]
+    python -m emotiw.common.utils.sweep view <sweep file> [column ...]
+    python -m emotiw.common.utils.sweep requeue <sweep file>
+"""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+# environment variables bounding the threads of numpy/Theano
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS']
+
+
+class State(dict):
+    """
+    Dict whose keys are also attributes, like jobman's DD
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+def produit_cartesien_jobs(val_dict):
+    """
+    All the combinations of the values of `val_dict`, a dict mapping each
+    hyperparameter to the list of its values.
+    """
+    job_list = [State()]
+
+    for key in val_dict.keys():
+        new_job_list = []
+        for val in val_dict[key]:
+            for job in job_list:
+                to_insert = State(job)
+                to_insert[key] = val
+                new_job_list.append(to_insert)
+        job_list = new_job_list
+
+    return job_list
+
+
+def random_jobs(n_jobs, sample):
+    """
+    `n_jobs` jobs returned by `sample()`, a function drawing a dict of
+    hyperparameters.
+    """
+    return [State(sample()) for _ in xrange(n_jobs)]
+
+
+def _to_json(value):
+    # numpy scalars and arrays
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def _dumps(state):
+    return json.dumps(state, default=_to_json, sort_keys=True)
+
+
+def connect(filename):
+    db = sqlite3.connect(filename, timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+               'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+               'experiment TEXT, '
+               'status TEXT, '
+               'state TEXT, '
+               'start_time REAL, '
+               'end_time REAL, '
+               'error TEXT)')
+    db.commit()
+    return db
+
+
+def insert(filename, experiment, jobs):
+    """
+    Queue `jobs` (dicts of hyperparameters) for the function `experiment`
+    ("module.function").
+
+    Returns the ids of the new jobs.
+    """
+    db = connect(filename)
+    ids = []
+    with db:
+        for job in jobs:
+            cursor = db.execute(
+                'INSERT INTO jobs (experiment, status, state) '
+                'VALUES (?, ?, ?)', (experiment, QUEUED, _dumps(job)))
+            ids.append(cursor.lastrowid)
+    db.close()
+    return ids
+
+
+def requeue(filename, statuses=(RUNNING, ERROR)):
+    """
+    Queue again the jobs in `statuses`, e.g. the jobs left running when
+    `run` was interrupted.
+    """
+    db = connect(filename)
+    with db:
+        db.execute('UPDATE jobs SET status = ?, error = NULL WHERE status '
+                   'IN (%s)' % ', '.join('?' * len(statuses)),
+                   (QUEUED,) + tuple(statuses))
+    db.close()
+
+
+def jobs(filename):
+    """
+    List of (id, status, state) of all the jobs
+    """
+    db = connect(filename)
+    rows = db.execute('SELECT id, status, state FROM jobs ORDER BY id')
+    rval = [(id, status, State(json.loads(state)))
+            for id, status, state in rows]
+    db.close()
+    return rval
+
+
+def _claim(filename):
+    """
+    Mark the first queued job as running and return its id, None if no job
+    is queued.
+    """
+    db = connect(filename)
+    db.isolation_level = None
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        row = db.execute('SELECT id FROM jobs WHERE status = ? '
+                         'ORDER BY id LIMIT 1', (QUEUED,)).fetchone()
+        if row is None:
+            db.execute('COMMIT')
+            return None
+        db.execute('UPDATE jobs SET status = ?, start_time = ?, '
+                   'end_time = NULL, error = NULL WHERE id = ?',
+                   (RUNNING, time.time(), row[0]))
+        db.execute('COMMIT')
+        return row[0]
+    finally:
+        db.close()
+
+
+def _finish(filename, job_id, status, error=None):
+    db = connect(filename)
+    with db:
+        db.execute('UPDATE jobs SET status = ?, end_time = ?, error = ? '
+                   'WHERE id = ?', (status, time.time(), error, job_id))
+    db.close()
+
+
+class Channel(object):
+    """
+    The part of jobman's channel used by the entry points: `save()` writes
+    the state of the job to the sweep file.
+    """
+    COMPLETE = DONE
+    INCOMPLETE = QUEUED
+
+    def __init__(self, filename, job_id, state):
+        self.filename = filename
+        self.job_id = job_id
+        self.state = state
+
+    def save(self):
+        db = connect(self.filename)
+        with db:
+            db.execute('UPDATE jobs SET state = ? WHERE id = ?',
+                       (_dumps(self.state), self.job_id))
+        db.close()
+
+
+def work_dir(filename, job_id):
+    return os.path.join(os.path.abspath(filename) + '.jobs', str(job_id))
+
+
+def run_job(filename, job_id):
+    """
+    Run job `job_id` in the current process, in its working directory.
+    """
+    filename = os.path.abspath(filename)
+    db = connect(filename)
+    experiment, state = db.execute(
+        'SELECT experiment, state FROM jobs WHERE id = ?',
+        (job_id,)).fetchone()
+    db.close()
+    state = State(json.loads(state))
+    channel = Channel(filename, job_id, state)
+
+    directory = work_dir(filename, job_id)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    os.chdir(directory)
+
+    try:
+        module, function = experiment.rsplit('.', 1)
+        function = getattr(__import__(module, fromlist=[function]), function)
+        status = function(state, channel)
+        channel.save()
+    except:
+        channel.save()
+        _finish(filename, job_id, ERROR, traceback.format_exc())
+        raise
+    if status == Channel.INCOMPLETE:
+        _finish(filename, job_id, QUEUED)
+    else:
+        _finish(filename, job_id, DONE)
+
+
+def run(filename, n_workers=1, n_threads=1):
+    """
+    Run the queued jobs until none is left, `n_workers` at a time, each
+    one in a new process using `n_threads` threads.
+    """
+    filename = os.path.abspath(filename)
+    env = dict(os.environ)
+    for name in THREAD_VARIABLES:
+        env[name] = str(n_threads)
+    # the entry point is imported from the same path as in this process
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.abspath(p) for p in sys.path if p] +
+        [os.getcwd()])
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            job_id = _claim(filename)
+            if job_id is None:
+                return
+            with lock:
+                print 'Starting job %d' % job_id
+            directory = work_dir(filename, job_id)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(os.path.join(directory, 'stdout'), 'a') as out:
+                code = subprocess.call(
+                    [sys.executable, '-m', 'emotiw.common.utils.sweep', 'job',
+                     filename, str(job_id)],
+                    env=env, stdout=out, stderr=subprocess.STDOUT)
+            if code != 0:
+                # the process may have died before recording the error
+                db = connect(filename)
+                status, = db.execute('SELECT status FROM jobs WHERE id = ?',
+                                     (job_id,)).fetchone()
+                db.close()
+                if status == RUNNING:
+                    _finish(filename, job_id, ERROR,
+                            'exit status %d' % code)
+            with lock:
+                print 'Job %d exited with status %d' % (job_id, code)
+
+    threads = [threading.Thread(target=work) for _ in xrange(n_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def format_num(num):
+    """
+    Floats with 7 decimals, anything else as a string
+    """
+    if num is None:
+        return ''
+    if isinstance(num, float):
+        return "%.7f" % num
+    return str(num)
+
+
+def format_table(rows):
+    """
+    Text table of `rows`, the first one being the header.
+    """
+    rows = [[format_num(x) for x in row] for row in rows]
+    col_paddings = [max(len(row[i]) for row in rows)
+                    for i in range(len(rows[0]))]
+
+    lines = []
+    for row_num, row in enumerate(rows):
+        lines.append(" ".join(col.ljust(col_paddings[i] + 2) + "|"
+                              for i, col in enumerate(row)))
+        if row_num == 0:
+            lines.append(" ".join("".ljust(col_paddings[i] + 1, "-") + " +"
+                                  for i in range(len(row))))
+    return "\n".join(lines)
+
+
+def view(filename, columns=None, order_by=('tag', '-valid_error')):
+    """
+    Print the jobs of the sweep file as a table.
+
+    :param columns: keys of the job states to show after the id and the
+    status, all of them by default
+    :param order_by: keys to sort the jobs by, descending order when
+    prefixed by '-'
+    """
+    all_jobs = jobs(filename)
+    if columns is None:
+        columns = sorted(set(key for _, _, state in all_jobs
+                             for key in state.keys()))
+
+    for key in reversed(order_by):
+        reverse = key.startswith('-')
+        key = key.lstrip('-')
+        all_jobs.sort(key=lambda job: job[2].get(key), reverse=reverse)
+
+    results = [['id', 'status'] + list(columns)]
+    for job_id, status, state in all_jobs:
+        results.append([job_id, status] + [state.get(c) for c in columns])
+    print format_table(results)
+
+
+if __name__ == '__main__':
+    command, filename = sys.argv[1:3]
+    if command == 'job':
+        run_job(filename, int(sys.argv[3]))
+    elif command == 'run':
+        run(filename, *[int(x) for x in sys.argv[3:5]])
+    elif command == 'view':
+        view(filename, sys.argv[3:] or None)
+    elif command == 'requeue':
+        requeue(filename)
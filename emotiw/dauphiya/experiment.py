@@ -2,6 +2,7 @@ import sys
 import cPickle
 import os
 import re
+import threading
 import time
 
 import PIL.Image
@@ -12,6 +13,8 @@ import ml
 from jobman import DD
 import jobman, jobman.sql
 from utils import tile_raster_images
+from emotiw.common.datasets.audio_store import AudioFeatureStore
+from emotiw.common.utils import sweep
 
 
 def save_weights(model, epoch):
@@ -29,6 +32,74 @@ def save_weights(model, epoch):
     image.save('weights_%d.png' % epoch)
 
 
+FEATURES_PATH = "/data/lisa/data/faces/EmotiW/complete_audio_features"
+
+
+def load_features(path, split, features, labels):
+    """
+    Load the clips of a split as a list of matrices and a vector of
+    labels. `features` is a subset name, followed by ".pca" for the PCA
+    projected features, e.g. "minimal.pca".
+    """
+    subset = features.split(".")[0]
+    pca = features.endswith(".pca")
+    
+    x = []
+    y = []
+    if os.path.isfile(os.path.join(path, "index.pkl")):
+        store = AudioFeatureStore(path)
+        for idx in store.select(split):
+            x.append(numpy.asarray(store.get(idx, subset, pca), theano.config.floatX))
+            y.append(labels.index(store.labels[idx]))
+    else:
+        for directory, dirnames, filenames in os.walk(os.path.join(path, split)):
+            for filename in filenames:
+                if filename.find("%s.pkl" % features) != -1:
+                    feat = numpy.load(os.path.join(directory, filename))
+                    targ = numpy.argmax(map(lambda x: directory.find(x) != -1, labels))
+                    
+                    x.append(numpy.asarray(feat, theano.config.floatX))
+                    y.append(targ)
+    return x, numpy.asarray(y)
+
+
+class ClipEvaluator(object):
+    """
+    Classification error of a model over a set of clips.
+    
+    The clips are centred once and concatenated, so the clean network
+    sees them in a few segment-pooled batches of `batch_size` clips
+    instead of one call per clip. `clips` are views of the centred
+    clips, in the original order.
+    """
+    def __init__(self, clips, labels, means, batch_size=64):
+        lengths = [x.shape[0] for x in clips]
+        
+        self.x = numpy.empty((sum(lengths), clips[0].shape[1]), theano.config.floatX)
+        self.offsets = numpy.zeros(len(clips) + 1, dtype='int64')
+        self.offsets[1:] = numpy.cumsum(lengths)
+        
+        self.clips = []
+        for i, x in enumerate(clips):
+            clip = self.x[self.offsets[i]:self.offsets[i + 1]]
+            numpy.subtract(x, means, out=clip)
+            self.clips.append(clip)
+        
+        self.labels = numpy.asarray(labels)
+        self.batch_size = batch_size
+    
+    def predict(self, model, snapshot=False):
+        out = []
+        for start in range(0, len(self.clips), self.batch_size):
+            offsets = self.offsets[start:start + self.batch_size + 1]
+            x = self.x[offsets[0]:offsets[-1]]
+            out.append(model.output(x, offsets=offsets - offsets[0], snapshot=snapshot))
+        return numpy.concatenate(out)
+    
+    def error(self, model, snapshot=False):
+        return numpy.mean(self.labels != self.predict(model, snapshot))
+
+
 def main(n_hiddens=400,
          n_layers=2,
 		 learning_rate=0.001,
@@ -37,6 +108,10 @@ def main(n_hiddens=400,
 		 rbm_epochs=32,
 		 rbm_batch_size=100,
 		 example_dropout=32,
+		 clip_batch_size=16,
+		 eval_batch_size=64,
+		 eval_every=1,
+		 eval_background=False,
 		 l2=None,
 		 train_epochs=200,
 		 K=1,
@@ -50,34 +125,20 @@ def main(n_hiddens=400,
     
     LABELS = ["Disgust",  "Fear",  "Happy",  "Neutral",  "Sad",  "Surprise", "Angry"]
     
-    train_x = []
-    train_y = []
-    for directory, dirnames, filenames in os.walk("/data/lisa/data/faces/EmotiW/complete_audio_features/Train"):
-        for filename in filenames:
-            if filename.find("%s.pkl" % features) != -1:
-                feat = numpy.load(os.path.join(directory, filename))
-                targ = numpy.argmax(map(lambda x: directory.find(x) != -1, LABELS))
-                
-                train_x.append(numpy.asarray(feat, theano.config.floatX))
-                train_y.append(targ)
-    train_y = numpy.asarray(train_y)
+    train_x, train_y = load_features(FEATURES_PATH, "Train", features, LABELS)
     
     pretrain_x = numpy.load("/data/lisatmp/dauphiya/emotiw/mlp_audio/train_x_%s.npy" % features)
     
-    valid_x = []
-    valid_y = []
-    for directory, dirnames, filenames in os.walk("/data/lisa/data/faces/EmotiW/complete_audio_features/Val"):
-        for filename in filenames:
-            if filename.find("%s.pkl" % features) != -1:
-                feat = numpy.load(os.path.join(directory, filename))
-                targ = numpy.argmax(map(lambda x: directory.find(x) != -1, LABELS))
-                
-                valid_x.append(numpy.asarray(feat, theano.config.floatX))
-                valid_y.append(targ)
-    valid_y = numpy.asarray(train_y)
+    valid_x, valid_y = load_features(FEATURES_PATH, "Val", features, LABELS)
     
     means = numpy.asarray(numpy.sum([x.sum(0) for x in train_x], 0) / sum([x.shape[0] for x in train_x]), theano.config.floatX)
     
+    # centred once, training reads the centred clips too
+    train_eval = ClipEvaluator(train_x, train_y, means, eval_batch_size)
+    valid_eval = ClipEvaluator(valid_x, valid_y, means, eval_batch_size)
+    train_x = train_eval.clips
+    del valid_x
+    
     train_inds = range(len(train_x))
     numpy.random.shuffle(train_inds)
     
@@ -98,10 +159,8 @@ def main(n_hiddens=400,
                    momentum=momentum)
     
     rbms = []
-    def project(x):
-       for rbm in rbms:
-           x = rbm.mean_h(x)
-       return x
+    # input of the RBM being trained, projected once by every layer
+    rbm_x = pretrain_x
 
     for i in range(len(layers) - 1):
        print "Training RBM %d..." % i
@@ -118,7 +177,7 @@ def main(n_hiddens=400,
                                  epochs=rbm_epochs,
                                  K=K)
 
-       rbm.fit(pretrain_x, project=project, verbose=True)
+       rbm.fit(rbm_x, verbose=True, shared=True)
 
        model.layers[i].W.set_value(rbm.W)
        model.layers[i].b.set_value(rbm.c)
@@ -126,62 +185,34 @@ def main(n_hiddens=400,
        numpy.save("rbm_W_%d.npy" % i, rbm.W)
 
        rbms.append(rbm)
+       if i < len(layers) - 2:
+           rbm_x = ml.project_in_chunks(rbm.mean_h, rbm_x)
+    
+    print "Compiled %d RBM functions in %.2f sec" % (
+        ml.compile_stats['count'], ml.compile_stats['time'])
     
     print "Training model..."
 
     epoch_times = []
     
-    best_train_error = float('inf')
+    best = {'train_error' : float('inf'), 'valid_error' : float('inf')}
     
-    best_valid_error = float('inf')
+    def evaluate(snapshot):
+        return (train_eval.error(model, snapshot),
+                valid_eval.error(model, snapshot))
     
-    for epoch in range(train_epochs):
-        begin = time.time()
-
-        losses = []
-        
-        for minibatch in range(len(train_inds)):
-            x = train_x[train_inds[minibatch]] - means
-            y = train_y[[train_inds[minibatch]]]
-            
-            inds = range(x.shape[0])
-            numpy.random.shuffle(inds)
-            inds = inds[:example_dropout]
-            
-            losses.append(model.train(x[inds], y))
-        end = time.time()
-        
-        loss = numpy.mean(losses)
-        
-        train_error = 0.
-        for minibatch in range(len(train_inds)):
-            x = train_x[train_inds[minibatch]] - means
-            y = train_y[train_inds[minibatch]]
-            
-            train_error += (y != model.output(x))[0]
-        train_error /= len(train_inds)
-        
-        valid_error = 0.
-        for minibatch in range(len(valid_y)):
-            x = valid_x[minibatch] - means
-            y = valid_y[[minibatch]]
-            
-            valid_error += (y != model.output(x))[0]
-        valid_error /= len(valid_y)
-        
-        epoch_times.append((end - begin) / 60)
-        
+    def report(epoch, loss, train_error, valid_error, params=None):
         mean_epoch_time = numpy.mean(epoch_times)
         
-        if train_error < best_train_error:
-            best_train_error = train_error
+        if train_error < best['train_error']:
+            best['train_error'] = train_error
         elif epoch > 50:
             model.trainer.learning_rate.set_value(numpy.asarray(0.95 * model.trainer.learning_rate.get_value(), dtype=theano.config.floatX))
         
-        if valid_error < best_valid_error:
-            best_valid_error = valid_error
+        if valid_error < best['valid_error']:
+            best['valid_error'] = valid_error
             
-            model.save()
+            model.save(params)
         elif epoch > 50:
             model.trainer.learning_rate.set_value(numpy.asarray(0.95 * model.trainer.learning_rate.get_value(), dtype=theano.config.floatX))
         
@@ -191,10 +222,75 @@ def main(n_hiddens=400,
             state.epoch = epoch
             state.epoch_time = mean_epoch_time
             state.loss = loss
-            state.train_error = best_train_error
-            state.valid_error = best_valid_error
+            state.train_error = best['train_error']
+            state.valid_error = best['valid_error']
             
             channel.save()
+    
+    # evaluation running in the background on a snapshot of the
+    # parameters: (thread, epoch, loss, params, result)
+    pending = None
+    
+    def finish(pending):
+        thread, epoch, loss, params, result = pending
+        thread.join()
+        if 'error' in result:
+            raise result['error'][0], result['error'][1], result['error'][2]
+        report(epoch, loss, *result['errors'], params=params)
+    
+    for epoch in range(train_epochs):
+        begin = time.time()
+
+        losses = []
+        
+        # minibatches of clip_batch_size clips, each one reduced to
+        # example_dropout random frames and concatenated
+        for start in range(0, len(train_inds), clip_batch_size):
+            batch_inds = train_inds[start:start + clip_batch_size]
+            x = []
+            offsets = [0]
+            for ind in batch_inds:
+                inds = range(train_x[ind].shape[0])
+                numpy.random.shuffle(inds)
+                inds = inds[:example_dropout]
+                
+                x.append(train_x[ind][inds])
+                offsets.append(offsets[-1] + len(inds))
+            y = train_y[batch_inds]
+            
+            losses.append(model.train(numpy.concatenate(x), y, offsets))
+        end = time.time()
+        
+        loss = numpy.mean(losses)
+        
+        epoch_times.append((end - begin) / 60)
+        
+        if (epoch + 1) % eval_every != 0 and epoch != train_epochs - 1:
+            print "epoch = %d, loss = %.4f" % (epoch, loss)
+            continue
+        
+        if not eval_background:
+            report(epoch, loss, *evaluate(False))
+            continue
+        
+        # the learning rate decay of an evaluation is applied when it is
+        # collected, before starting the next one
+        if pending is not None:
+            finish(pending)
+        
+        result = {}
+        def run(result=result):
+            try:
+                result['errors'] = evaluate(True)
+            except:
+                result['error'] = sys.exc_info()
+        params = model.snapshot()
+        thread = threading.Thread(target=run)
+        thread.start()
+        pending = (thread, epoch, loss, params, result)
+    
+    if pending is not None:
+        finish(pending)
 
 
 def jobman_entrypoint(state, channel):
@@ -203,23 +299,48 @@ def jobman_entrypoint(state, channel):
     return channel.COMPLETE
 
 
-def jobman_insert_random(n_jobs):
-    JOBDB = 'postgres://dauphiya@opter.iro.umontreal.ca/dauphiya_db/emotiw_mlp_audio'
-    EXPERIMENT_PATH = "experiment.jobman_entrypoint"
+JOBDB = 'postgres://dauphiya@opter.iro.umontreal.ca/dauphiya_db/emotiw_mlp_audio'
+EXPERIMENT_PATH = "experiment.jobman_entrypoint"
+
+# local sweeps, see emotiw.common.utils.sweep
+SWEEP_DB = "emotiw_mlp_audio.sqlite"
+SWEEP_COLUMNS = ['tag', 'n_hiddens', 'learning_rate', 'momentum', 'features',
+                 'example_dropout', 'n_layers', 'train_error', 'valid_error']
+
+JOB_VALS = {
+    'n_hiddens' : [1024],
+    'n_layers' : [1],
+    'learning_rate' : [0.01, 0.001],
+    'rbm_learning_rate' : [0.001, 0.0001],
+    'rbm_epochs' : [32,],
+    'example_dropout' : [32],
+    'l2' : [0],
+    'train_epochs' : [200],
+    'K' : [1, 5, 10],
+    'tag' : ['pretrain-all2'],
+    }
 
+
+def random_job():
+    job = DD()
+    
+    job.n_hiddens = numpy.random.randint(8, 512)
+    job.n_layers = numpy.random.randint(1, 4)
+    job.learning_rate = 10.**numpy.random.uniform(-3, -0)
+    job.momentum = 10.**numpy.random.uniform(-1, -0)
+    job.features = ["minimal.pca", "full.pca"][numpy.random.binomial(1, 0.5)]
+    job.example_dropout = numpy.random.randint(16, 200)
+    job.rbm_learning_rate = 10.**numpy.random.uniform(-3, -0)
+    job.rbm_epochs = numpy.random.randint(8, 100)
+    job.tag = "pretrain"
+    
+    return job
+
+
+def jobman_insert_random(n_jobs):
     jobs = []
     for _ in range(n_jobs):
-        job = DD()
-        
-        job.n_hiddens = numpy.random.randint(8, 512)
-        job.n_layers = numpy.random.randint(1, 4)
-        job.learning_rate = 10.**numpy.random.uniform(-3, -0)
-        job.momentum = 10.**numpy.random.uniform(-1, -0)
-        job.features = ["minimal.pca", "full.pca"][numpy.random.binomial(1, 0.5)]
-        job.example_dropout = numpy.random.randint(16, 200)
-        job.rbm_learning_rate = 10.**numpy.random.uniform(-3, -0)
-        job.rbm_epochs = numpy.random.randint(8, 100)
-        job.tag = "pretrain"
+        job = random_job()
 
         jobs.append(job)
         print job
@@ -238,38 +359,10 @@ def jobman_insert_random(n_jobs):
 
 
 def produit_cartesien_jobs(val_dict):
-    job_list = [DD()]
-    all_keys = val_dict.keys()
-
-    for key in all_keys:
-        possible_values = val_dict[key]
-        new_job_list = []
-        for val in possible_values:
-            for job in job_list:
-                to_insert = job.copy()
-                to_insert.update({key: val})
-                new_job_list.append(to_insert)
-        job_list = new_job_list
-
-    return job_list
+    return [DD(job) for job in sweep.produit_cartesien_jobs(val_dict)]
 
 
 def jobman_insert():
-    JOBDB = 'postgres://dauphiya@opter.iro.umontreal.ca/dauphiya_db/emotiw_mlp_audio'
-    EXPERIMENT_PATH = "experiment.jobman_entrypoint"
-    JOB_VALS = {
-        'n_hiddens' : [1024],
-        'n_layers' : [1],
-        'learning_rate' : [0.01, 0.001],
-        'rbm_learning_rate' : [0.001, 0.0001],
-        'rbm_epochs' : [32,],
-        'example_dropout' : [32],
-        'l2' : [0],
-        'train_epochs' : [200],
-        'K' : [1, 5, 10],
-        'tag' : ['pretrain-all2'],
-        }
-
     jobs = produit_cartesien_jobs(JOB_VALS)
     
     for job in jobs:
@@ -331,39 +424,44 @@ def view(table="emotiw_mlp_audio",
                                     sqlalchemy.desc(experiments.columns.validerror)]).execute()
     results = [map(lambda x: x.name, columns)] + list(results)
 
-    def get_max_width(table, index):
-        """Get the maximum width of the given column index"""
-        return max([len(format_num(row[index])) for row in table])
-
-    def format_num(num):
-        """Format a number according to given places.
-        Adds commas, etc. Will truncate floats into ints!"""
-        try:
-            if "." in num:
-                return "%.7f" % float(num)
-            else:
-                return int(num)
-        except (ValueError, TypeError):
-            return str(num)
-
-    col_paddings = []
-
-    for i in range(len(results[0])):
-        col_paddings.append(get_max_width(results, i))
-
-    for row_num, row in enumerate(results):
-        for i in range(len(row)):
-            col = format_num(row[i]).ljust(col_paddings[i] + 2) + "|"
-            print col,
-        print
-
-        if row_num == 0:
-            for i in range(len(row)):
-                print "".ljust(col_paddings[i] + 1, "-") + " +",
-            print
+    print sweep.format_table(results)
+
+
+def sweep_insert(n_jobs=0):
+    """
+    Queue n_jobs random jobs in the local sweep file, or the grid JOB_VALS
+    if n_jobs is 0.
+    """
+    if n_jobs:
+        jobs = sweep.random_jobs(n_jobs, random_job)
+    else:
+        jobs = sweep.produit_cartesien_jobs(JOB_VALS)
+    
+    numpy.random.shuffle(jobs)
+    sweep.insert(SWEEP_DB, EXPERIMENT_PATH, jobs)
+    
+    print "inserted %d jobs" % len(jobs)
+    print "To run: python experiment.py sweep run <n_workers> <n_threads>"
+
+
+def sweep_run(n_workers=1, n_threads=1):
+    sweep.run(SWEEP_DB, n_workers, n_threads)
+
+
+def sweep_view():
+    sweep.view(SWEEP_DB, SWEEP_COLUMNS)
+
 
 if __name__ == "__main__":
-    if "insert" in sys.argv:
+    if "sweep" in sys.argv:
+        args = sys.argv[sys.argv.index("sweep") + 1:]
+        if args[0] == "insert":
+            sweep_insert(*map(int, args[1:]))
+        elif args[0] == "run":
+            sweep_run(*map(int, args[1:]))
+        elif args[0] == "view":
+            sweep_view()
+    elif "insert" in sys.argv:
         jobman_insert_random(int(sys.argv[2]))
     elif "view" in sys.argv:
         view()
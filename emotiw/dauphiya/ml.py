@@ -7,12 +7,59 @@ from theano import sparse as S
 from theano.tensor.shared_randomstreams import RandomStreams
 import scipy.sparse
 
+from emotiw.common.utils.sequences import (length_buckets, pad_sequences,
+                                           predict_in_batches)
+
+
+# Functions compiled by `symbolic`, shared by all the instances of a class
+# with the same signature, see `symbolic`. The compiled functions hold the
+# shared variables of the instance they were compiled with, so its arrays
+# stay alive for the life of the process, or until `clear_compiled()`.
+_compiled = {}
+
+# Number of functions compiled by `symbolic` and total compilation time
+compile_stats = {'count': 0, 'time': 0.}
+
+
+def clear_compiled():
+    """
+    Forget the shared compiled functions, and the shared variables they
+    hold. The instances compile them again when they are next called.
+    """
+    _compiled.clear()
+
+
+def _swapped_call(fn, template, variables, args):
+    """
+    Call `fn`, compiled with the shared variables `template`, on the
+    values of the shared variables `variables`. The values are swapped in
+    without copies and the updated values are given back to `variables`.
+    """
+    stash = [t.get_value(borrow=True) for t in template]
+    for t, v in zip(template, variables):
+        t.set_value(v.get_value(borrow=True), borrow=True)
+    try:
+        return fn(*args)
+    finally:
+        for t, v, value in zip(template, variables, stash):
+            v.set_value(t.get_value(borrow=True), borrow=True)
+            t.set_value(value, borrow=True)
+
 
 def symbolic(inputs):
     """
     Wrap a symbolic method so that it can also accept concrete arguments.
     The method will be compiled with the provided inputs and stored under
     the name of the method prefixed with '__'.
+    
+    If the class defines `_signature()` and `_swapped` (names of the shared
+    variables attributes the graph reads and updates), the compiled
+    function is shared by all the instances of the class with the same
+    signature: it is compiled with the shared variables of the first
+    instance and the ones of the other instances are swapped in for each
+    call. Shared variables created while building the graph (e.g. the
+    random states) belong to the compiled function, so their graphs must
+    not depend on what the signature leaves out.
         
     Parameters
     ----------
@@ -26,29 +73,50 @@ def symbolic(inputs):
     def decorator(method):
         name = "__" + method.__name__
         
+        def compile(self):
+            res = method(self, *inputs)
+            
+            if type(res) is tuple:
+                output, updates = res
+            else:
+                output, updates = res, None
+            
+            begin = time.time()
+            fn = theano.function(inputs, output, updates=updates)
+            compile_stats['count'] += 1
+            compile_stats['time'] += time.time() - begin
+            return fn
+        
         def wrapper(self, *args):
             if isinstance(args[0], T.Variable):
                 return method(self, *args)
-            elif hasattr(self, name):
-                return getattr(self, name)(*args)
-            else:
-                res = method(self, *inputs)
-                
-                if type(res) is tuple:
-                    output, updates = res
-                else:
-                    output, updates = res, None
-                
-                setattr(self, name, theano.function(inputs, output,
-                    updates=updates))
-                
+            elif not hasattr(self, '_signature'):
+                if not hasattr(self, name):
+                    setattr(self, name, compile(self))
                 return getattr(self, name)(*args)
+            
+            key = (type(self), method.__name__, self._signature())
+            variables = [getattr(self, attr) for attr in self._swapped]
+            if key not in _compiled:
+                _compiled[key] = (compile(self), variables)
+            fn, template = _compiled[key]
+            if all(t is v for t, v in zip(template, variables)):
+                return fn(*args)
+            return _swapped_call(fn, template, variables, args)
         
         return wrapper
     
     return decorator
 
 
+def project_in_chunks(project, X, chunk_size=10000):
+    """
+    Apply `project` to the rows of X by chunks of `chunk_size` rows.
+    """
+    return numpy.concatenate([project(X[i:i + chunk_size])
+        for i in range(0, X.shape[0], chunk_size)])
+
+
 class BinaryRBM(object):
     """
     Restricted Boltzmann Machine (RBM)
@@ -105,13 +173,32 @@ class BinaryRBM(object):
         self._b = theano.shared(numpy.array([], dtype=theano.config.floatX)
             if b == None else b)
         self.K = K
-        self.epsilon = epsilon
+        self._epsilon = theano.shared(numpy.asarray(epsilon,
+            dtype=theano.config.floatX), name='epsilon')
         self.n_samples = n_samples
         self.epochs = epochs
         self.h_samples = theano.shared(numpy.array([[]],
             dtype=theano.config.floatX))
+        # training set of fit(..., shared=True)
+        self._data = theano.shared(numpy.array([[]],
+            dtype=theano.config.floatX))
         self.rng = RandomStreams(numpy.random.randint(2**30))
     
+    # compiled functions are shared by the RBMs with the same signature
+    _swapped = ['_W', '_b', '_c', '_epsilon', 'h_samples', '_data']
+    
+    def _signature(self):
+        return (theano.config.floatX, self.n_hiddens, self.K)
+    
+    @property
+    def epsilon(self):
+        return self._epsilon.get_value()
+    
+    @epsilon.setter
+    def epsilon(self, val):
+        self._epsilon.set_value(numpy.asarray(val,
+            dtype=theano.config.floatX))
+    
     @property
     def W(self):
         return self._W.get_value()
@@ -255,7 +342,7 @@ class BinaryRBM(object):
         
         updates = {}
         for p, gp in zip(params, gparams):
-            updates[p] = p - self.epsilon * gp
+            updates[p] = p - self._epsilon * gp
         
         updates[self.h_samples] = h_neg
         
@@ -278,17 +365,29 @@ class BinaryRBM(object):
         pl: float
         """
         bit_i = theano.shared(value=0, name='bit_i')
+        # bit_i is shared by the RBMs of any number of visibles using the
+        # same compiled function, it may have been left past this one's
+        bit = bit_i % v_pos.shape[1]
 
         fe_xi = self.free_energy(v_pos)
 
-        fe_xi_ = self.free_energy(T.set_subtensor(v_pos[:, bit_i],
-            1 - v_pos[:, bit_i]))
+        fe_xi_ = self.free_energy(T.set_subtensor(v_pos[:, bit],
+            1 - v_pos[:, bit]))
 
-        updates[bit_i] = (bit_i + 1) % v_pos.shape[1]
+        updates[bit_i] = (bit + 1) % v_pos.shape[1]
         
         return T.mean(v_pos.shape[1] * T.log(T.nnet.sigmoid(fe_xi_ - fe_xi)))
     
-    def fit(self, X, verbose=False, callback=None, project=lambda x: x):
+    @symbolic([T.lscalar('begin'), T.lscalar('end')])
+    def _fit_slice(self, begin, end):
+        """
+        `_fit` on the rows begin:end of the training set held in a shared
+        variable by `fit(..., shared=True)`.
+        """
+        return self._fit(self._data[begin:end])
+    
+    def fit(self, X, verbose=False, callback=None, project=lambda x: x,
+            shared=False):
         """
         Fit the model to the data X.
 
@@ -297,8 +396,21 @@ class BinaryRBM(object):
         X: array-like, shape (n_samples, n_features)
             Training data, where n_samples in the number of samples
             and n_features is the number of features.
+        project: fn
+            Applied to the data before fitting, e.g. the lower layers of
+            a stack of RBMs.
+        shared: bool
+            If True, X is projected once and kept in a shared variable,
+            minibatches are slices of it taken inside the compiled
+            function and it is shuffled in place at every epoch.
+            Otherwise every minibatch is projected at every epoch.
         """
-        n_in = project(X[[0]]).shape[1]
+        if shared:
+            self._data.set_value(numpy.asarray(project_in_chunks(project, X),
+                dtype=theano.config.floatX), borrow=True)
+            n_in = self._data.get_value(borrow=True).shape[1]
+        else:
+            n_in = project(X[[0]]).shape[1]
         if self.W.shape[1] == 0:
             self.W = numpy.asarray(numpy.random.normal(0, 0.01,
                 (n_in, self.n_hiddens)), dtype=theano.config.floatX)
@@ -316,8 +428,16 @@ class BinaryRBM(object):
         for epoch in range(self.epochs):
             loss = []
             begin = time.time()
-            for minibatch in range(n_batches):
-                loss.append(self._fit(project(X[inds[minibatch::n_batches]])))
+            if shared:
+                data = self._data.get_value(borrow=True)
+                numpy.random.shuffle(data)
+                self._data.set_value(data, borrow=True)
+                for minibatch in range(n_batches):
+                    loss.append(self._fit_slice(minibatch * self.n_samples,
+                        (minibatch + 1) * self.n_samples))
+            else:
+                for minibatch in range(n_batches):
+                    loss.append(self._fit(project(X[inds[minibatch::n_batches]])))
             end = time.time()
 
             if verbose:
@@ -328,6 +448,10 @@ class BinaryRBM(object):
 
                 if callback != None:
                     callback(self, epoch)
+        
+        if shared:
+            self._data.set_value(numpy.array([[]],
+                dtype=theano.config.floatX))
 
 
 class GaussianRBM(object):
@@ -386,13 +510,32 @@ class GaussianRBM(object):
         self._b = theano.shared(numpy.array([], dtype=theano.config.floatX)
             if b == None else b)
         self.K = K
-        self.epsilon = epsilon
+        self._epsilon = theano.shared(numpy.asarray(epsilon,
+            dtype=theano.config.floatX), name='epsilon')
         self.n_samples = n_samples
         self.epochs = epochs
         self.h_samples = theano.shared(numpy.array([[]],
             dtype=theano.config.floatX))
+        # training set of fit(..., shared=True)
+        self._data = theano.shared(numpy.array([[]],
+            dtype=theano.config.floatX))
         self.rng = RandomStreams(numpy.random.randint(2**30))
     
+    # compiled functions are shared by the RBMs with the same signature
+    _swapped = ['_W', '_b', '_c', '_epsilon', 'h_samples', '_data']
+    
+    def _signature(self):
+        return (theano.config.floatX, self.n_hiddens, self.K)
+    
+    @property
+    def epsilon(self):
+        return self._epsilon.get_value()
+    
+    @epsilon.setter
+    def epsilon(self, val):
+        self._epsilon.set_value(numpy.asarray(val,
+            dtype=theano.config.floatX))
+    
     @property
     def W(self):
         return self._W.get_value()
@@ -536,7 +679,7 @@ class GaussianRBM(object):
         
         updates = {}
         for p, gp in zip(params, gparams):
-            updates[p] = p - self.epsilon * gp
+            updates[p] = p - self._epsilon * gp
         
         updates[self.h_samples] = h_neg
         
@@ -561,7 +704,16 @@ class GaussianRBM(object):
         
         return ((v_pos - z)**2).sum(1).mean()
     
-    def fit(self, X, verbose=False, callback=None, project=lambda x: x):
+    @symbolic([T.lscalar('begin'), T.lscalar('end')])
+    def _fit_slice(self, begin, end):
+        """
+        `_fit` on the rows begin:end of the training set held in a shared
+        variable by `fit(..., shared=True)`.
+        """
+        return self._fit(self._data[begin:end])
+    
+    def fit(self, X, verbose=False, callback=None, project=lambda x: x,
+            shared=False):
         """
         Fit the model to the data X.
         
@@ -570,8 +722,21 @@ class GaussianRBM(object):
         X: array-like, shape (n_samples, n_features)
             Training data, where n_samples in the number of samples
             and n_features is the number of features.
+        project: fn
+            Applied to the data before fitting, e.g. the lower layers of
+            a stack of RBMs.
+        shared: bool
+            If True, X is projected once and kept in a shared variable,
+            minibatches are slices of it taken inside the compiled
+            function and it is shuffled in place at every epoch.
+            Otherwise every minibatch is projected at every epoch.
         """
-        n_in = project(X[[0]]).shape[1]
+        if shared:
+            self._data.set_value(numpy.asarray(project_in_chunks(project, X),
+                dtype=theano.config.floatX), borrow=True)
+            n_in = self._data.get_value(borrow=True).shape[1]
+        else:
+            n_in = project(X[[0]]).shape[1]
         if self.W.shape[1] == 0:
             self.W = numpy.asarray(numpy.random.normal(0, 0.01,
                 (n_in, self.n_hiddens)), dtype=theano.config.floatX)
@@ -589,8 +754,16 @@ class GaussianRBM(object):
         for epoch in range(self.epochs):
             loss = []
             begin = time.time()
-            for minibatch in range(n_batches):
-                loss.append(self._fit(project(X[inds[minibatch::n_batches]])))
+            if shared:
+                data = self._data.get_value(borrow=True)
+                numpy.random.shuffle(data)
+                self._data.set_value(data, borrow=True)
+                for minibatch in range(n_batches):
+                    loss.append(self._fit_slice(minibatch * self.n_samples,
+                        (minibatch + 1) * self.n_samples))
+            else:
+                for minibatch in range(n_batches):
+                    loss.append(self._fit(project(X[inds[minibatch::n_batches]])))
             end = time.time()
             
             if verbose:
@@ -601,6 +774,10 @@ class GaussianRBM(object):
                 
                 if callback != None:
                     callback(self, epoch)
+        
+        if shared:
+            self._data.set_value(numpy.array([[]],
+                dtype=theano.config.floatX))
 
 class SetRBM(object):
     """
@@ -883,10 +1060,42 @@ class NeuralNetworkTrainer(object):
         return self._train(*args)
 
 
+def segment_max(x, offsets):
+    """
+    Max-pooling of the rows of x by segments, the rows of segment i being
+    x[offsets[i]:offsets[i + 1]].
+    
+    Returns a (len(offsets) - 1, x.shape[1]) matrix.
+    """
+    rval, _ = theano.scan(lambda begin, end, x: T.max(x[begin:end], axis=0),
+                          sequences=[offsets[:-1], offsets[1:]],
+                          non_sequences=x)
+    return rval
+
+
+def _clip_offsets(x, offsets):
+    """
+    Offsets of a single clip if none are given.
+    """
+    if offsets is None:
+        return numpy.array([0, x.shape[0]], dtype='int64')
+    return numpy.asarray(offsets, dtype='int64')
+
+
 class MLP(object):
+    """
+    MLP classifying clips of frames. The frames go through the hidden
+    layers and are max-pooled over the clip before the last layer.
+    
+    A minibatch holds the frames of several clips one after the other,
+    with offsets such that the frames of clip i are
+    x[offsets[i]:offsets[i + 1]]. The loss is averaged over the clips.
+    Without offsets, x is a single clip.
+    """
     def __init__(self, n_in, layers, hidden_dropout=0.5, l2=None, **kwargs):
         x = T.fmatrix('x')
         y = T.lvector('y')
+        offsets = T.lvector('offsets')
 
         type_map = {
             'L' : LogisticLayer,
@@ -914,8 +1123,10 @@ class MLP(object):
                 layer_n_in = self.layers[-1].n_out
 
             if i == len(layers) - 1:
-                layer_input = T.max(layer_input, axis=0)
-                layer_input = layer_input * self.rng.binomial(n=1, p=hidden_dropout,
+                layer_input = segment_max(layer_input, offsets)
+                # one dropout mask per clip
+                layer_input = layer_input * self.rng.binomial(
+                    size=layer_input.shape, n=1, p=hidden_dropout,
                     dtype=theano.config.floatX) / hidden_dropout
             
             xargs = {}
@@ -944,7 +1155,7 @@ class MLP(object):
                 layer_n_in = self.clean_layers[-1].n_out
 
             if i == len(layers) - 1:
-                layer_input = T.max(layer_input, axis=0)
+                layer_input = segment_max(layer_input, offsets)
 
             xargs = {}
 
@@ -960,36 +1171,84 @@ class MLP(object):
 
             self.clean_layers.append(layer)
         
-        self._output = theano.function([x], T.argmax(self.clean_layers[-1].output, axis=1))
+        self._output = theano.function([x, offsets], T.argmax(self.clean_layers[-1].output, axis=1))
         
-        self.transform = theano.function([x], T.max(self.clean_layers[-2].output, axis=0))
+        # inputs and predictions of the clean network, compiled again on
+        # copies of the parameters by `snapshot`
+        self._inputs = [x, offsets]
+        self._prediction = T.argmax(self.clean_layers[-1].output, axis=1)
+        self._snapshot_params = None
+        self._snapshot_output = None
+        
+        self._transform = theano.function([x, offsets],
+            segment_max(self.clean_layers[-2].output, offsets))
         
         loss = -T.mean(T.log(self.layers[-1].output)[T.arange(y.shape[0]), y])
         
         if l2 != None:
             loss += l2 * sum([(l.W**2).sum() for l in self.layers])
         
-        self.trainer = NeuralNetworkTrainer([x, y], loss, self.layers, **kwargs)
+        self.trainer = NeuralNetworkTrainer([x, y, offsets], loss, self.layers, **kwargs)
 
         
-    def train(self, *args):
-        return self.trainer.train(*args)
+    def train(self, x, y, offsets=None):
+        return self.trainer.train(x, y, _clip_offsets(x, offsets))
 
 
-    def output(self, x, batch_size=None):
-        if batch_size:
+    def output(self, x, batch_size=None, offsets=None, snapshot=False):
+        if snapshot:
+            return self._snapshot_output(x, _clip_offsets(x, offsets))
+        if offsets is not None:
+            return self._output(x, _clip_offsets(x, offsets))
+        elif batch_size:
             out = []
             n_batches = int(numpy.ceil(x.shape[0] / float(batch_size)))
             for n in range(n_batches):
-                out.append(self._output(x[n * batch_size : (n+1) * batch_size ]))
+                batch = x[n * batch_size : (n+1) * batch_size ]
+                out.append(self._output(batch, _clip_offsets(batch, None)))
             return numpy.concatenate(out)
         else:
-            return self._output(x)
+            return self._output(x, _clip_offsets(x, None))
 
-    def save(self):
-        for i, layer in enumerate(self.layers):
-            numpy.save("W_%d.npy" % i, layer.W.get_value())
-            numpy.save("b_%d.npy" % i, layer.b.get_value())
+
+    def transform(self, x, offsets=None):
+        rval = self._transform(x, _clip_offsets(x, offsets))
+        if offsets is None:
+            return rval[0]
+        return rval
+
+    def snapshot(self):
+        """
+        Copy the parameters into the ones used by `output(...,
+        snapshot=True)`, so the network can be evaluated from another
+        thread while training goes on.
+        
+        Returns the copied values, as a list of (W, b) per layer.
+        """
+        params = [layer.W for layer in self.layers] + \
+                 [layer.b for layer in self.layers]
+        
+        if self._snapshot_params is None:
+            self._snapshot_params = [theano.shared(p.get_value(), name=p.name)
+                                     for p in params]
+            self._snapshot_output = theano.function(self._inputs,
+                self._prediction,
+                givens=zip(params, self._snapshot_params))
+        else:
+            for p, s in zip(params, self._snapshot_params):
+                s.set_value(p.get_value())
+        
+        values = [s.get_value() for s in self._snapshot_params]
+        return zip(values[:len(self.layers)], values[len(self.layers):])
+
+
+    def save(self, values=None):
+        if values is None:
+            values = [(layer.W.get_value(), layer.b.get_value())
+                      for layer in self.layers]
+        for i, (W, b) in enumerate(values):
+            numpy.save("W_%d.npy" % i, W)
+            numpy.save("b_%d.npy" % i, b)
 
 
     def load(self):
@@ -1003,8 +1262,28 @@ class MLP(object):
             layer.reset()
 
 
+def masked_mean(x, mask):
+    """
+    Mean over time of a (n_steps, batch_size, n_units) tensor, counting
+    only the steps where the (n_steps, batch_size) mask is 1.
+    """
+    length = mask.sum(0).dimshuffle(0, 'x')
+    return (x * mask.dimshuffle(0, 1, 'x')).sum(0) / length
+
+
 class RNN(object):
+    """
+    Elman RNN with sigmoid outputs at every step.
+    
+    `train`, `output` and `transform` work on one (n_steps, n_in) sequence.
+    `train_batch`, `output_batch` and `transform_batch` work on minibatches
+    of sequences: x is (n_steps, batch_size, n_in), left aligned and padded
+    with a (n_steps, batch_size) mask, and h0 the (batch_size, n_hiddens)
+    initial states (the shared `h0` for every sequence if None). `fit`
+    trains on minibatches of sequences of similar lengths.
+    """
     def __init__(self, n_in, n_hiddens, n_out, learning_rate):
+        self.n_hiddens = n_hiddens
         self.x = T.matrix()
         self.y = T.matrix()
         self.h0 = theano.shared(numpy.zeros(n_hiddens,
@@ -1026,6 +1305,8 @@ class RNN(object):
         self.c = theano.shared(numpy.zeros((n_out,),
             dtype=theano.config.floatX), name = 'c')
         self.params = [self.W, self.U, self.V, self.b, self.c]
+        self.learning_rate = theano.shared(numpy.asarray(learning_rate,
+            dtype=theano.config.floatX))
         
         def step(x_t, h_tm1, W, U, V, b, c):
             h_t = T.tanh(T.dot(x_t, W) + T.dot(h_tm1, U) + b)
@@ -1039,18 +1320,138 @@ class RNN(object):
                                     self.c])
         cost = -(self.y*T.log(output) + (1.-self.y)*T.log(1.-output)).sum(1).mean()
         
+        self.train = theano.function([self.x, self.y], outputs=cost,
+            updates=self._updates(cost))
+        self.output = theano.function([self.x], outputs=T.argmax(output.mean(0)))    
+        self.transform = theano.function([self.x], outputs=h.mean(0))
+        
+        # minibatches of sequences
+        x = T.tensor3('x')
+        y = T.tensor3('y')
+        mask = T.matrix('mask')
+        h0 = T.matrix('h0')
+        
+        h, output = self._masked_scan(x, mask, h0)
+        steps = -(y*T.log(output) + (1.-y)*T.log(1.-output)).sum(2)
+        cost = (steps * mask).sum() / mask.sum()
+        
+        self._train_batch = theano.function([x, mask, h0, y], outputs=cost,
+            updates=self._updates(cost))
+        self._output_batch = theano.function([x, mask, h0],
+            outputs=T.argmax(masked_mean(output, mask), axis=1))
+        self._transform_batch = theano.function([x, mask, h0],
+            outputs=masked_mean(h, mask))
+
+    def _updates(self, cost):
         gparams = T.grad(cost, self.params)
-        self.learning_rate = theano.shared(numpy.asarray(learning_rate,
-            dtype=theano.config.floatX))
         
         updates = []
         for param, gparam in zip(self.params, gparams):
             updates.append((param, param
                 - self.learning_rate * T.maximum(-15, T.minimum(gparam, 15.))))
-        self.train = theano.function([self.x, self.y], outputs=cost,
-            updates=updates)
-        self.output = theano.function([self.x], outputs=T.argmax(output.mean(0)))    
-        self.transform = theano.function([self.x], outputs=h.mean(0))
+        return updates
+
+    def _masked_scan(self, x, mask, h0):
+        """
+        Hidden states and outputs of a (n_steps, batch_size, n_in)
+        minibatch, both (n_steps, batch_size, n_units).
+        """
+        def step(x_t, m_t, h_tm1, W, U, V, b, c):
+            h_t = T.tanh(T.dot(x_t, W) + T.dot(h_tm1, U) + b)
+            y_t = T.nnet.sigmoid(T.dot(h_t, V) + c)
+            # the padding at the end of a clip does not change its state
+            m_t = m_t.dimshuffle(0, 'x')
+            h_t = m_t * h_t + (1. - m_t) * h_tm1
+            return h_t, y_t
+
+        [h, output], _ = theano.scan(step,
+                                sequences=[x, mask],
+                                outputs_info=[h0, None],
+                                non_sequences=[self.W, self.U, self.V,
+                                    self.b, self.c])
+        return h, output
+
+    def _initial_states(self, x, h0):
+        if h0 is None:
+            return numpy.tile(self.h0.get_value(), (x.shape[1], 1))
+        return numpy.asarray(h0, dtype=theano.config.floatX)
+
+    def train_batch(self, x, mask, y, h0=None):
+        return self._train_batch(x, mask, self._initial_states(x, h0), y)
+
+    def output_batch(self, x, mask, h0=None):
+        return self._output_batch(x, mask, self._initial_states(x, h0))
+
+    def transform_batch(self, x, mask, h0=None):
+        return self._transform_batch(x, mask, self._initial_states(x, h0))
+
+    def fit(self, sequences, targets, batch_size=32, epochs=1,
+            verbose=False):
+        """
+        Train on minibatches of `batch_size` sequences of similar lengths,
+        visited in a random order at every epoch.
+
+        Parameters
+        ----------
+        sequences: list of (n_steps, n_in) arrays
+        targets: list of (n_steps, n_out) arrays, the targets of every step
+        
+        Returns
+        -------
+        the mean cost of every epoch
+        """
+        batches = []
+        for indices in length_buckets(sequences, batch_size):
+            x, mask = pad_sequences([sequences[i] for i in indices],
+                                    theano.config.floatX)
+            y, _ = pad_sequences([targets[i] for i in indices],
+                                 theano.config.floatX)
+            batches.append((x, mask, y))
+        
+        costs = []
+        for epoch in range(epochs):
+            begin = time.time()
+            
+            order = numpy.random.permutation(len(batches))
+            cost = numpy.mean([self.train_batch(*batches[i]) for i in order])
+            costs.append(cost)
+            
+            if verbose:
+                print "Epoch %d, cost = %.4f, time = %.2f sec" % (
+                    epoch, cost, time.time() - begin)
+        return costs
+
+    def predict_clips(self, sequences, batch_size=64, cache_dir=None):
+        """
+        Run the model on whole clips by minibatches of clips of similar
+        lengths, instead of one `output`/`transform` call per clip.
+
+        Parameters
+        ----------
+        sequences: list of (n_steps, n_in) arrays
+        cache_dir: str
+            if given, the outputs are saved in this directory, keyed by the
+            parameter values and the clips, and loaded back instead of
+            being computed again
+
+        Returns
+        -------
+        (scores, features) in the order of `sequences`, the mean over the
+        clip of the outputs (whose argmax is `output`) and of the hidden
+        states (`transform`)
+        """
+        if not hasattr(self, '_predict_clips'):
+            x = T.tensor3()
+            mask = T.matrix()
+            h0 = T.alloc(self.h0, x.shape[1], self.n_hiddens)
+            h, output = self._masked_scan(x, mask, h0)
+            self._predict_clips = theano.function([x, mask],
+                outputs=[masked_mean(output, mask), masked_mean(h, mask)])
+        params = [param.get_value(borrow=True)
+                  for param in self.params + [self.h0]]
+        return predict_in_batches(self._predict_clips, sequences, batch_size,
+                                  params=params, cache_dir=cache_dir,
+                                  dtype=theano.config.floatX)
     
     def save(self):
         numpy.save("W.npy", self.W.get_value())
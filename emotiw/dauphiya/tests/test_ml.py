@@ -0,0 +1,162 @@
+import numpy
+import theano
+from emotiw.common.utils.sequences import pad_sequences
+from emotiw.dauphiya import ml
+
+def test_mlp_snapshot():
+    rng = numpy.random.RandomState(0)
+    model = ml.MLP(n_in=4, layers=[('L', 5), ('S', 3)])
+    x = numpy.asarray(rng.randn(10, 4), theano.config.floatX)
+    offsets = [0, 3, 4, 10]
+    before = model.output(x, offsets=offsets)
+
+    values = model.snapshot()
+    assert len(values) == len(model.layers)
+    for (W, b), layer in zip(values, model.layers):
+        numpy.testing.assert_array_equal(W, layer.W.get_value())
+        numpy.testing.assert_array_equal(b, layer.b.get_value())
+    numpy.testing.assert_array_equal(
+            model.output(x, offsets=offsets, snapshot=True), before)
+
+    # the snapshot is not changed by updates of the parameters
+    for layer in model.layers:
+        layer.W.set_value(numpy.asarray(rng.randn(*layer.W.get_value().shape),
+                                        theano.config.floatX))
+    numpy.testing.assert_array_equal(
+            model.output(x, offsets=offsets, snapshot=True), before)
+    for (W, b), layer in zip(values, model.layers):
+        assert not numpy.all(W == layer.W.get_value())
+
+    model.snapshot()
+    numpy.testing.assert_array_equal(
+            model.output(x, offsets=offsets, snapshot=True),
+            model.output(x, offsets=offsets))
+
+floatX = theano.config.floatX
+
+def gaussian_rbm(seed, n_visibles=4, n_hiddens=3):
+    rng = numpy.random.RandomState(seed)
+    rbm = ml.GaussianRBM(n_hiddens=n_hiddens, epsilon=0.05 * (seed + 1),
+                         n_samples=5)
+    rbm.W = numpy.asarray(0.1 * rng.randn(n_visibles, n_hiddens), floatX)
+    rbm.b = numpy.asarray(rng.randn(n_visibles), floatX)
+    rbm.c = numpy.asarray(rng.randn(n_hiddens), floatX)
+    rbm.h_samples.set_value(numpy.asarray(rng.rand(5, n_hiddens) > .5,
+                                          floatX))
+    return rbm
+
+def rbm_results(rbms, x):
+    # the parameter updates of GaussianRBM._fit do not depend on the
+    # random samples, only the next h_samples do
+    results = [[rbm.mean_h(x), rbm.free_energy(x)] for rbm in rbms]
+    for rbm, values in zip(rbms, results):
+        values += [rbm._fit(x), rbm.W, rbm.b, rbm.c]
+    return results
+
+def test_rbm_shared_functions():
+    x = numpy.asarray(numpy.random.RandomState(2).randn(5, 4), floatX)
+
+    unshared = []
+    for seed in [0, 1]:
+        ml.clear_compiled()
+        unshared += rbm_results([gaussian_rbm(seed)], x)
+
+    ml.clear_compiled()
+    count = ml.compile_stats['count']
+    rbms = [gaussian_rbm(0), gaussian_rbm(1)]
+    shared = rbm_results(rbms, x)
+    # mean_h, free_energy and _fit, compiled once for both
+    assert ml.compile_stats['count'] - count == 3
+
+    for shared_values, unshared_values in zip(shared, unshared):
+        for a, b in zip(shared_values, unshared_values):
+            numpy.testing.assert_array_almost_equal(a, b)
+
+    # the values are given back when the shared function fails
+    values = [(rbm.W, rbm.b, rbm.c) for rbm in rbms]
+    try:
+        rbms[1].mean_h(numpy.zeros((2, 7), floatX))
+    except Exception:
+        pass
+    else:
+        assert False, "mean_h accepted 7 visibles instead of 4"
+    for rbm, rbm_values in zip(rbms, values):
+        for a, b in zip(rbm_values, (rbm.W, rbm.b, rbm.c)):
+            numpy.testing.assert_array_equal(a, b)
+    ml.clear_compiled()
+
+def test_rbm_pseudo_likelihood_widths():
+    # RBMs of different numbers of visibles share the pseudo-likelihood
+    # bit index
+    ml.clear_compiled()
+    rng = numpy.random.RandomState(3)
+    for n_visibles in [6, 3]:
+        rbm = ml.BinaryRBM(n_hiddens=2, n_samples=4, epochs=2)
+        x = numpy.asarray(rng.rand(8, n_visibles) > .5, floatX)
+        rbm.fit(x)
+        for _ in range(n_visibles + 1):
+            assert numpy.isfinite(rbm._fit(x[:4]))
+    ml.clear_compiled()
+
+def test_mlp_segment_pooling():
+    rng = numpy.random.RandomState(4)
+    model = ml.MLP(n_in=4, layers=[('R', 6), ('S', 3)])
+    x = numpy.asarray(rng.randn(12, 4), floatX)
+    offsets = [0, 2, 3, 7, 12]
+    clips = [x[begin:end] for begin, end in zip(offsets[:-1], offsets[1:])]
+
+    numpy.testing.assert_array_equal(model.output(x, offsets=offsets),
+        numpy.concatenate([model.output(clip) for clip in clips]))
+    numpy.testing.assert_array_almost_equal(model.transform(x, offsets),
+        numpy.array([model.transform(clip) for clip in clips]))
+
+    # the pooled hidden units are the max over the frames of every clip
+    hidden = theano.function([model.layers[0].input],
+                             model.clean_layers[0].output)(x)
+    numpy.testing.assert_array_almost_equal(model.transform(x, offsets),
+        numpy.array([hidden[begin:end].max(axis=0)
+                     for begin, end in zip(offsets[:-1], offsets[1:])]))
+
+    y = numpy.array([0, 2, 1, 1], dtype='int64')
+    assert numpy.isfinite(model.train(x, y, offsets))
+
+def rnn_sequences(rng, lengths, n_in=3, n_out=2):
+    sequences = [numpy.asarray(rng.randn(n, n_in), floatX) for n in lengths]
+    targets = [numpy.asarray(rng.rand(n, n_out) > .5, floatX)
+               for n in lengths]
+    return sequences, targets
+
+def test_rnn_batches():
+    numpy.random.seed(5)
+    rng = numpy.random.RandomState(5)
+    model = ml.RNN(n_in=3, n_hiddens=4, n_out=2, learning_rate=0.1)
+    lengths = [5, 3, 1]
+    sequences, targets = rnn_sequences(rng, lengths)
+    x, mask = pad_sequences(sequences, floatX)
+    y, _ = pad_sequences(targets, floatX)
+
+    numpy.testing.assert_array_equal(model.output_batch(x, mask),
+        [model.output(seq) for seq in sequences])
+    numpy.testing.assert_array_almost_equal(model.transform_batch(x, mask),
+        numpy.array([model.transform(seq) for seq in sequences]))
+
+    # without updates, the cost is the mean over the steps of all the
+    # sequences and does not depend on the padding
+    model.learning_rate.set_value(numpy.asarray(0, dtype=floatX))
+    cost = model.train_batch(x, mask, y)
+    costs = [model.train(seq, t) for seq, t in zip(sequences, targets)]
+    numpy.testing.assert_approx_equal(cost,
+        numpy.dot(costs, lengths) / float(sum(lengths)), significant=5)
+
+    padding = (1 - mask)[:, :, None]
+    x_noise = x + padding * numpy.asarray(rng.randn(*x.shape), floatX)
+    y_noise = y + padding * numpy.asarray(rng.rand(*y.shape) > .5, floatX)
+    numpy.testing.assert_approx_equal(model.train_batch(x_noise, mask,
+                                                        y_noise), cost)
+    numpy.testing.assert_array_almost_equal(
+        model.transform_batch(x_noise, mask), model.transform_batch(x, mask))
+
+    model.learning_rate.set_value(numpy.asarray(0.1, dtype=floatX))
+    costs = model.fit(sequences, targets, batch_size=2, epochs=3)
+    assert len(costs) == 3
+    assert numpy.all(numpy.isfinite(costs))
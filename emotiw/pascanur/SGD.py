@@ -7,6 +7,8 @@ from theano.sandbox.scan import scan
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 from utils import safe_clone, print_time, print_mem, const
+from metrics import Metrics
+from parallel import ReplicaPool
 
 
 class SGD(object):
@@ -49,20 +51,30 @@ class SGD(object):
                                batchsize = self.state['bs'])
         self.data_iter = data.__iter__()
         self.step_timer = time.time()
+        # replaced by the one of MainLoop, which writes it to disk
+        self.metrics = Metrics()
 
         ############################################################
         # Step 1. Compile function for computing eucledian gradients
         ############################################################
+        # The grad function also returns the cost and error before the
+        # update, so that the forward pass on the minibatch is done once.
+        # The cost at the trial step `params - lr * grads` is only needed
+        # to adapt the learning rate (halved when the cost increases); it
+        # is evaluated every `trialFreq` steps, never if it is 0.
+        self.trial_freq = state.get('trialFreq', 1)
         print 'Constructing grad function'
         gs = TT.grad(self.model.train_cost, model.params)
         update = [(g, lg) for g, lg in zip(self.gs, gs)]
+        norm_grads = TT.sqrt(sum(TT.sum(x ** 2) for x in gs))
         print 'Compiling grad function'
         st = time.time()
         self.grad_fn = theano.function(
-            self.model.inputs, [], updates=update, name='loc_fn_grad', profile=profile)
+            self.model.inputs,
+            [self.model.train_cost, self.model.error, norm_grads],
+            updates=update, name='loc_fn_grad', profile=profile)
         print 'took', time.time() - st
 
-        norm_grads = TT.sqrt(sum(TT.sum(x ** 2) for x in self.gs))
         ###########################################################
         # Step 3. Compile function for evaluating cost and updating
         # parameters
@@ -70,27 +82,25 @@ class SGD(object):
         print 'constructing evaluation function'
         lr = TT.scalar('lr')
         self.lr = numpy.float32(state['lr'])
-        old_cost = model.train_cost
-        self.compute_old_cost = theano.function(
-            self.model.inputs, old_cost, name='loc_old_cost', profile=profile)
         new_params = [p - lr * r for p, r in zip(model.params, self.gs)]
-        new_cost = safe_clone(model.train_cost,
-                              model.params, new_params)
-        new_err = safe_clone(model.error,
-                             model.params, new_params)
-        self.compute_new_cost = theano.function(
-            [lr]+self.model.inputs, [new_cost, new_err], name='loc_new_cost',
-            profile=profile)
+        if self.trial_freq > 0:
+            new_cost = safe_clone(model.train_cost,
+                                  model.params, new_params)
+            new_err = safe_clone(model.error,
+                                 model.params, new_params)
+            self.compute_new_cost = theano.function(
+                [lr]+self.model.inputs, [new_cost, new_err], name='loc_new_cost',
+                profile=profile)
+            old_cost = TT.scalar('old_cost')
+            new_cost = TT.scalar('new_cost')
+            dist = -lr * sum([TT.sum(g * r) for g, r in zip(self.gs, self.gs)])
+            rho = (new_cost - old_cost) / dist
+            self.compute_rho = theano.function(
+                [old_cost, new_cost, lr], rho, name='compute_rho', profile=profile)
 
         self.update_params = theano.function(
             [lr], [], updates=zip(model.params, new_params),
             name='update_params')
-        old_cost = TT.scalar('old_cost')
-        new_cost = TT.scalar('new_cost')
-        dist = -lr * sum([TT.sum(g * r) for g, r in zip(self.gs, self.gs)])
-        rho = (new_cost - old_cost) / dist
-        self.compute_rho = theano.function(
-            [old_cost, new_cost, lr], [rho, norm_grads], name='compute_rho', profile=profile)
         self.old_cost = 1e20
         self.step = 0
         self.return_names = ['cost',
@@ -101,12 +111,85 @@ class SGD(object):
                              'rho',
                              'lr']
 
+        # With `n_workers` > 0 every minibatch is split along its batch
+        # axis over that many forked worker processes (CPU only), holding
+        # replicas of the compiled functions. The parameters are copied to
+        # the workers before every step and the gradients summed back.
+        # The pieces are smaller than `bs`, so this needs a model whose
+        # graph does not depend on the minibatch shape, e.g. a masked
+        # biRNN (the unmasked one has `bs` and `seqlen` compiled in).
+        self.pool = None
+        if state.get('n_workers', 0) > 0:
+            if not getattr(model, 'masked', False):
+                raise ValueError('n_workers > 0 needs a model accepting '
+                                 'minibatches of any shape (masked=True)')
+            self.pool = ReplicaPool(self, state['n_workers'],
+                                    model.params + self.gs, self.gs)
+
+    def split_batch(self, batch):
+        """
+        Split a minibatch of time-major sequences, e.g. (x, t) or
+        (x, mask, t), into one piece per worker along the batch axis.
+
+        Returns a list of (piece, weight) where weight is the fraction of
+        the examples in the piece, the costs being means over examples.
+        """
+        bs = len(batch[-1])
+        bounds = numpy.linspace(0, bs, self.pool.n_workers + 1).astype('int64')
+        rval = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end > start:
+                piece = [x[:, start:end] if x.ndim > 1 else x[start:end]
+                         for x in batch]
+                rval.append((piece, (end - start) / float(bs)))
+        return rval
+
+    def chunk_grads(self, chunks):
+        """
+        Worker side: weighted sum of the gradients of the pieces of the
+        minibatch, kept for `chunk_new_costs`
+        """
+        self.worker_chunks = chunks
+        grads = [numpy.zeros_like(g.get_value(borrow=True)) for g in self.gs]
+        rvals = []
+        for batch, weight in chunks:
+            cost, error, _ = self.grad_fn(*batch)
+            for acc, g in zip(grads, self.gs):
+                acc += weight * g.get_value(borrow=True)
+            rvals.append((weight * cost, weight * error))
+        for g, acc in zip(self.gs, grads):
+            g.set_value(acc, borrow=True)
+        return rvals
+
+    def chunk_new_costs(self, chunks, lr):
+        rvals = []
+        for batch, weight in self.worker_chunks:
+            cost, error = self.compute_new_cost(lr, *batch)
+            rvals.append((weight * cost, weight * error))
+        return rvals
 
     def __call__(self):
 
-        batch = self.data_iter.get_batch()
+        metrics = self.metrics
+        with metrics.timer('data'):
+            batch = self.data_iter.get_batch()
+        metrics.count('examples', len(batch[-1]))
+        if len(batch) == 3:
+            # (x, mask, t) batch of sequences of different lengths
+            metrics.count('frames', float(batch[1].sum()))
+        else:
+            metrics.count('frames', batch[0].shape[0] * batch[0].shape[1])
         g_st = time.time()
-        self.grad_fn(*batch)
+        with metrics.timer('grad'):
+            if self.pool is None:
+                old_cost, old_error, norm_grad = self.grad_fn(*batch)
+            else:
+                rvals = sum(self.pool.run('chunk_grads',
+                                          self.split_batch(batch),
+                                          reduce=True), [])
+                old_cost, old_error = numpy.sum(rvals, axis=0)
+                norm_grad = numpy.sqrt(sum(numpy.sum(g.get_value(borrow=True)**2)
+                                           for g in self.gs))
         g_ed = time.time()
         if self.state['lr_adapt'] == 1:
             if self.step > self.state['lr_adapt_start']:
@@ -114,26 +197,38 @@ class SGD(object):
                     (1. + float(self.step - self.state['lr_adapt_start'])/self.state['lr_beta'])
                 self.state['lr'] = float(self.lr)
         e_st = time.time()
-        old_cost = self.compute_old_cost(*batch)
-        new_cost, error = self.compute_new_cost(self.lr, *batch)
-        rho, norm_grad = self.compute_rho(old_cost, new_cost, self.lr)
+        if self.trial_freq > 0 and self.step % self.trial_freq == 0:
+            with metrics.timer('eval'):
+                if self.pool is None:
+                    new_cost, error = self.compute_new_cost(self.lr, *batch)
+                else:
+                    new_cost, error = numpy.sum(sum(self.pool.run(
+                        'chunk_new_costs', None, self.lr), []), axis=0)
+                rho = self.compute_rho(old_cost, new_cost, self.lr)
 
-        if new_cost > old_cost:
-            print ('Error increasing !? ')
-            self.lr = self.lr / 2.
+            if new_cost > old_cost:
+                print ('Error increasing !? ')
+                self.lr = self.lr / 2.
+        else:
+            # fast path, the reported cost and error are the ones of the
+            # minibatch before the update
+            new_cost, error = old_cost, old_error
+            rho = numpy.nan
 
         while (numpy.isnan(new_cost) or
                numpy.isinf(new_cost)):
             raise Exception('Got Inf/NaN !')
         self.old_cost = new_cost
-        self.update_params(self.lr)
+        with metrics.timer('update'):
+            self.update_params(self.lr)
         e_ed = time.time()
         msg = ('.. iter %4d cost %.3g (before update %.3g), error %.3g step_size %.3g '
                'rho %.3g '
                'norm grad %.3g '
                'time [grad] %s,'
                '[updates param] %s,'
-               'whole time %s'
+               'whole time %s, '
+               '%.1f examples/s'
               )
         print msg % (
             self.step,
@@ -145,7 +240,8 @@ class SGD(object):
             norm_grad,
             print_time(g_ed - g_st),
             print_time(e_ed - e_st),
-            print_time(time.time() - self.step_timer) )
+            print_time(time.time() - self.step_timer),
+            metrics.rate('examples'))
         self.step_timer = time.time()
         self.step += 1
 
@@ -19,6 +19,9 @@ import numpy
 import os
 import sys
 
+from emotiw.common.datasets.audio_store import AudioFeatureStore
+from emotiw.common.utils.sequences import pad_sequences
+
 classes = ['Angry',
            'Disgust',
            'Fear',
@@ -41,7 +44,9 @@ class ListSequences(object):
         sequences of different lengths.
         :param path: String
             Path to the dataset; If it points to a pickle file, just load
-            that pickle file
+            that pickle file. If it is an AudioFeatureStore directory,
+            sequences are read from its memory maps, otherwise from the
+            per clip pickles
         :param pca: Bool
             If we want the PCA version of the dataset or not
         :param subset: String
@@ -71,27 +76,38 @@ class ListSequences(object):
                 which = 'Train'
             else:
                 which = 'Val'
-            if pca:
-                suffix = '%s.pca.pkl' % subset
-            else:
-                suffix = '%s.pkl' % subset
-            audiofiles = glob.glob('%s/*/*/*.%s' % (path, suffix))
-
             data_x = []
             data_y = []
-            for audiofile in audiofiles:
-                data = cPickle.load(open(audiofile))
-                target = [(cls in audiofile) for cls in classes]
-
-                if not one_hot:
-                    target = numpy.argmax(target)
-                if which in audiofile:
-                    data_x.append(
-                            numpy.array(data,
-                                dtype='float%d'%nbits))
-                    data_y.append(
-                            numpy.array(target,
-                                dtype='int%d'%nbits))
+            if os.path.isfile(os.path.join(path, 'index.pkl')):
+                store = AudioFeatureStore(path)
+                for idx in store.select(which):
+                    target = [(cls == store.labels[idx]) for cls in classes]
+                    if not one_hot:
+                        target = numpy.argmax(target)
+                    data_x.append(numpy.asarray(store.get(idx, subset, pca),
+                                                dtype='float%d'%nbits))
+                    data_y.append(numpy.array(target,
+                                              dtype='int%d'%nbits))
+            else:
+                if pca:
+                    suffix = '%s.pca.pkl' % subset
+                else:
+                    suffix = '%s.pkl' % subset
+                audiofiles = glob.glob('%s/*/*/*.%s' % (path, suffix))
+
+                for audiofile in audiofiles:
+                    data = cPickle.load(open(audiofile))
+                    target = [(cls in audiofile) for cls in classes]
+
+                    if not one_hot:
+                        target = numpy.argmax(target)
+                    if which in audiofile:
+                        data_x.append(
+                                numpy.array(data,
+                                    dtype='float%d'%nbits))
+                        data_y.append(
+                                numpy.array(target,
+                                    dtype='int%d'%nbits))
             self.data_x = data_x
             self.data_y = data_y
         self.nbits = nbits
@@ -145,12 +161,21 @@ class ListSequences(object):
 
     def export_dense_format(self,
                             sequence_length= 10,
-                            overlap = 5):
+                            overlap = 5,
+                            windowed = True):
         """
         Clip sequences in subseuqnecs of fixed length
         `sequence_length`. Consecutive subsequences have an
         overlap of `overlap` steps,
+
+        :param windowed: Bool
+            If True, return a WindowedSequences that keeps all sequences in
+            a single buffer and only copies the windows of the current
+            minibatch. Otherwise every window is copied into a dense
+            3D tensor.
         """
+        if windowed:
+            return self.export_windowed_format(sequence_length, overlap)
         final_data_x = []
         final_data_y = []
         for sample_x, sample_y in zip(self.data_x, self.data_y):
@@ -171,6 +196,50 @@ class ListSequences(object):
                 data=(final_data_x, final_data_y),
                 nbits=self.nbits)
 
+    def export_bucketed_format(self,
+                               max_waste = .2,
+                               max_batchsize = 32):
+        """
+        Minibatches of whole sequences of similar lengths, see
+        BucketedSequences.
+        """
+        return BucketedSequences(
+                data=(self.data_x, self.data_y),
+                max_waste=max_waste,
+                max_batchsize=max_batchsize,
+                nbits=self.nbits)
+
+    def export_windowed_format(self,
+                               sequence_length = 10,
+                               overlap = 5):
+        """
+        Same windows as `export_dense_format`, described by the position
+        of their first step in the concatenation of all sequences. The
+        windows are permuted the same way.
+        """
+        buffer_x = numpy.concatenate(
+            [numpy.asarray(x, dtype='float%d'%self.nbits)
+             for x in self.data_x])
+        starts = []
+        final_data_y = []
+        offset = 0
+        for sample_x, sample_y in zip(self.data_x, self.data_y):
+            n_steps = sample_x.shape[0]
+            ks = numpy.arange(0, max(n_steps-sequence_length, 0),
+                              sequence_length-overlap)
+            starts.append(offset + ks)
+            final_data_y.extend([sample_y] * len(ks))
+            offset += n_steps
+
+        starts = numpy.concatenate(starts).astype('int64')
+        final_data_y = numpy.array(final_data_y,
+                dtype='int%d'%self.nbits)
+        perm = self.rng.permutation(starts.shape[0])
+        return WindowedSequences(
+                data=(buffer_x, starts[perm], final_data_y[perm]),
+                sequence_length=sequence_length,
+                nbits=self.nbits)
+
 
 class DenseSequences(object):
     def __init__(self, path=None, data =None, nbits = 32):
@@ -234,15 +303,191 @@ class DenseSequences(object):
             index = self.index
         start = index * self.batchsize + self.offset
         end = (index + 1) * self.batchsize + self.offset
-        if end >= self.data_x.shape[1]:
+        if end >= self.n_examples:
             import ipdb; ipdb.set_trace()
-        return self.data_x[:,start:end], self.data_y[start:end]
+        return self.slice(start, end)
 
+    def slice(self, start, end):
+        return self.data_x[:,start:end], self.data_y[start:end]
 
     def save(self, filename):
         numpy.savez(filename, x = self.data_x, y = self.data_y)
 
 
+class WindowedSequences(DenseSequences):
+    def __init__(self, path=None, data=None, sequence_length=None,
+                 nbits=32):
+        """
+        Fixed length windows over a single (n_steps, nfeatures) buffer
+        holding all the sequences one after the other. A window is the
+        position of its first step in the buffer; the windows of a
+        minibatch are gathered from a strided view of the buffer, so
+        overlapping windows are never copied in advance.
+
+        :param data: tuple
+            (buffer, starts, targets)
+        :param sequence_length: int
+            Length of the windows
+        """
+        assert (path is None) or (data is None)
+        assert nbits in (32, 64)
+        if path is not None:
+            data = numpy.load(path)
+            sequence_length = int(data['sequence_length'])
+            data = (data['x'], data['starts'], data['y'])
+        assert sequence_length is not None
+        self.data_x = numpy.ascontiguousarray(data[0])
+        self.starts = data[1]
+        self.data_y = data[2]
+        self.sequence_length = sequence_length
+        self.nbits = nbits
+        self.n_examples = self.starts.shape[0]
+        # windows[i] is the (sequence_length, nfeatures) window starting
+        # at step i of the buffer, without any copy
+        n_steps, nfeatures = self.data_x.shape
+        step_stride, feat_stride = self.data_x.strides
+        self.windows = numpy.lib.stride_tricks.as_strided(
+            self.data_x,
+            shape=(max(n_steps - sequence_length + 1, 0),
+                   sequence_length, nfeatures),
+            strides=(step_stride, step_stride, feat_stride))
+        self.__iterator_set__ = False
+
+    def slice(self, start, end):
+        # (batch, time, nfeatures) -> (time, batch, nfeatures)
+        batch_x = self.windows[self.starts[start:end]].transpose(1, 0, 2)
+        return batch_x, self.data_y[start:end]
+
+    def save(self, filename):
+        numpy.savez(filename, x = self.data_x, starts = self.starts,
+                    y = self.data_y,
+                    sequence_length = self.sequence_length)
+
+
+
+class BucketedSequences(object):
+    def __init__(self, data, max_waste = .2, max_batchsize = 32,
+                 nbits = 32):
+        """
+        Minibatches of whole sequences. Sequences are sorted by length and
+        grouped greedily, so that each minibatch holds sequences of similar
+        lengths, padded with zeros to the longest one.
+
+        Each batch is (x, mask, y) where x is a (time, batch-size,
+        nfeatures) tensor, mask a (time, batch-size) matrix which is 1 for
+        the steps of a sequence and 0 for the padding, and y the targets.
+
+        :param data: tuple
+            (list of (n_steps, nfeatures) sequences, list of targets)
+        :param max_waste: float
+            Largest fraction of padded steps in a minibatch. A sequence is
+            put in a new minibatch rather than exceeding it. 0 only groups
+            sequences of exactly the same length.
+        :param max_batchsize: int
+            Largest number of sequences in a minibatch
+        """
+        assert nbits in (32, 64)
+        assert 0 <= max_waste < 1
+        self.data_x = data[0]
+        self.data_y = data[1]
+        self.nbits = nbits
+        self.max_waste = max_waste
+        self.max_batchsize = max_batchsize
+        self.lengths = numpy.array([x.shape[0] for x in self.data_x])
+        self.n_examples = len(self.data_x)
+        self.__iterator_set__ = False
+
+    def make_batches(self, rng=None):
+        """
+        Group the sequences in minibatches; if rng is given, sequences of
+        the same length are grouped in a random order.
+
+        Returns a list of arrays of sequence indices.
+        """
+        if rng is None:
+            order = numpy.argsort(self.lengths, kind='mergesort')
+        else:
+            perm = rng.permutation(self.n_examples)
+            order = perm[numpy.argsort(self.lengths[perm], kind='mergesort')]
+
+        batches = []
+        batch = []
+        n_steps = 0
+        for idx in order:
+            length = self.lengths[idx]
+            # sequences are sorted, the new one is the longest
+            waste = 1. - (n_steps + length) / float(length * (len(batch) + 1))
+            if batch and (len(batch) == self.max_batchsize or
+                          waste > self.max_waste):
+                batches.append(numpy.array(batch))
+                batch = []
+                n_steps = 0
+            batch.append(idx)
+            n_steps += length
+        if batch:
+            batches.append(numpy.array(batch))
+        return batches
+
+    def set_iterator(self,
+            order = 'rand',
+            rng = None,
+            batchsize = None):
+        if batchsize is not None:
+            self.max_batchsize = batchsize
+        self.order = order
+        if rng is None:
+            rng = numpy.random.RandomState([123,43,53])
+        self.rng = rng
+        self.index = -1
+        self.new_epoch()
+        self.__iterator_set__ = True
+
+    def new_epoch(self):
+        if self.order == 'rand':
+            self.batches = self.make_batches(self.rng)
+            self.perm = self.rng.permutation(len(self.batches))
+        else:
+            self.batches = self.make_batches()
+            self.perm = numpy.arange(len(self.batches))
+        self.n_batches = len(self.batches)
+
+    def __iter__(self):
+        if not self.__iterator_set__:
+            self.set_iterator()
+        return self
+
+    def next(self):
+        if self.index == self.n_batches - 1:
+            self.index = -1
+            raise StopIteration
+        return self.get_batch()
+
+    def get_batch(self):
+        if not self.__iterator_set__:
+            self.set_iterator()
+        self.index += 1
+        if self.index >= self.n_batches:
+            self.new_epoch()
+            self.index = 0
+        return self.pad(self.batches[self.perm[self.index]])
+
+    def pad(self, indices):
+        """
+        Build the (x, mask, y) minibatch of the given sequences
+        """
+        x, mask = pad_sequences([self.data_x[idx] for idx in indices],
+                                dtype='float%d'%self.nbits)
+        y = numpy.array([self.data_y[idx] for idx in indices],
+                        dtype='int%d'%self.nbits)
+        return x, mask, y
+
+    def waste(self):
+        """
+        Fraction of padded steps over all the minibatches
+        """
+        batches = self.make_batches()
+        padded = sum(len(b) * self.lengths[b].max() for b in batches)
+        return 1. - self.lengths.sum() / float(padded)
 
 
 if __name__=='__main__':
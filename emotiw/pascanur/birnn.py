@@ -14,6 +14,7 @@ import theano.tensor as TT
 # certain shortcommings of scan
 from theano.sandbox.scan import scan
 from utils import safe_clone
+from emotiw.common.utils.sequences import predict_in_batches
 
 class biRNN(object):
     def __init__(self,
@@ -23,9 +24,14 @@ class biRNN(object):
                  activ = TT.nnet.sigmoid,
                  seed = 234,
                  bs = 16, # batchsize
-                 seqlen = 3 # sequence length - fixed during training
+                 seqlen = 3, # sequence length - fixed during training
+                 masked = False # variable batchsize and length, with a mask
                 ):
         # 0. Keep track of arguments
+        # If `masked` is True, `bs` and `seqlen` are ignored: minibatches
+        # can have any size and length (e.g. from BucketedSequences) and a
+        # (time, batch-size) mask marks the steps of each sequence, which
+        # are expected to be left aligned.
         self.bs = bs
         self.nhids = nhids
         self.nouts = nouts
@@ -34,6 +40,7 @@ class biRNN(object):
         self.seed = seed
         self.bs = bs
         self.seqlen = seqlen
+        self.masked = masked
         floatX = theano.config.floatX
         self.rng = numpy.random.RandomState(seed)
 
@@ -45,7 +52,14 @@ class biRNN(object):
         # We store data as 1D tensor where each the dimension goes over the
         # batch size (i.e. target of each sequence in the batch)
         self.t = TT.ivector('t') # target index for each element of batchsize
-        self.inputs = [self.x, self.t]
+        if masked:
+            # 1 for the steps of a sequence, 0 for the padding
+            self.mask = TT.matrix('mask')
+            self.inputs = [self.x, self.mask, self.t]
+            seqlen = self.x.shape[0]
+            bs = self.x.shape[1]
+        else:
+            self.inputs = [self.x, self.t]
         # Naming convention for letters after the `_`:
         # u - input
         # h - hidden
@@ -106,67 +120,66 @@ class biRNN(object):
                              self.params]
 
         # 2. Constructing Theano graph
-        # Note: new interface of scan asks the user to provide a memory
-        # buffer that contains the initial state but which is also used
-        # internally by scan to store the intermediate values of its
-        # computations - hence the initial state is a 3D tensor
-        h0_f = TT.alloc(numpy.array(0,dtype=floatX), self.seqlen+1, self.bs,
-                              self.nhids)
-        h0_b = TT.alloc(numpy.array(0, dtype=floatX), self.seqlen+1, self.bs,
-                               self.nhids)
-
-        # Do we use to much memory!?
-        p_hf = TT.dot(self.x.reshape((self.seqlen*self.bs, self.nins)), self.W_uhf) + self.b_hhf
-        p_hb = TT.dot(self.x[::-1].reshape((self.seqlen*self.bs, self.nins)), self.W_uhb) + self.b_hhb
-
-        def recurrent_fn(pf_t, pb_t, hf_tm1, hb_tm1):
-            hf_t = activ(TT.dot(hf_tm1, self.W_hhf) + pf_t)
-            hb_t = activ(TT.dot(hb_tm1, self.W_hhb) + pb_t)
-            return hf_t, hb_t
-        # provide sequence length !? is better on GPU
-        [h_f, h_b], _ = scan(
-            recurrent_fn,
-            sequences = [
-                p_hf.reshape((self.seqlen, self.bs, self.nhids)),
-                p_hb.reshape((self.seqlen, self.bs, self.nhids))],
-            states = [h0_f, h0_b],
-            n_steps = self.seqlen,
-            name = 'bi-RNN',
-            profile = 0)
-        h_b = h_b[::-1]
-        # Optionally do the max over hidden layer !?
-        # I'm afraid the semantics for RNN are somewhat different than MLP
-        y = TT.nnet.softmax(
-            TT.dot(h_f.reshape((self.seqlen * self.bs+self.bs, self.nhids)), self.W_hyf) + # Check doc flatten
-            TT.dot(h_b.reshape((self.seqlen * self.bs+self.bs, self.nhids)), self.W_hyb) +
-            self.b_hy)
-        my = y.reshape((self.seqlen+1, self.bs, self.nouts)).max(axis=0)
+        if masked:
+            h_f, h_b, y, y3 = self.fprop(self.x, self.mask)
+        else:
+            h_f, h_b, y, y3 = self.fprop(self.x, None, seqlen, bs)
+        my = y3.max(axis=0)
         nll = -TT.log(
-            my[TT.constant(numpy.arange(self.bs)), self.t])
+            my[TT.arange(bs), self.t])
         self.train_cost = nll.mean()
         self.error = TT.mean(TT.neq(my.argmax(axis=1), self.t) * 100.)
         ## |-----------------------------
+        # Forward activations the metric products depend on. They only
+        # change with the parameters, so natSGD (`cache_metric`) computes
+        # them once per step and passes the cached values, in this order,
+        # as the `activations` keyword of `Gyvs`, `Ghfvs` and `Ghbvs`.
+        # They replace the nodes reading y, h_f and h_b (softmax, output
+        # layer, metric scaling); TT.Rop through the scan still recomputes
+        # the hidden states.
+        self.metric_activations = [y, h_f, h_b]
+        def with_activations(Gv):
+            def Gvs(*args, **kwargs):
+                rval = Gv(*args)
+                activations = kwargs.get('activations', None)
+                if activations is not None:
+                    rval = theano.clone(rval, replace=zip(
+                        self.metric_activations, activations))
+                return rval
+            return Gvs
+        # With a mask the padded steps are left out of the metric, like
+        # they are left out of the cost, by masking the activations whose
+        # Jacobian is taken (the outputs k <= length of every sequence).
+        if masked:
+            out_mask = TT.concatenate([TT.ones_like(self.mask[:1]),
+                                       self.mask])
+            y_m = y * out_mask.flatten().dimshuffle(0, 'x')
+            h_fm = h_f * out_mask.dimshuffle(0, 1, 'x')
+            h_bm = h_b * out_mask.dimshuffle(0, 1, 'x')
+        else:
+            y_m, h_fm, h_bm = y, h_f, h_b
         # - Computing metric times a vector efficiently for p(y|x)
         # Assume softmax .. we might want sigmoids though
-        self.Gyvs = lambda *args:\
-            TT.Lop(y, self.params,
-                   TT.Rop(y, self.params, args) /\
-                   (y*numpy.array(self.bs, dtype=floatX)))
+        self.Gyvs = with_activations(lambda *args:\
+            TT.Lop(y_m, self.params,
+                   TT.Rop(y_m, self.params, args) /\
+                   (y*TT.cast(bs, floatX))))
         # Computing metric times a vector effciently for p(h|x)
         if activ == TT.nnet.sigmoid:
-            fn = lambda x : (1-x)*x*numpy.array(self.bs, dtype=floatX)
+            fn = lambda x : (1-x)*x*TT.cast(bs, floatX)
         elif activ == TT.tanh:
             # Please check formula !!!! It is probably wrong
-            fn = lambda x:(.5-x/2)*(x/2+.5)*numpy.array(self.bs,
-                                                        dtype=floatX)
+            fn = lambda x:(.5-x/2)*(x/2+.5)*TT.cast(bs, floatX)
         else: # Assume linear or piece-wise linear activation
-            fn = lambda x: numpy,array(self.bs, dtype=floatX)
-        self.Ghfvs = lambda *args:\
-                TT.Lop(h_f, self.params,
-                       TT.Rop(h_f, self.params, args) / fn(h_f))
-        self.Ghbvs = lambda *args:\
-                TT.Lop(h_b, self.params,
-                       TT.Rop(h_b, self.params, args) / fn(h_b))
+            fn = lambda x: TT.cast(bs, floatX)
+        self.Ghfvs = with_activations(lambda *args:\
+                TT.Lop(h_fm, self.params,
+                       TT.Rop(h_fm, self.params, args) / fn(h_f)))
+        self.Ghbvs = with_activations(lambda *args:\
+                TT.Lop(h_bm, self.params,
+                       TT.Rop(h_bm, self.params, args) / fn(h_b)))
+        # metric used by natSGD
+        self.Gvs = self.Gyvs
         ## ------------------ |
 
         vx = TT.matrix('vx')
@@ -201,18 +214,158 @@ class biRNN(object):
         self.validate = theano.function([vx, vt], my,
                                         name='validation',
                                         profile=0)
+        # kept to compile `validate_snapshot` on the first snapshot
+        self._validation_graph = ([vx, vt], my)
+
+
+
+    def fprop(self, x, mask=None, seqlen=None, bs=None):
+        """
+        Graph of the model for a (time, batch-size, nins) tensor `x`, with
+        an optional (time, batch-size) `mask` for left aligned sequences
+        of different lengths (see `masked` in the constructor).
+
+        Returns the forward and backward hidden states, each of shape
+        (seqlen+1, bs, nhids), the flattened softmax outputs and the same
+        outputs as a (seqlen+1, bs, nouts) tensor where the outputs of
+        the padding are 0.
+        """
+        floatX = theano.config.floatX
+        if seqlen is None:
+            seqlen = x.shape[0]
+        if bs is None:
+            bs = x.shape[1]
+        # Note: new interface of scan asks the user to provide a memory
+        # buffer that contains the initial state but which is also used
+        # internally by scan to store the intermediate values of its
+        # computations - hence the initial state is a 3D tensor
+        h0_f = TT.alloc(numpy.array(0,dtype=floatX), seqlen+1, bs,
+                              self.nhids)
+        h0_b = TT.alloc(numpy.array(0, dtype=floatX), seqlen+1, bs,
+                               self.nhids)
+
+        # Do we use to much memory!?
+        p_hf = TT.dot(x.reshape((seqlen*bs, self.nins)), self.W_uhf) + self.b_hhf
+        p_hb = TT.dot(x[::-1].reshape((seqlen*bs, self.nins)), self.W_uhb) + self.b_hhb
 
+        def recurrent_fn(pf_t, pb_t, hf_tm1, hb_tm1):
+            hf_t = self.activ(TT.dot(hf_tm1, self.W_hhf) + pf_t)
+            hb_t = self.activ(TT.dot(hb_tm1, self.W_hhb) + pb_t)
+            return hf_t, hb_t
 
+        def masked_recurrent_fn(pf_t, pb_t, mf_t, mb_t, hf_tm1, hb_tm1):
+            # padded steps keep the previous state; for the backward
+            # direction the padding comes first, so the state stays at 0
+            # until the true end of the sequence
+            hf_t, hb_t = recurrent_fn(pf_t, pb_t, hf_tm1, hb_tm1)
+            mf_t = mf_t.dimshuffle(0, 'x')
+            mb_t = mb_t.dimshuffle(0, 'x')
+            hf_t = mf_t * hf_t + (1 - mf_t) * hf_tm1
+            hb_t = mb_t * hb_t + (1 - mb_t) * hb_tm1
+            return hf_t, hb_t
 
-    def save(self, filename):
+        sequences = [
+            p_hf.reshape((seqlen, bs, self.nhids)),
+            p_hb.reshape((seqlen, bs, self.nhids))]
+        if mask is not None:
+            sequences += [mask, mask[::-1]]
+            step_fn = masked_recurrent_fn
+        else:
+            step_fn = recurrent_fn
+        # provide sequence length !? is better on GPU
+        [h_f, h_b], _ = scan(
+            step_fn,
+            sequences = sequences,
+            states = [h0_f, h0_b],
+            n_steps = seqlen,
+            name = 'bi-RNN',
+            profile = 0)
+        h_b = h_b[::-1]
+        # Optionally do the max over hidden layer !?
+        # I'm afraid the semantics for RNN are somewhat different than MLP
+        y = TT.nnet.softmax(
+            TT.dot(h_f.reshape((seqlen * bs+bs, self.nhids)), self.W_hyf) + # Check doc flatten
+            TT.dot(h_b.reshape((seqlen * bs+bs, self.nhids)), self.W_hyb) +
+            self.b_hy)
+        y3 = y.reshape((seqlen+1, bs, self.nouts))
+        if mask is not None:
+            # output k combines the forward state after k steps and the
+            # backward state starting at step k, it is valid for k up to
+            # the length of the sequence. Probabilities are positive, so
+            # zeroing the padding removes it from the max.
+            out_mask = TT.concatenate([TT.ones_like(mask[:1]), mask])
+            y3 = y3 * out_mask.dimshuffle(0, 1, 'x')
+        return h_f, h_b, y, y3
+
+    def predict_clips(self, sequences, batch_size=64, cache_dir=None):
+        """
+        Run the model on whole clips, by minibatches of clips of similar
+        lengths.
+
+        :param sequences: list of (n_steps, nins) arrays
+        :param cache_dir: String
+            If given, the outputs are saved in this directory, keyed by the
+            parameter values and the clips, and loaded back instead of
+            being computed again
+        :rval: (probs, features) in the order of `sequences`. probs are
+            the max-pooled class probabilities of the training cost,
+            normalized to sum to 1, and features the mean of the
+            concatenated forward and backward hidden states over the clip
+        """
+        if not hasattr(self, '_predict_fn'):
+            x = TT.tensor3('x')
+            mask = TT.matrix('mask')
+            h_f, h_b, y, y3 = self.fprop(x, mask)
+            probs = y3.max(axis=0)
+            probs = probs / probs.sum(axis=1).dimshuffle(0, 'x')
+            out_mask = TT.concatenate([TT.ones_like(mask[:1]), mask])
+            out_mask = out_mask.dimshuffle(0, 1, 'x')
+            h = TT.concatenate([h_f, h_b], axis=2)
+            features = (h * out_mask).sum(axis=0) / out_mask.sum(axis=0)
+            self._predict_fn = theano.function([x, mask], [probs, features],
+                                               name='predict_clips',
+                                               profile=0)
+        params = [x.get_value(borrow=True) for x in self.params]
+        return predict_in_batches(self._predict_fn, sequences, batch_size,
+                                  params=params, cache_dir=cache_dir,
+                                  dtype=theano.config.floatX)
+
+    def snapshot(self):
+        """
+        Copy the current parameters into a second set of shared variables
+        used by `validate_snapshot`, so that a validation can run in the
+        background while training keeps updating the parameters.
+
+        Returns the copied values as a list of (name, value) pairs.
+        """
+        values = [(x.name, x.get_value()) for x in self.params]
+        if not hasattr(self, 'snapshot_params'):
+            self.snapshot_params = [theano.shared(value, name=name+'_snapshot')
+                                    for name, value in values]
+            inputs, output = self._validation_graph
+            self.validate_snapshot = theano.function(
+                inputs, output,
+                givens=zip(self.params, self.snapshot_params),
+                name='snapshot validation',
+                profile=0)
+        else:
+            for param, (name, value) in zip(self.snapshot_params, values):
+                param.set_value(value, borrow=True)
+        return values
+
+    def save(self, filename, values=None):
         """
         Personally I don't like relying on pickling the class to save, but
         rather to saving explicitly to minimize the size of the saved file
+
+        `values` is a list of (name, value) pairs to save instead of the
+        current parameters, e.g. taken earlier with `snapshot`.
         """
-        vals = dict([(x.name, x.get_value()) for x in self.params])
-        numpy.savez(filename, vals)
+        if values is None:
+            values = [(x.name, x.get_value()) for x in self.params]
+        numpy.savez(filename, **dict(values))
 
-    def load(self, filenma):
+    def load(self, filename):
         values = numpy.load(filename)
         for param in self.params:
             param.set_value(values[param.name], borrow=True)
@@ -15,9 +15,12 @@ sys.stdout=Unbuffered(sys.stdout)
 import numpy
 import cPickle
 import gzip
+import os
+import threading
 import time
 
 from utils import print_mem, print_time
+from metrics import Metrics
 
 class MainLoop(object):
     def __init__(self,
@@ -56,17 +59,126 @@ class MainLoop(object):
         n_elems = state['loopIters'] // state['validFreq'] + 1
         self.timings['valid'] = numpy.zeros((n_elems,), dtype='float32')
         self.timings['test'] = numpy.zeros((n_elems,), dtype='float32')
+        # With `asyncValid` validation runs in a background thread on a
+        # snapshot of the parameters (the model has to provide `snapshot`
+        # and `validate_snapshot`), with `asyncSave` checkpoints are
+        # written by a background thread. At most one validation and one
+        # checkpoint are in flight at any time. `keepCheckpoints` bounds
+        # the number of model%d.npz files kept when not overwriting (0
+        # keeps all of them). Both are off by default: the Theano and
+        # NumPy calls of the background thread mostly hold the GIL, so the
+        # overlap with training is small. It is measured and printed at
+        # the end of the run (see `report_overlap`), check it before
+        # turning them on.
+        self.async_valid = state.get('asyncValid', 0) and \
+                hasattr(model, 'snapshot')
+        self.async_save = state.get('asyncSave', 0)
+        self.keep_checkpoints = state.get('keepCheckpoints', 0)
+        self.valid_thread = None
+        self.save_thread = None
+        self.worker_error = None
+        # seconds spent in background work and seconds the training loop
+        # waited for it, per kind of work
+        self.background_time = {'validate': 0., 'save': 0.}
+        self.wait_time = {'validate': 0., 'save': 0.}
+        # durations of the training steps run with (True) and without
+        # (False) a background thread alive
+        self.step_times = {True: [], False: []}
+        # timers, counters and throughput of every step, appended to
+        # <prefix>metrics.jsonl; the algorithm reports into the same one
+        self.metrics = Metrics(state['prefix']+'metrics.jsonl',
+                               state.get('metricsWindow', 20))
+        self.algo.metrics = self.metrics
         if self.channel is not None:
             self.channel.save()
         self.start_time = time.time()
         self.batch_start_time = time.time()
 
+    def run_in_background(self, kind, target, *args):
+        def run():
+            st = time.time()
+            try:
+                target(*args)
+            except:
+                self.worker_error = sys.exc_info()
+            self.background_time[kind] += time.time() - st
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def check_worker_error(self):
+        if self.worker_error is not None:
+            exc_type, exc_value, exc_tb = self.worker_error
+            self.worker_error = None
+            raise exc_type, exc_value, exc_tb
+
+    def wait_validation(self):
+        if self.valid_thread is not None:
+            st = time.time()
+            self.valid_thread.join()
+            self.wait_time['validate'] += time.time() - st
+            self.metrics.add_time('validate_wait', time.time() - st)
+            self.valid_thread = None
+        self.check_worker_error()
+
+    def wait_save(self):
+        if self.save_thread is not None:
+            st = time.time()
+            self.save_thread.join()
+            self.wait_time['save'] += time.time() - st
+            self.metrics.add_time('save_wait', time.time() - st)
+            self.save_thread = None
+        self.check_worker_error()
+
+    def background_running(self):
+        return any(thread is not None and thread.is_alive()
+                   for thread in [self.valid_thread, self.save_thread])
+
+    def report_overlap(self):
+        """
+        Print how much of the background validation and save time was
+        really overlapped with training: the background time minus the
+        time the loop waited for the threads and minus the time the
+        training steps lost while a thread was running (mean step time
+        with a thread alive compared to without).
+        """
+        busy = sum(self.background_time.values())
+        if busy == 0:
+            return
+        waited = sum(self.wait_time.values())
+        with_bg = self.step_times[True]
+        without_bg = self.step_times[False]
+        lost = 0.
+        if with_bg and without_bg:
+            lost = max(numpy.mean(with_bg) - numpy.mean(without_bg), 0.) * \
+                    len(with_bg)
+        overlap = max(busy - waited - lost, 0.) / busy
+        print ('Background work %s, waited %s, steps slowed down by %s, '
+               'overlap %.1f%%') % (print_time(busy), print_time(waited),
+                                    print_time(lost), 100 * overlap)
+
     def validate(self):
+        self.wait_validation()
+        if self.async_valid:
+            values = self.model.snapshot()
+            self.valid_thread = self.run_in_background(
+                'validate', self._validate, self.model.validate_snapshot, values,
+                self.step)
+        else:
+            self._validate(self.model.validate, None, self.step)
+
+    def _validate(self, validate_fn, values, step):
+        """
+        Validation of the parameters of step `step`, `values` are the
+        (name, value) pairs of these parameters if they were copied with
+        `model.snapshot`, None if the model parameters are used directly.
+        """
         n_elems = 0
         cost = 0
-        for batch in self.valid_data.__iter__():
-            n_elems += 1
-            cost += 100*self.model.validate(*batch)
+        with self.metrics.timer('validate'):
+            for batch in self.valid_data.__iter__():
+                n_elems += 1
+                cost += 100*validate_fn(*batch)
         cost /= numpy.float32(n_elems)
         print ('** validation cost %6.3f computed in %s'
                ', best cost is %6.3f, test %6.3f, whole time %6.3f min') % (
@@ -76,7 +188,7 @@ class MainLoop(object):
                    self.state['testcost'],
                    (time.time() - self.start_time)/60. )
         self.batch_start_time = time.time()
-        pos = self.step // self.state['validFreq']
+        pos = step // self.state['validFreq']
         self.timings['valid'][pos] = float(cost)
         self.timings['test'][pos] = float(self.state['testcost'])
         self.state['validcost'] = float(cost)
@@ -84,36 +196,68 @@ class MainLoop(object):
         if self.state['bvalidcost'] > cost:
             self.state['bvalidcost'] = float(cost)
             self.state['btraincost'] = float(self.state['traincost'])
-            self.test()
+            self.test(validate_fn, values, step)
         print_mem('validate')
 
-    def test(self):
-        self.model.best_params = [(x.name, x.get_value()) for x in
-                                  self.model.params]
+    def test(self, validate_fn, values, step):
+        if values is None:
+            values = [(x.name, x.get_value()) for x in self.model.params]
+        self.model.best_params = values
         if self.test_data is not None:
             n_elems = 0
             cost = 0
-            for batch in self.valid_data.__iter__():
+            for batch in self.test_data.__iter__():
                 n_elems += 1
-                cost += self.model.validate(*batch)
+                cost += validate_fn(*batch)
             cost /= numpy.float32(n_elems)
         else:
             cost = numpy.nan
         print '>>> Test cost', cost
-        pos = self.step // self.state['validFreq']
+        pos = step // self.state['validFreq']
         self.timings['test'][pos] = float(cost)
         self.state['testcost'] = float(cost)
 
     def save(self):
-        numpy.savez(self.state['prefix']+'timing.npz',
-                    **self.timings)
-        if self.state['overwrite']:
-            self.model.save(self.state['prefix']+'model.npz')
+        """
+        Write the timings, the model and the state. Everything is copied
+        first, so with `asyncSave` the files are written in the background
+        while training goes on.
+        """
+        self.wait_save()
+        with self.metrics.timer('save'):
+            timings = dict((name, value.copy())
+                           for name, value in self.timings.items())
+            values = [(x.name, x.get_value()) for x in self.model.params]
+            state = dict(self.state)
+        if self.async_save:
+            self.save_thread = self.run_in_background(
+                'save', self._save, timings, values, state, self.save_iter)
         else:
-            self.model.save(self.state['prefix']+'model%d.npz' % self.save_iter)
-        cPickle.dump(self.state, open(self.state['prefix']+'state.pkl', 'w'))
+            self._save(timings, values, state, self.save_iter)
         self.save_iter += 1
 
+    def _save(self, timings, values, state, save_iter):
+        # every file is written under a temporary name then renamed, so
+        # an interrupted job never leaves a truncated checkpoint
+        st = time.time()
+        prefix = self.state['prefix']
+        numpy.savez(prefix+'timing.tmp.npz', **timings)
+        os.rename(prefix+'timing.tmp.npz', prefix+'timing.npz')
+        if self.state['overwrite']:
+            filename = prefix+'model.npz'
+        else:
+            filename = prefix+'model%d.npz' % save_iter
+        self.model.save(prefix+'model.tmp.npz', values)
+        os.rename(prefix+'model.tmp.npz', filename)
+        with open(prefix+'state.pkl.tmp', 'w') as fp:
+            cPickle.dump(state, fp)
+        os.rename(prefix+'state.pkl.tmp', prefix+'state.pkl')
+        if not self.state['overwrite'] and self.keep_checkpoints > 0:
+            old = prefix+'model%d.npz' % (save_iter - self.keep_checkpoints)
+            if os.path.exists(old):
+                os.remove(old)
+        self.metrics.add_time('save_write', time.time() - st)
+
     def main(self):
         print_mem('start')
         self.state['gotNaN'] = 0
@@ -138,7 +282,11 @@ class MainLoop(object):
                 self.save_time = time.time()
             st = time.time()
             try:
+                background = self.background_running()
+                step_st = time.time()
                 rvals = self.algo()
+                self.step_times[background].append(time.time() - step_st)
+                self.metrics.record(self.step, **rvals)
                 self.state['traincost'] = float(rvals['cost'])
                 self.state['step'] = self.step
                 last_cost = rvals['cost']
@@ -158,6 +306,7 @@ class MainLoop(object):
                 self.step += 1
             except:
                 self.state['wholetime'] = float(time.time() - start_time)
+                self.async_save = 0
                 self.save()
                 if self.channel:
                     self.channel.save()
@@ -176,7 +325,9 @@ class MainLoop(object):
 
         self.state['wholetime'] = float(time.time() - start_time)
         self.validate()
+        self.wait_validation()
         self.save()
+        self.wait_save()
         if self.channel:
             self.channel.save()
         print 'BEST SCORE'
@@ -187,3 +338,4 @@ class MainLoop(object):
         print 'Best Valid', self.state['bvalidcost']
         print 'TEST', self.state['testcost']
         print 'Took', (time.time() - start_time)/60.,'min'
+        self.report_overlap()
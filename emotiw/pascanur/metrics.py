@@ -0,0 +1,105 @@
+"""
+Instrumentation of the training loop.
+
+`Metrics` accumulates named timers (seconds spent in data fetch, grad,
+eval, update, validate, save, ...) and counters (examples, frames, ...)
+between two calls of `record`. Every record is appended as one JSON
+object per line to a metrics file, so a run can be followed or analysed
+while it is going, e.g. to tell whether a slow job is waiting on data
+or on compute:
+
+    {"step": 10, "time": 12.3, "timers": {"data": .5, "grad": 1.2},
+     "counters": {"examples": 128}, "rates": {"examples": 104.1},
+     "cost": 1.92, ...}
+
+`rates` are throughputs (per second of wall-clock time) of the counters
+over the last `window` records.
+"""
+import collections
+import contextlib
+import json
+import threading
+import time
+
+
+class Metrics(object):
+    def __init__(self, filename=None, window=20):
+        """
+        :param filename: String
+            Metrics file, records are appended to it. If None, nothing is
+            written and only the rolling rates are kept.
+        :param window: int
+            Number of records over which rates are computed
+        """
+        self.filename = filename
+        self.window = window
+        self.start_time = time.time()
+        self.timers = collections.defaultdict(float)
+        self.counters = collections.defaultdict(float)
+        self.totals = collections.defaultdict(float)
+        # (time, totals) at the last `window` records
+        self.history = collections.deque(maxlen=window + 1)
+        self.history.append((self.start_time, {}))
+        # timers can be updated from the validation/save threads
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Context manager adding the time spent in its block to timer `name`
+        """
+        st = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - st)
+
+    def add_time(self, name, secs):
+        with self.lock:
+            self.timers[name] += secs
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+            self.totals[name] += n
+
+    def rate(self, name):
+        """
+        Rolling throughput of counter `name` per second
+        """
+        with self.lock:
+            now = time.time()
+            first_time, first_totals = self.history[0]
+            if now <= first_time:
+                return 0.
+            done = self.totals.get(name, 0.) - first_totals.get(name, 0.)
+            return done / (now - first_time)
+
+    def record(self, step, **values):
+        """
+        Append the timers and counters accumulated since the previous
+        record, the rolling rates and `values` (e.g. the cost) to the
+        metrics file, then reset the timers and counters.
+
+        Returns the record as a dict.
+        """
+        now = time.time()
+        with self.lock:
+            self.history.append((now, dict(self.totals)))
+            first_time, first_totals = self.history[0]
+            span = max(now - first_time, 1e-8)
+            rates = dict((name, (total - first_totals.get(name, 0.)) / span)
+                         for name, total in self.totals.items())
+            entry = {'step': step,
+                     'time': now - self.start_time,
+                     'timers': dict(self.timers),
+                     'counters': dict(self.counters),
+                     'rates': rates}
+            self.timers.clear()
+            self.counters.clear()
+        for name, value in values.items():
+            entry[name] = value
+        if self.filename is not None:
+            with open(self.filename, 'a') as fp:
+                fp.write(json.dumps(entry, default=float) + '\n')
+        return entry
@@ -10,6 +10,8 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 from minres import minres, minres_messages
 from minres import minresQLP, minresQLP_messages
 from utils import forloop, safe_clone, print_time, print_mem, const
+from metrics import Metrics
+from parallel import ReplicaPool
 
 
 class natSGD(object):
@@ -65,6 +67,8 @@ class natSGD(object):
         self.profile = profile
         self.data = data
         self.step_timer = time.time()
+        # replaced by the one of MainLoop, which writes it to disk
+        self.metrics = Metrics()
 
         ############################################################
         # Step 1. Compile function for computing eucledian gradients
@@ -86,10 +90,42 @@ class natSGD(object):
         #############################################################
         # Step 2. Compile function for Computing Riemannian gradients
         #############################################################
+        # the metric minibatch is only inputs and labels, it has no mask
+        # to give to the inputs of a masked model
+        if getattr(model, 'masked', False):
+            raise ValueError('natSGD needs a model taking the inputs and '
+                             'labels only (masked=False)')
         loc_x = self.data._natgrad[bdx*cbs: (bdx+1)*cbs]
         loc_y = self.data._natgrady[bdx*cbs:(bdx+1)*cbs]
-        loc_Gvs = safe_clone(model.Gvs(*self.loop_inps), [model.x, model.y],
-                             [loc_x, loc_y])
+        # The forward activations of the metric minibatch do not depend on
+        # the vector multiplied by the metric, only on the parameters and
+        # the data. With `cache_metric`, the activations the model lists
+        # in `metric_activations` are computed once per step for every
+        # chunk and the Gv products of all the MINRES iterations read them
+        # from shared variables (leading dimension is the chunk index),
+        # passed to `model.Gvs` as `activations`. This only saves the
+        # parts of the graph reading these activations directly: the R-op
+        # through a recurrence is a scan recomputing the forward states,
+        # so every Gv product of a recurrent model still runs its forward
+        # recurrence once.
+        acts = getattr(model, 'metric_activations', [])
+        self.metric_cache = []
+        if state.get('cache_metric', 0):
+            if not acts:
+                raise ValueError('cache_metric needs a model listing its '
+                                 'metric_activations')
+            self.metric_cache = [theano.shared(
+                numpy.zeros((0,) * (act.ndim + 1), dtype=act.dtype),
+                name='cached_%s' % act.name) for act in acts]
+            Gvs = model.Gvs(*self.loop_inps, activations=[
+                cache[bdx] for cache in self.metric_cache])
+            loc_acts = safe_clone(acts, model.inputs, [loc_x, loc_y])
+            self.loc_metric_activations = theano.function(
+                [bdx], loc_acts, name='loc_metric_activations',
+                profile=profile)
+        else:
+            Gvs = model.Gvs(*self.loop_inps)
+        loc_Gvs = safe_clone(Gvs, model.inputs, [loc_x, loc_y])
         updates = [(l, l + lg) for l, lg in zip(self.loop_outs, loc_Gvs)]
         st = time.time()
         loc_Gv_fn = theano.function(
@@ -106,10 +142,22 @@ class natSGD(object):
         print 'Constructing riemannian gradient function'
         st = time.time()
         norm_grads = TT.sqrt(sum(TT.sum(x ** 2) for x in self.gs))
+        rhs = [x / norm_grads for x in self.gs]
+        if state.get('minres_warm', 0):
+            # Warm start from the natural gradient of the previous step:
+            # with x0 = rs / |g|, solve (G + damp I) d = b - (G + damp I) x0
+            # and return x0 + d. This costs one more Gv product and any
+            # solver can be used since it still starts from 0. The relative
+            # residual reported by the solver is then relative to the
+            # initial residual.
+            x0 = [r / norm_grads for r in self.rs]
+            Gx0, _ = compute_Gv(*x0)
+            rhs = [b - Gv - self.damping * v
+                   for b, Gv, v in zip(rhs, Gx0, x0)]
         if not state['minresQLP']:
             self.msgs = minres_messages
             rvals = minres(compute_Gv,
-                           [x / norm_grads for x in self.gs],
+                           rhs,
                            rtol=state['mrtol'],
                            damp=self.damping,
                            maxit=state['miters'],
@@ -117,7 +165,7 @@ class natSGD(object):
         else:
             self.msgs = minresQLP_messages[1:]
             rvals = minresQLP(compute_Gv,
-                              [x / norm_grads for x in self.gs],
+                              rhs,
                               model.params_shape,
                               rtol=state['mrtol'],
                               damp=self.damping,
@@ -125,7 +173,10 @@ class natSGD(object):
                               TranCond=state['trancond'],
                               profile=state['profile'])
 
-        nw_rs = [x * norm_grads for x in rvals[0]]
+        if state.get('minres_warm', 0):
+            nw_rs = [(v + d) * norm_grads for v, d in zip(x0, rvals[0])]
+        else:
+            nw_rs = [x * norm_grads for x in rvals[0]]
         flag = TT.cast(rvals[1], 'int32')
         niters = rvals[2]
         rel_residual = rvals[3]
@@ -221,20 +272,69 @@ class natSGD(object):
                              'damping',
                              'rho']
 
-    def compute_gradients(self):
+        # With `n_workers` > 0 the chunk loops over the gradient and cost
+        # minibatches run in that many forked worker processes (CPU only),
+        # which hold replicas of the compiled functions and of the data.
+        # The parameters and natural gradients are copied to the workers
+        # before every loop, the gradients are summed back.
+        self.pool = None
+        if state.get('n_workers', 0) > 0:
+            self.pool = ReplicaPool(self, state['n_workers'],
+                                    model.params + self.rs, self.gs)
+
+    def map_chunks(self, method, n_chunks, *args, **kwargs):
+        """
+        Call `method(chunks, *args)` on the chunks 0 .. n_chunks-1, split
+        over the worker processes if there are any, and return the
+        concatenation of the lists it returns. With `reduce=True` the
+        gradients accumulated by the workers are summed.
+        """
+        if self.pool is None:
+            return getattr(self, method)(range(n_chunks), *args)
+        return sum(self.pool.run(method, range(n_chunks), *args,
+                                 **kwargs), [])
+
+    def update_data(self, name):
+        """
+        Call the update method `name` of the dataset, in the worker
+        processes as well so that their replicas stay in sync.
+        """
+        if self.pool is not None:
+            self.pool.call('update_data', name)
+        getattr(self.data, name)()
+
+    def chunk_gradients(self, chunks):
         for g in self.gs:
             g.container.storage[0][:] = 0
-        for idx in xrange(self.bs // self.cbs):
+        for idx in chunks:
             self.loc_grad_fn(idx)
+        return []
+
+    def chunk_old_costs(self, chunks):
+        return [self.loc_old_cost(idx) for idx in chunks]
+
+    def chunk_new_costs(self, chunks, lr):
+        return [self.loc_new_cost(idx, lr) for idx in chunks]
+
+    def chunk_new_costs_all(self, chunks, lr):
+        return [self.loc_new_cost_all(idx, lr) for idx in chunks]
+
+    def compute_gradients(self):
+        self.map_chunks('chunk_gradients', self.bs // self.cbs, reduce=True)
+
+    def cache_metric_activations(self):
+        for cache, values in zip(self.metric_cache, zip(*[
+                self.loc_metric_activations(idx)
+                for idx in xrange(self.mbs // self.cbs)])):
+            cache.set_value(numpy.asarray(values), borrow=True)
 
     def compute_old_cost(self):
-        costs = [self.loc_old_cost(idx)
-                 for idx in xrange(self.bs // self.cbs)]
+        costs = self.map_chunks('chunk_old_costs', self.bs // self.cbs)
         return numpy.mean(costs).astype(theano.config.floatX)
 
     def compute_new_cost(self, lr):
-        rvals = [self.loc_new_cost(idx, self.lr)
-                 for idx in xrange(self.bs // self.cbs)]
+        rvals = self.map_chunks('chunk_new_costs', self.bs // self.cbs,
+                                self.lr)
         cost = numpy.mean([x for x, y in
                             rvals]).astype(theano.config.floatX)
         error = numpy.mean([y for x, y in
@@ -242,8 +342,8 @@ class natSGD(object):
         return cost, error
 
     def compute_new_cost_all(self, lr):
-        rvals = [self.loc_new_cost_all(idx, self.lr)
-                 for idx in xrange(self.ebs // self.cbs)]
+        rvals = self.map_chunks('chunk_new_costs_all', self.ebs // self.cbs,
+                                self.lr)
         cost = numpy.mean([x for x, z, y in
                             rvals]).astype(theano.config.floatX)
         old_cost = numpy.mean([z for x,z,y in
@@ -253,20 +353,30 @@ class natSGD(object):
         return cost, old_cost, error
 
     def __call__(self):
-        self.data.update_before_computing_gradients()
+        metrics = self.metrics
+        with metrics.timer('data'):
+            self.update_data('update_before_computing_gradients')
+        metrics.count('examples', self.bs)
         g_st = time.time()
-        self.compute_gradients()
+        with metrics.timer('grad'):
+            self.compute_gradients()
         g_ed = time.time()
-        self.data.update_before_computing_natural_gradients()
+        with metrics.timer('data'):
+            self.update_data('update_before_computing_natural_gradients')
         r_st = time.time()
-        rvals = self.compute_natural_gradients()
+        with metrics.timer('metric'):
+            if self.metric_cache:
+                self.cache_metric_activations()
+            rvals = self.compute_natural_gradients()
         r_ed = time.time()
-        self.data.update_before_evaluation()
+        with metrics.timer('data'):
+            self.update_data('update_before_evaluation')
         e_st = time.time()
-        old_cost = self.compute_old_cost()
-        new_cost, error = self.compute_new_cost(self.lr)
-        rho, r_g, angle = self.compute_rho(old_cost, new_cost, self.lr,
-                                           rvals[5]*rvals[6])
+        with metrics.timer('eval'):
+            old_cost = self.compute_old_cost()
+            new_cost, error = self.compute_new_cost(self.lr)
+            rho, r_g, angle = self.compute_rho(old_cost, new_cost, self.lr,
+                                               rvals[5]*rvals[6])
         if self.state['adapt'] == 3:
             odamp = self.damping.get_value()
             if rvals[1] < 5 and odamp > 1e-5:
@@ -302,7 +412,8 @@ class natSGD(object):
                     (1. + float(self.step - self.state['lr_adapt_start'])/self.state['lr_beta'])
                 self.state['lr'] = float(self.lr)
         if self.step % self.state['trainFreq'] == 0:
-            new_cost, old_cost, error = self.compute_new_cost_all(self.lr)
+            with metrics.timer('eval'):
+                new_cost, old_cost, error = self.compute_new_cost_all(self.lr)
 
             if new_cost > self.state['btraincost'] * 6:
                 raise Exception('Variance too large on training cost!')
@@ -338,7 +449,8 @@ class natSGD(object):
                    'time [grad] %s,'
                    '[riemann grad] %s,'
                    '[updates param] %s,'
-                   'whole time %s')
+                   'whole time %s, '
+                   '%.1f examples/s')
             print msg % (
                 self.step,
                 new_cost,
@@ -355,14 +467,16 @@ class natSGD(object):
                 print_time(g_ed - g_st),
                 print_time(r_ed - r_st),
                 print_time(e_ed - e_st),
-                print_time(time.time() - self.step_timer))
+                print_time(time.time() - self.step_timer),
+                metrics.rate('examples'))
             self.step_timer = time.time()
 
         else:
             new_cost = self.__new_cost
             error = self.__error
         self.old_cost = new_cost
-        self.update_params(self.lr)
+        with metrics.timer('update'):
+            self.update_params(self.lr)
         e_ed = time.time()
 
 
@@ -0,0 +1,179 @@
+"""
+Data-parallel evaluation of the chunk loops of SGD and natSGD.
+
+`ReplicaPool` forks worker processes once an algorithm has compiled its
+functions, so every worker holds a replica of the model, of the dataset
+and of the compiled functions. Before running anything the parent
+broadcasts a list of shared variables (the parameters and whatever else
+the functions read, e.g. the natural gradients) through shared memory.
+Each worker then runs a method of its replica of the algorithm on its
+share of the chunks. For the methods computing the gradients
+(`run(..., reduce=True)`), it writes its partial sums of the reduced
+shared variables into its own slot of a second shared memory block,
+which the parent sums. Methods which only compute costs leave the reduced
+variables untouched.
+
+Forking only works with Theano on the CPU, a CUDA context can not be
+used from a child process.
+"""
+import multiprocessing
+import traceback
+
+import numpy
+import theano
+
+
+class SharedArrays(object):
+    def __init__(self, shapes, dtype, n_slots=1):
+        """
+        Arrays of the given shapes packed in one block of shared memory,
+        with `n_slots` copies of all of them.
+        """
+        self.shapes = shapes
+        self.sizes = [int(numpy.prod(shp)) for shp in shapes]
+        dtype = numpy.dtype(dtype)
+        self.raw = multiprocessing.RawArray(
+            'b', n_slots * sum(self.sizes) * dtype.itemsize)
+        self.data = numpy.frombuffer(self.raw, dtype=dtype).reshape(
+            (n_slots, sum(self.sizes)))
+
+    def views(self, slot=0):
+        rval = []
+        start = 0
+        for shp, size in zip(self.shapes, self.sizes):
+            rval.append(self.data[slot, start:start + size].reshape(shp))
+            start += size
+        return rval
+
+    def write(self, values, slot=0):
+        for view, value in zip(self.views(slot), values):
+            view[...] = value
+
+    def total(self):
+        """
+        Sum of all the slots, as a list of arrays
+        """
+        rval = []
+        start = 0
+        summed = self.data.sum(axis=0)
+        for shp, size in zip(self.shapes, self.sizes):
+            rval.append(summed[start:start + size].reshape(shp))
+            start += size
+        return rval
+
+
+def _shapes(variables):
+    return [x.get_value(borrow=True).shape for x in variables]
+
+
+class ReplicaPool(object):
+    def __init__(self, algo, n_workers, broadcast, reduced):
+        """
+        :param algo:
+            Object whose methods are run by the workers, usually the
+            optimization algorithm after compiling its functions
+        :param n_workers: int
+            Number of worker processes
+        :param broadcast:
+            Shared variables copied from the parent to the workers before
+            every `run`
+        :param reduced:
+            Shared variables summed over the workers after a `run` with
+            `reduce=True`, the result is set in the parent
+        """
+        self.n_workers = n_workers
+        self.broadcast = broadcast
+        self.reduced = reduced
+        floatX = theano.config.floatX
+        self.broadcast_buf = SharedArrays(_shapes(broadcast), floatX)
+        self.reduced_buf = SharedArrays(_shapes(reduced), floatX, n_workers)
+        self.conns = []
+        self.workers = []
+        for slot in xrange(n_workers):
+            conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=self._work, args=(algo, child_conn, slot))
+            worker.daemon = True
+            worker.start()
+            self.conns.append(conn)
+            self.workers.append(worker)
+
+    def _work(self, algo, conn, slot):
+        error = None
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            command, method, chunks, args, reduce = msg
+            try:
+                if command == 'call':
+                    getattr(algo, method)(*args)
+                    continue
+                if error is not None:
+                    raise Exception(error)
+                for var, value in zip(self.broadcast,
+                                      self.broadcast_buf.views()):
+                    var.set_value(value, borrow=False)
+                rval = getattr(algo, method)(chunks, *args)
+                if reduce:
+                    self.reduced_buf.write(
+                        [x.get_value(borrow=True) for x in self.reduced],
+                        slot)
+                conn.send(('ok', rval))
+            except:
+                if command == 'call':
+                    # reported with the reply to the next `run`
+                    error = traceback.format_exc()
+                else:
+                    conn.send(('error', traceback.format_exc()))
+                    error = None
+
+    def call(self, method, *args):
+        """
+        Call `method(*args)` in every worker without waiting for it, e.g.
+        to keep the replicas of the dataset in sync with the parent.
+        """
+        for conn in self.conns:
+            conn.send(('call', method, None, args, False))
+
+    def run(self, method, chunks, *args, **kwargs):
+        """
+        Broadcast the shared variables, then call `method(chunks_k, *args)`
+        in every worker k, where chunks_k = chunks[k::n_workers] (None if
+        `chunks` is None). With `reduce=True` the reduced variables are
+        set to their sum over the workers, `method` must then leave in
+        them the partial sums of its chunks. They are left as they are
+        otherwise.
+
+        Returns the list of the return values of the workers.
+        """
+        reduce = kwargs.pop('reduce', False)
+        assert not kwargs, kwargs
+        self.broadcast_buf.write([x.get_value(borrow=True)
+                                  for x in self.broadcast])
+        for k, conn in enumerate(self.conns):
+            if chunks is None:
+                loc_chunks = None
+            else:
+                loc_chunks = chunks[k::self.n_workers]
+            conn.send(('run', method, loc_chunks, args, reduce))
+        rvals = []
+        errors = []
+        for conn in self.conns:
+            status, rval = conn.recv()
+            if status == 'error':
+                errors.append(rval)
+            rvals.append(rval)
+        if errors:
+            raise Exception('Error in worker process:\n' + errors[0])
+        if not reduce:
+            return rvals
+        for var, value in zip(self.reduced, self.reduced_buf.total()):
+            var.set_value(value.astype(theano.config.floatX), borrow=True)
+        return rvals
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for worker in self.workers:
+            worker.join()
@@ -2,9 +2,11 @@ from birnn import biRNN
 from SGD import SGD
 from mainLoop import MainLoop
 from audio_data import DenseSequences, ListSequences
+import sys
 import numpy
 import theano
 import theano.tensor as TT
+from emotiw.common.utils import sweep
 
 def jobman(state, channel):
     # load dataset
@@ -14,9 +16,15 @@ def jobman(state, channel):
                                 which='train',
                                 one_hot=False,
                                 nbits=32)
-    train_data = _train_data.export_dense_format(
-        sequence_length=state['seqlen'],
-        overlap=state['overlap'])
+    if state.get('bucketed', 0):
+        # whole clips, in minibatches of similar lengths
+        train_data = _train_data.export_bucketed_format(
+            max_waste=state['max_waste'],
+            max_batchsize=state['bs'])
+    else:
+        train_data = _train_data.export_dense_format(
+            sequence_length=state['seqlen'],
+            overlap=state['overlap'])
 
     valid_data = ListSequences(
         path = state['path'],
@@ -28,18 +36,38 @@ def jobman(state, channel):
     model = biRNN(
         nhids=state['nhids'],
         nouts=numpy.max(train_data.data_y)+1,
-        nins=train_data.data_x.shape[-1],
+        nins=_train_data.data_x[0].shape[-1],
         activ = TT.nnet.sigmoid,
         seed = state['seed'],
         bs = state['bs'],
-        seqlen = state['seqlen'])
+        seqlen = state['seqlen'],
+        masked = state.get('bucketed', 0))
 
     algo = SGD(model, state, train_data)
 
     main = MainLoop(train_data,valid_data, None, model, algo, state, channel)
     main.main()
 
-if __name__=='__main__':
+def sweep_entrypoint(state, channel):
+    # the sweep jobs only hold the values overriding the default state
+    for key, value in default_state().items():
+        state.setdefault(key, value)
+    jobman(state, channel)
+    return channel.COMPLETE
+
+# local sweeps (see emotiw.common.utils.sweep), values overriding the
+# default state
+SWEEP_DB = 'birnn.sqlite'
+SWEEP_VALS = {
+    'nhids' : [50, 100, 200],
+    'lr' : [.1, .01],
+    'bucketed' : [0, 1],
+    'seed' : [123],
+    }
+SWEEP_COLUMNS = ['nhids', 'lr', 'bucketed', 'seed', 'traincost',
+                 'validcost', 'bvalidcost', 'step']
+
+def default_state():
     state = {}
 
     state['path'] = '/data/lisa/data/faces/EmotiW/complete_audio_features'
@@ -48,6 +76,9 @@ if __name__=='__main__':
     state['subset'] = 'full'
     state['seqlen'] = 50
     state['overlap'] = 30
+    # set to 1 to train on whole clips instead of windows of seqlen steps
+    state['bucketed'] = 0
+    state['max_waste'] = .2
 
     state['nhids'] = 100
 
@@ -57,6 +88,9 @@ if __name__=='__main__':
 
     state['lr'] = .1
     state['lr_adapt'] = 0
+    # evaluate the trial step (to halve lr when the cost goes up) every
+    # trialFreq steps, 0 to never do it
+    state['trialFreq'] = 1
 
     state['seed'] = 123
 
@@ -68,5 +102,24 @@ if __name__=='__main__':
 
     state['prefix'] = 'conv_'
     state['overwrite'] = 1
-    jobman(state, None)
+    # set to 1 to validate and save in background threads (the overlap
+    # they get is printed at the end of the run); keep the last 3
+    # checkpoints when not overwriting
+    state['asyncValid'] = 0
+    state['asyncSave'] = 0
+    state['keepCheckpoints'] = 3
+    return state
+
+if __name__=='__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+        # python run_birnn.py sweep insert|run [n_workers n_threads]|view
+        if sys.argv[2] == 'insert':
+            sweep.insert(SWEEP_DB, 'run_birnn.sweep_entrypoint',
+                         sweep.produit_cartesien_jobs(SWEEP_VALS))
+        elif sys.argv[2] == 'run':
+            sweep.run(SWEEP_DB, *[int(x) for x in sys.argv[3:5]])
+        elif sys.argv[2] == 'view':
+            sweep.view(SWEEP_DB, SWEEP_COLUMNS, order_by=('bvalidcost',))
+    else:
+        jobman(default_state(), None)
 
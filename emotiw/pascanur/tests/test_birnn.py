@@ -0,0 +1,37 @@
+import numpy
+import theano
+from emotiw.pascanur.birnn import biRNN
+
+floatX = theano.config.floatX
+
+def test_cached_metric_products():
+    model = biRNN(nhids=5, nouts=3, nins=2, bs=4, seqlen=3, seed=1)
+    rng = numpy.random.RandomState(2)
+    x = numpy.asarray(rng.randn(3, 4, 2), floatX)
+    vs = [theano.shared(numpy.asarray(rng.randn(*shp), floatX))
+          for shp in model.params_shape]
+    acts = theano.function([model.x], model.metric_activations)(x)
+    cached = [theano.shared(act) for act in acts]
+    Gvs = model.Gvs(*vs)
+    cached_Gvs = model.Gvs(*vs, activations=cached)
+    fn = theano.function([model.x], Gvs + cached_Gvs,
+                         on_unused_input='ignore')
+    rvals = fn(x)
+    for Gv, cached_Gv in zip(rvals[:len(vs)], rvals[len(vs):]):
+        numpy.testing.assert_array_almost_equal(cached_Gv, Gv, decimal=4)
+
+def test_masked_metric_ignores_padding():
+    model = biRNN(nhids=5, nouts=3, nins=2, seed=1, masked=True)
+    rng = numpy.random.RandomState(2)
+    x = numpy.asarray(rng.randn(4, 3, 2), floatX)
+    mask = numpy.ones((4, 3), dtype=floatX)
+    mask[2:, 0] = 0
+    mask[1:, 2] = 0
+    vs = [theano.shared(numpy.asarray(rng.randn(*shp), floatX))
+          for shp in model.params_shape]
+    fn = theano.function([model.x, model.mask], model.Gvs(*vs))
+    rvals = fn(x, mask)
+    # the padded steps take other values
+    x2 = x + numpy.asarray(10 * (1 - mask)[:, :, None], floatX)
+    for Gv, Gv2 in zip(rvals, fn(x2, mask)):
+        numpy.testing.assert_array_almost_equal(Gv2, Gv, decimal=4)
@@ -0,0 +1,90 @@
+import numpy
+import theano
+import theano.tensor as TT
+from emotiw.pascanur.SGD import SGD
+
+floatX = theano.config.floatX
+
+class MeanSoftmax(object):
+    """
+    Softmax classifier of the mean over time of masked sequences, it
+    accepts minibatches of any shape
+    """
+    masked = True
+
+    def __init__(self, nins=3, nouts=2):
+        rng = numpy.random.RandomState(1)
+        self.W = theano.shared(numpy.asarray(rng.randn(nins, nouts), floatX))
+        self.b = theano.shared(numpy.zeros(nouts, dtype=floatX))
+        self.params = [self.W, self.b]
+        self.params_shape = [(nins, nouts), (nouts,)]
+        x = TT.tensor3('x')
+        mask = TT.matrix('mask')
+        t = TT.lvector('t')
+        h = (x * mask.dimshuffle(0, 1, 'x')).sum(0) / \
+                mask.sum(0).dimshuffle(0, 'x')
+        p = TT.nnet.softmax(TT.dot(h, self.W) + self.b)
+        self.train_cost = -TT.log(p[TT.arange(t.shape[0]), t]).mean()
+        self.error = TT.neq(TT.argmax(p, axis=1), t).mean()
+        self.inputs = [x, mask, t]
+
+class Batches(object):
+    def __init__(self, batches):
+        self.batches = batches
+
+    def set_iterator(self, **kwargs):
+        pass
+
+    def __iter__(self):
+        return self
+
+    def get_batch(self):
+        return self.batches.pop(0)
+
+def random_batches(n_batches, bs=8):
+    rng = numpy.random.RandomState(2)
+    batches = []
+    for _ in xrange(n_batches):
+        x = numpy.asarray(rng.randn(5, bs, 3), floatX)
+        mask = numpy.zeros((5, bs), dtype=floatX)
+        for i, length in enumerate(rng.randint(1, 6, size=bs)):
+            mask[:length, i] = 1
+        t = rng.randint(2, size=bs).astype('int64')
+        batches.append((x, mask, t))
+    return batches
+
+def run_sgd(n_workers, n_steps=3):
+    state = {'bs': 8, 'profile': 0, 'seed': 1, 'lr': .1, 'lr_adapt': 0,
+             'trialFreq': 1, 'n_workers': n_workers}
+    model = MeanSoftmax()
+    algo = SGD(model, state, Batches(random_batches(n_steps)))
+    try:
+        rvals = [algo() for _ in xrange(n_steps)]
+    finally:
+        if algo.pool is not None:
+            algo.pool.close()
+    return (rvals, [g.get_value() for g in algo.gs],
+            [p.get_value() for p in model.params])
+
+def test_parallel_sgd_matches_serial():
+    rvals, grads, params = run_sgd(0)
+    for n_workers in [1, 3]:
+        par_rvals, par_grads, par_params = run_sgd(n_workers)
+        for name in ['cost', 'error', 'norm_grad', 'rho', 'lr']:
+            numpy.testing.assert_array_almost_equal(
+                    [r[name] for r in par_rvals],
+                    [r[name] for r in rvals], decimal=5)
+        for par, ref in zip(par_grads + par_params, grads + params):
+            numpy.testing.assert_array_almost_equal(par, ref, decimal=5)
+
+def test_parallel_sgd_needs_masked_model():
+    model = MeanSoftmax()
+    model.masked = False
+    state = {'bs': 8, 'profile': 0, 'seed': 1, 'lr': .1, 'lr_adapt': 0,
+             'trialFreq': 1, 'n_workers': 2}
+    try:
+        SGD(model, state, Batches(random_batches(1)))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('n_workers > 0 accepted with an unmasked model')
@@ -3,6 +3,8 @@ import numpy
 import theano
 import theano.tensor as TT
 
+from emotiw.common.utils import lcn as lcn_module
+
 
 def safe_clone(cost, old_vars, new_vars):
     dummy_params = [x.type() for x in old_vars]
@@ -37,8 +39,10 @@ class forloop(theano.gof.Op):
         for out in self.outputs:
             out.container.storage[0][:] = 0
 
+        # the inputs are only read by loc_fn during this call, so they
+        # are bound without a copy
         for inp, inp_var in zip(inputs, self.inputs):
-            inp_var.set_value(inp, borrow=False)
+            inp_var.set_value(inp, borrow=True)
 
         for step in xrange(self.n_steps):
             self.loc_fn(step)
@@ -106,46 +110,12 @@ def const(value):
 
 def gaussian(size, sigma):
     # Function borrowed from bengioe_util
+    return lcn_module.gaussian(size, sigma)
 
-    height = float(size)
-    width = float(size)
-    center_x = width  / 2. + 0.5
-    center_y = height / 2. + 0.5
-
-    gauss = numpy.zeros((height, width))
-
-    for i in xrange(1, int(height) + 1):
-        for j in xrange(1, int(height) + 1):
-            x_diff_sq = ((float(j) - center_x)/(sigma*width)) ** 2.
-            y_diff_sq = ((float(i) - center_y)/(sigma*height)) ** 2.
-            gauss[i-1][j-1] = numpy.exp( - (x_diff_sq + y_diff_sq) / 2.)
-
-    return gauss
-
-def lcn_std_diff(x,size=9):
+def lcn_std_diff(x, size=9, ishape=(48, 48)):
     # Function borrowed from bengioe_util
-    p = x.reshape((1,1,48,48))
-    #p = (p-TT.mean(p))/T.std(p)
-    g = gaussian(size,1.591/size)
-    g/=g.sum()
-    g = numpy.float32(g.reshape((1,1,size,size)))
-    mean = TT.nnet.conv.conv2d(p,TT.constant(g),
-                              (1,1,48,48),
-                              (1,1,size,size),
-                              'full').reshape((48+size-1,)*2)
-    mean = mean[size/2:48+size/2,
-                size/2:48+size/2]
-    meansq = TT.nnet.conv.conv2d(TT.sqr(p),TT.constant(g),
-                                (1,1,48,48),
-                                (1,1,size,size),
-                                'full').reshape((48+size-1,)*2)
-    meansq = meansq[size/2:48+size/2,
-                    size/2:48+size/2]
-    var = meansq - TT.sqr(mean)
-    var = TT.clip(var, 0, 1e30)
-    std = TT.sqrt(var)
-    std = TT.clip(std, TT.mean(std), 1e30)
-    out = (p - mean) / std
+    p = x.reshape((1, 1) + tuple(ishape))
+    out = lcn_module.lcn_symbolic(p, size, variance='moments')
     return out - out.min()
 
 def lcn(x,ishape,size=9):
@@ -154,33 +124,12 @@ def lcn(x,ishape,size=9):
     expects x to be tensor{3|4}, the first dimension being the number
     of images, and the two last the shape of the image (which should be
     given anyways for optimization purposes
+
+    See emotiw.common.utils.lcn for the separable implementation and its
+    NumPy counterpart.
     """
-    inshape = (x.shape[0],1,ishape[0],ishape[1])
-    p = x.reshape(inshape)
-    #p = (p-TT.mean(p))/T.std(p)
-    g = gaussian(size,1.591/size)
-    g/=g.sum()
-    g = numpy.float32(g.reshape((1,1,size,size)))
-    mean = TT.nnet.conv.conv2d(p,TT.constant(g),
-                              None,
-                              (1,1,size,size),
-                              'full').reshape(
-                                  (x.shape[0],1)+(ishape[0]+size-1,)*2)
-    mean = mean[:,:,
-                size/2:ishape[0]+size/2,
-                size/2:ishape[1]+size/2]
-    v = (p - mean)#.dimshuffle('x','x',0,1)
-    var = TT.nnet.conv.conv2d(TT.sqr(v),TT.constant(g),
-                             None,
-                             (1,1,size,size),
-                             'full').reshape(
-                                  (x.shape[0],1)+(ishape[0]+size-1,)*2)
-    var = var[:,:,
-              size/2:ishape[0]+size/2,
-              size/2:ishape[1]+size/2]
-    std = TT.sqrt(var)
-    std_mean = TT.mean(TT.mean(std,axis=3),axis=2).dimshuffle(0,1,'x','x')
-    out = v / TT.maximum(std,std_mean)
+    p = x.reshape((x.shape[0], 1, ishape[0], ishape[1]))
+    out = lcn_module.lcn_symbolic(p, size)
     return (out + 2.5 )/5# - out.min()
 
 def softmax(x):
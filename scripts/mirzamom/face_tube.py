@@ -1,10 +1,12 @@
 import glob
+import os
 import numpy
 import cv2
 from PIL import Image, ImageDraw
 import shutil
 import ipdb
 import pickle
+import template_search
 
 
 color_list = ['#CD0000', '#1E90FF', '#FFFF00', '#00EE00', '#FF34B3',
@@ -21,7 +23,7 @@ def get_clip_lists(path):
     list = glob.glob("{}*.avi".format(path))
     rval = []
     for item in list:
-        rval.append(item.split('/')[-1].rstrip('.avi'))
+        rval.append(os.path.splitext(os.path.basename(item))[0])
     return rval
 
 def get_frames(path, clips):
@@ -117,32 +119,24 @@ def check_loc(data, loc_thre, size_thre):
             prev = data[clip][frame]
     return failed
 
-def get_previous_boxes(curr, prev, boxes, similar_thr):
-
-    prev = Image.open(prev)
-    curr = Image.open(curr)
+def get_previous_boxes(curr, prev, boxes, similar_thr, radius = 21, step = 3):
+    """
+    Track the boxes of the previous frame into the current one
+
+    Params
+    -----
+    curr: decoded current frame, see template_search.load_frame
+    prev: decoded previous frame
+    boxes: list of [x0, y0, x1, y1] boxes in the previous frame
+    similar_thr: minimum histogram correlation to accept a match
+    radius, step: displacements tried along each axis
+    """
 
     rval = []
     for box in boxes:
-        box = [int(item) for item in box]
-
-        prev = prev.crop(box)
-        rvals = []
-        pads = []
-        for x in range(-21, 22, 3):
-            for y in (-21, 22, 3):
-                pads.append([x, y])
-        for pad in pads:
-            tmp_box = [box[0] + pad[0], box[1] + pad[1], box[2] + pad[0], box[3] + pad[1]]
-            for item in tmp_box:
-                if item < 0:
-                    continue
-            curr_tmp = curr.crop(tmp_box)
-            rvals.append(similarness(prev, curr))
-
-        if max(rvals) > similar_thr: # 0.10:
-            pad = pads[numpy.argmax(rvals)]
-            rval.append([box[0] + pad[0], box[1] + pad[1], box[2] + pad[0], box[3] + pad[1]])
+        new_box = template_search.find_box(prev, curr, box, similar_thr, radius, step)
+        if new_box is not None:
+            rval.append(new_box)
 
     return rval
 
@@ -249,7 +243,7 @@ def assign_tube(tubes, boxes, frame, distance_thr, size_thr, overlap_thr):
 
     return tubes
 
-def get_face_tubes(frames, boxes, failed, img_path, tube_path, tube_full_path, distance_thr, size_thr, overlap_thr, similar_thr):
+def get_face_tubes(frames, boxes, failed, img_path, tube_path, tube_full_path, distance_thr, size_thr, overlap_thr, similar_thr, search_radius = 21, search_step = 3):
 
     def find_previous(data, ind):
         keys = data.keys()
@@ -273,6 +267,8 @@ def get_face_tubes(frames, boxes, failed, img_path, tube_path, tube_full_path, d
         frame_range = find_range(frames[clip])
         box_range = [min(boxes[clip].keys()), max(boxes[clip].keys())]
         face_tubes[clip] = []
+        # keep the last decoded previous frame, it is shared by a whole gap
+        prev_decoded = (None, None)
 
         for frame in frame_range:
             img = "%s%s-%03d.png" % (img_path, clip, frame)
@@ -285,8 +281,11 @@ def get_face_tubes(frames, boxes, failed, img_path, tube_path, tube_full_path, d
             else:
                 prev = find_previous(boxes[clip], frame)
                 if prev is not None:
-                    prev_img = "%s%s-%03d.png" % (img_path, clip, prev)
-                    prev_boxes = get_previous_boxes(img, prev_img, boxes[clip][prev], similar_thr)
+                    if prev_decoded[0] != prev:
+                        prev_img = "%s%s-%03d.png" % (img_path, clip, prev)
+                        prev_decoded = (prev, template_search.load_frame(prev_img))
+                    curr_img = template_search.load_frame(img)
+                    prev_boxes = get_previous_boxes(curr_img, prev_decoded[1], boxes[clip][prev], similar_thr, search_radius, search_step)
                     if len(prev_boxes) > 0:
                         face_tubes[clip] = assign_tube(face_tubes[clip], prev_boxes, frame, distance_thr, size_thr, overlap_thr)
 
@@ -1,12 +1,60 @@
 """
 Extracts frame images from avi files
+
+Clips are extracted by a pool of ffmpeg jobs. Every finished clip is
+recorded in a manifest (one json line per clip in the image directory)
+with its output size, frame count, timing and error if any, so a run
+can be interrupted and started again: clips that are already complete
+at the requested size are skipped.
+
+Usage: python frame_extractor.py AFEW2|AFEW [n_jobs] [width]
 """
 
 import subprocess
+import multiprocessing
 import glob
+import json
+import time
 import os
 import sys
-import ipdb
+
+MANIFEST = "manifest.json"
+
+
+def probe(path):
+    """
+    Return the width, height, and display aspect ratio of the video
+    stream as reported by ffprobe
+
+    Params
+    -----
+    path: avi file path
+    """
+
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+                "-show_entries", "stream=width,height,sample_aspect_ratio,display_aspect_ratio",
+                "-of", "json", path]
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise IOError("ffprobe failed on {}: {}".format(path, err.strip()))
+    stream = json.loads(out)['streams'][0]
+
+    def ratio(value):
+        try:
+            num, den = map(float, value.split(':'))
+        except (AttributeError, ValueError):
+            return None
+        if num <= 0 or den <= 0:
+            return None
+        return num / den
+
+    width, height = stream['width'], stream['height']
+    dar = ratio(stream.get('display_aspect_ratio'))
+    if dar is None:
+        sar = ratio(stream.get('sample_aspect_ratio')) or 1.
+        dar = sar * width / float(height)
+    return width, height, dar
 
 def get_output_size(path, width = 1024):
     """
@@ -20,18 +68,8 @@ def get_output_size(path, width = 1024):
     widht: output image width
     """
 
-    command = ["ffprobe", path]
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    res = p.communicate()[0]
-    asr = res[res.find("DAR "):].split(']')[0][4:].split(':')
-    try:
-        asr = map(float, asr)
-    except ValueError:
-        asr = res[res.find("DAR "):].split(' ')[1].split(':')
-        asr[1] = asr[1].split(",")[0]
-        asr = map(float, asr)
-
-    height = int(width / (asr[0]/asr[1]))
+    dar = probe(path)[2]
+    height = int(width / dar)
     return "{}x{}".format(width, height)
 
 
@@ -44,53 +82,160 @@ def extract_frames(src, dest, asr):
     src: src file
     dest: dest file pattern
     asr: aspect ration string e.g. 1024x576
+
+    Returns ffmpeg's return code and error output
+    """
+
+    command = ["ffmpeg", "-y", "-v", "error", "-i", src,  "-s", asr, "-q", "1", dest]
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = p.communicate()[1]
+    return p.returncode, err
+
+def clip_frames(save_path, clip):
+
+    return glob.glob("{}/{}-*.png".format(save_path, clip))
+
+def load_manifest(img_path):
+    """
+    Return the last manifest entry of every clip
+    """
+
+    rval = {}
+    path = os.path.join(img_path, MANIFEST)
+    if not os.path.isfile(path):
+        return rval
+    with open(path) as in_f:
+        for line in in_f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # partially written line of an interrupted run
+                continue
+            rval[entry['src']] = entry
+    return rval
+
+def is_complete(entry, width):
+    """
+    A clip is complete if its last extraction at this width succeeded and
+    all its frames are still on disk
+    """
+
+    if entry is None or entry['status'] != 'ok' or entry['width'] != width:
+        return False
+    return len(clip_frames(entry['save_path'], entry['clip'])) == entry['n_frames']
+
+def extract_job(job):
+    """
+    Extract one clip, run in a worker process
+
+    Params
+    -----
+    job: (src, save_path, width)
+
+    Returns the manifest entry of the clip
+    """
+
+    src, save_path, width = job
+    clip = os.path.splitext(os.path.basename(src))[0]
+    entry = {'src': src, 'clip': clip, 'save_path': save_path, 'width': width}
+    start = time.time()
+    try:
+        # get proper size of image from aspect ration info
+        asr = get_output_size(src, width)
+        entry['size'] = asr
+
+        # remove frames of a previous extraction, possibly at another size
+        for item in clip_frames(save_path, clip):
+            os.remove(item)
+
+        #extract frame images
+        output = "{}/{}-%3d.png".format(save_path, clip)
+        code, err = extract_frames(src, output, asr)
+        entry['n_frames'] = len(clip_frames(save_path, clip))
+        if code != 0 or entry['n_frames'] == 0:
+            entry['status'] = 'failed'
+            entry['error'] = "ffmpeg returned {}: {}".format(code, err.strip()[-500:])
+        else:
+            entry['status'] = 'ok'
+    except Exception, e:
+        entry['status'] = 'failed'
+        entry['error'] = "{}: {}".format(type(e).__name__, e)
+    entry['time'] = time.time() - start
+    return entry
+
+def run(jobs, img_path, n_jobs = None, width = 1024):
     """
+    Extract the frames of all the clips not yet complete
 
-    command = ["ffmpeg", "-i", src,  "-s", asr, "-q", "1", dest]
-    subprocess.call(command)
+    Params
+    -----
+    jobs: list of (src avi, destination directory)
+    img_path: directory holding the manifest
+    n_jobs: number of concurrent ffmpeg processes, defaults to the
+        number of cores
+    width: output image width
+    """
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    manifest = load_manifest(img_path)
+    todo = []
+    for src, save_path in jobs:
+        if is_complete(manifest.get(src), width):
+            continue
+        # make path if not exist
+        if not os.path.isdir(save_path):
+            os.makedirs(save_path)
+        todo.append((src, save_path, width))
+    print "{} clips, {} already extracted".format(len(jobs), len(jobs) - len(todo))
+
+    start = time.time()
+    failed = 0
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        with open(os.path.join(img_path, MANIFEST), 'a') as out_f:
+            for i, entry in enumerate(pool.imap_unordered(extract_job, todo)):
+                out_f.write(json.dumps(entry) + "\n")
+                out_f.flush()
+                if entry['status'] != 'ok':
+                    failed += 1
+                    print "Failed {}: {}".format(entry['src'], entry['error'])
+                else:
+                    print "{}/{} {} {} frames in {:.1f}s".format(i + 1, len(todo),
+                            entry['clip'], entry['n_frames'], entry['time'])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    print "Done in {:.1f}s, {} failed".format(time.time() - start, failed)
 
 if __name__ == "__main__":
 
-    _, which = sys.argv
+    which = sys.argv[1]
+    n_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    width = int(sys.argv[3]) if len(sys.argv) > 3 else 1024
+    emots = ["Angry", "Fear", "Disgust", "Happy", "Surprise", "Sad", "Neutral"]
+    jobs = []
 
     if which == 'AFEW2':
         avi_path = "/data/lisa/data/faces/EmotiW/AFEW_2_Distribute/"
         img_path = "/data/lisa/data/faces/EmotiW/images/"
-        emots = ["Angry", "Fear", "Disgust", "Happy", "Surprise", "Sad", "Neutral"]
 
         for set in ["Train", "Val"]:
             for emot in emots:
                 file_list = glob.glob("{}{}/{}/*.avi".format(avi_path, set, emot))
-                # make path if not exist
                 save_path = "{}{}/{}".format(img_path, set, emot)
-                if not os.path.isdir(save_path):
-                    os.makedirs(save_path)
-
-                for item in file_list:
-                    # get proper size of image from aspect ration info
-                    asr = get_output_size(item)
-
-                    #extract frame images
-                    output = "{}/{}-%3d.png".format(save_path, item.split("/")[-1].rstrip(".avi"))
-                    extract_frames(item, output, asr)
-
+                jobs.extend([(item, save_path) for item in file_list])
 
     elif which == 'AFEW':
         avi_path = "/data/lisa/data/faces/AFEW/SingleAFEW/"
         img_path = "/data/lisa/data/faces/AFEW/images/"
-        emots = ["Angry", "Fear", "Disgust", "Happy", "Surprise", "Sad", "Neutral"]
 
         for emot in emots:
             file_list = glob.glob("{}{}/*.avi".format(avi_path, emot))
-            # make path if not exist
-            save_path = "{}{}/".format(img_path, emot)
-            if not os.path.isdir(save_path):
-                os.makedirs(save_path)
-
-            for item in file_list:
-                # get proper size of image from aspect ration info
-                asr = get_output_size(item)
-
-                #extract frame images
-                output = "{}{}-%3d.png".format(save_path, item.split("/")[-1].rstrip(".avi"))
-                extract_frames(item, output, asr)
+            save_path = "{}{}".format(img_path, emot)
+            jobs.extend([(item, save_path) for item in file_list])
+
+    run(jobs, img_path, n_jobs, width)
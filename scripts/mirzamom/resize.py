@@ -1,58 +1,164 @@
+"""
+Resize face tube images into packed TubeStores
+
+Each clip is handled by a worker process, every jpg frame is decoded
+once and the frames of a tube are resized together as a stacked array,
+at every requested size. The tubes are then appended to one TubeStore
+per size.
+
+Usage: python resize.py [n_jobs] [size ...]
+"""
+
 import os
+import sys
 import glob
+import multiprocessing
 import numpy
-from skimage import transform, io
-from gif import sort_nicely
-import ipdb
+from PIL import Image
+from tube_store import TubeStore
 
-def resize(input, size):
 
-    img = io.imread(input)
-    img = transform.resize(img, size)
-    return img
+def interpolation_matrix(n_in, n_out):
+    """
+    Linear interpolation weights from n_in to n_out samples
 
+    Returns a float32 (n_out, n_in) matrix, pixel centers are aligned as
+    in skimage.transform.resize with order=1
+    """
 
-def make_face_tubes(input, output):
+    pos = (numpy.arange(n_out) + 0.5) * n_in / float(n_out) - 0.5
+    pos = numpy.clip(pos, 0, n_in - 1)
+    low = numpy.floor(pos).astype('int64')
+    high = numpy.minimum(low + 1, n_in - 1)
+    frac = (pos - low).astype('float32')
+    rval = numpy.zeros((n_out, n_in), dtype='float32')
+    rows = numpy.arange(n_out)
+    rval[rows, low] += 1 - frac
+    rval[rows, high] += frac
+    return rval
 
-    if format == 'jpg':
-        io.imsave(output, img)
-    else:
-        output = output.rstrip('jpg') + '.npy'
-        numpy.save(output, img)
+def resize_stack(frames, size):
+    """
+    Bilinear resize of a stack of images of the same shape
 
-if __name__ == "__main__":
+    Params
+    -----
+    frames: (n_frames, height, width, channels) array
+    size: (height, width) of the output
+
+    Returns an uint8 (n_frames, size[0], size[1], channels) array
+    """
+
+    rows = interpolation_matrix(frames.shape[1], size[0])
+    cols = interpolation_matrix(frames.shape[2], size[1])
+    rval = numpy.tensordot(frames.astype('float32'), cols, axes=([2], [1]))
+    rval = numpy.tensordot(rows, rval, axes=([1], [1]))
+    # back to (n_frames, height, width, channels)
+    rval = rval.transpose(1, 0, 3, 2)
+    return numpy.clip(numpy.round(rval), 0, 255).astype('uint8')
+
+def resize_tube(frames, sizes):
+    """
+    Resize the frames of a tube to several sizes
+
+    Params
+    -----
+    frames: list of uint8 (height, width, 3) arrays, the shape varies
+        with the face box
+    sizes: list of (height, width)
+
+    Returns a dict size -> uint8 (n_frames, height, width, 3) array
+    """
+
+    # frames of the same shape are resized in a single call
+    groups = {}
+    for i, frame in enumerate(frames):
+        groups.setdefault(frame.shape, []).append(i)
+
+    rval = {}
+    for size in sizes:
+        out = numpy.zeros((len(frames),) + tuple(size) + (3,), dtype='uint8')
+        for inds in groups.values():
+            out[inds] = resize_stack(numpy.asarray([frames[i] for i in inds]), size)
+        rval[size] = out
+    return rval
 
+def list_tubes(path):
+    """
+    Group the face tube images of a directory
+
+    Returns a dict clip -> tube number -> list of frame files ordered by
+    frame number
+    """
+
+    rval = {}
+    for item in glob.glob("{}*.jpg".format(path)):
+        clip, tube, frame = item.split("/")[-1][:-len(".jpg")].split("-")
+        rval.setdefault(clip, {}).setdefault(int(tube), []).append((int(frame), item))
+    for clip in rval:
+        for tube in rval[clip]:
+            rval[clip][tube] = [item for _, item in sorted(rval[clip][tube])]
+    return rval
+
+def resize_clip(job):
+    """
+    Resize all the tubes of a clip, run in a worker process
+
+    Params
+    -----
+    job: (clip, dict tube -> frame files, sizes, info)
+    """
+
+    clip, tubes, sizes, info = job
+    rval = []
+    for tube in sorted(tubes.keys()):
+        frames = [numpy.asarray(Image.open(item).convert('RGB')) for item in tubes[tube]]
+        rval.append((tube, resize_tube(frames, sizes)))
+    return clip, rval, info
+
+def main():
+
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    sizes = [int(item) for item in sys.argv[2:]] or [48, 96, 128]
+    sizes = [(item, item) for item in sizes]
     src = "/data/lisa/data/faces/EmotiW/picasa_face_tubes/v1/"
-    dest = "/data/lisa/data/faces/EmotiW/picasa_face_tubes_96_96/"
+    dest = "/data/lisa/data/faces/EmotiW/picasa_face_tubes_packed/"
     sets = ["Train", "Val"]
     emots = ["Angry", "Fear", "Happy", "Sad", "Surprise", "Neutral", "Disgust"]
-    size = (96, 96)
 
+    stores = dict((size, TubeStore("{}{}_{}/".format(dest, *size), shape = size + (3,),
+                    mode = 'a')) for size in sizes)
+    # a clip is only skipped if it is in every store
+    done = set.intersection(*[set(store.clips()) for store in stores.values()])
+
+    jobs = []
     for set_n in sets:
-        print set_n
         for emot in emots:
-            print emot
-            cur_dest = "{}{}/{}/".format(dest, set_n, emot)
-            if not os.path.isdir(cur_dest):
-                os.makedirs(cur_dest)
-
-            files = glob.glob("{}{}/{}/*.jpg".format(src, set_n, emot))
-            clips = [item.split("/")[-1].split("-")[0] for item in files]
-            clips = numpy.unique(clips)
-            for clip in clips:
-                print clip
-                tubes = glob.glob("{}{}/{}/{}*.jpg".format(src, set_n, emot, clip))
-                tubes = [item.split("/")[-1].split("-")[1] for item in tubes]
-                tubes = numpy.unique(tubes)
-                for tube in tubes:
-                    frames = glob.glob("{}{}/{}/{}-{}*.jpg".format(src, set_n, emot, clip, tube))
-                    sort_nicely(frames)
-                    rval = []
-                    for frame in frames:
-                        rval.append(resize(frame, size))
-
-                    rval = numpy.concatenate([item[numpy.newaxis, ...] for item in rval])
-                    rval *= 255.
-                    rval = rval.astype('uint8')
-                    output = "{}{}/{}/{}-{}.npy".format(dest, set_n, emot, clip, tube)
-                    numpy.save(output, rval)
+            tubes = list_tubes("{}{}/{}/".format(src, set_n, emot))
+            for clip in sorted(tubes.keys()):
+                if clip not in done:
+                    jobs.append((clip, tubes[clip], sizes, {'set': set_n, 'emotion': emot}))
+    print "{} clips to resize".format(len(jobs))
+
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        for i, (clip, tubes, info) in enumerate(pool.imap(resize_clip, jobs)):
+            print "{}/{} {}".format(i + 1, len(jobs), clip)
+            for size, store in stores.items():
+                for tube, frames in tubes:
+                    if (clip, tube) not in store:
+                        store.append(clip, tube, frames[size], **info)
+            if (i + 1) % 100 == 0:
+                for store in stores.values():
+                    store.flush()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for store in stores.values():
+            store.close()
+
+if __name__ == "__main__":
+    main()
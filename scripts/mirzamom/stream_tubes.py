@@ -0,0 +1,185 @@
+"""
+Extracts resized face tubes directly from avi files
+
+Frames are decoded by ffmpeg into a pipe and never written on disk.
+Picasa boxes are assigned to face tubes and gaps are filled by template
+search while the video is read, each face is cropped and resized in
+memory and the finished tubes are appended to a packed TubeStore.
+
+This replaces the frame_extractor.py, face_tube.py and resize.py passes.
+"""
+
+import os
+import sys
+import subprocess
+import numpy
+from PIL import Image
+from face_tube import get_clip_lists, get_bounding_boxes, assign_tube
+from frame_extractor import get_output_size
+from tube_store import TubeStore
+import template_search
+
+
+def read_frames(path, asr):
+    """
+    Decode an avi file with ffmpeg and yield its RGB frames
+
+    Params
+    -----
+    path: avi file path
+    asr: output size string e.g. 1024x576
+
+    Yields (frame number, uint8 (height, width, 3) array), frames are
+    numbered from 1 like the png files written by frame_extractor.
+    Raises IOError once the frames are read if ffmpeg failed
+    """
+
+    width, height = [int(item) for item in asr.split('x')]
+    frame_bytes = width * height * 3
+    command = ["ffmpeg", "-i", path, "-s", asr, "-f", "rawvideo",
+                "-pix_fmt", "rgb24", "-"]
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=devnull,
+                                bufsize = frame_bytes)
+        try:
+            frame = 1
+            while True:
+                buf = p.stdout.read(frame_bytes)
+                if len(buf) < frame_bytes:
+                    break
+                yield frame, numpy.frombuffer(buf, dtype='uint8').reshape((height, width, 3))
+                frame += 1
+        finally:
+            p.stdout.close()
+            p.wait()
+    # a clip that fails to decode gives no frames, it must not look like a
+    # clip without faces
+    if p.returncode != 0:
+        raise IOError("ffmpeg returned {} for {}".format(p.returncode, path))
+
+def crop_resize(img, box, size):
+    """
+    Crop a box from a frame and resize it to size
+
+    Params
+    -----
+    img: uint8 (height, width, 3) array
+    box: [x0, y0, x1, y1]
+    size: (height, width) of the output
+    """
+
+    box = [int(item) for item in box]
+    crop = Image.fromarray(img).crop(box)
+    crop = crop.resize((size[1], size[0]), Image.BILINEAR)
+    return numpy.asarray(crop)
+
+def track_clip(frames, boxes, size, distance_thr, size_thr, overlap_thr,
+                similar_thr, search_radius = 21, search_step = 3):
+    """
+    Build the face tubes of a clip in one pass over its frames
+
+    Params
+    -----
+    frames: iterator over (frame number, frame array)
+    boxes: dict frame number -> list of Picasa boxes
+    size: (height, width) of the tube frames
+
+    Returns (tubes, crops) where tubes is the list of {frame: box} dicts
+    as computed by face_tube.get_face_tubes and crops the list of
+    uint8 (n_frames, height, width, 3) arrays of the same tubes
+    """
+
+    tubes = []
+    crops = []
+    if len(boxes) == 0:
+        return tubes, crops
+
+    first = min(boxes.keys())
+    # last frame with a Picasa box, and its content
+    prev = (None, None)
+
+    for frame, img in frames:
+        if frame < first:
+            continue
+        if frame in boxes:
+            tubes = assign_tube(tubes, boxes[frame], frame, distance_thr, size_thr, overlap_thr)
+            prev = (frame, img)
+        elif prev[0] is not None:
+            prev_boxes = []
+            for box in boxes[prev[0]]:
+                new_box = template_search.find_box(prev[1], img, box, similar_thr,
+                                search_radius, search_step)
+                if new_box is not None:
+                    prev_boxes.append(new_box)
+            if len(prev_boxes) > 0:
+                tubes = assign_tube(tubes, prev_boxes, frame, distance_thr, size_thr, overlap_thr)
+
+        # crop the boxes assigned at this frame right away, the frame is
+        # not kept in memory
+        for i, tube in enumerate(tubes):
+            if i == len(crops):
+                crops.append([])
+            if frame in tube:
+                crops[i].append(crop_resize(img, tube[frame], size))
+
+    crops = [numpy.concatenate([item[numpy.newaxis, ...] for item in tube])
+                for tube in crops]
+    return tubes, crops
+
+def extract_clip(avi, boxes, store, size, params, **info):
+    """
+    Track the faces of one avi file and append its tubes to the store
+
+    The frame numbers and boxes of every tube are saved in the index as
+    'frame_numbers' and 'boxes', the clip is then marked as processed.
+    Nothing is stored if the clip cannot be decoded
+    """
+
+    clip = os.path.splitext(os.path.basename(avi))[0]
+    asr = get_output_size(avi)
+    tubes, crops = track_clip(read_frames(avi, asr), boxes, size, **params)
+    for i, (tube, crop) in enumerate(zip(tubes, crops)):
+        store.append(clip, i, crop, frame_numbers = sorted(tube.keys()),
+                    boxes = [tube[frame] for frame in sorted(tube.keys())], **info)
+    store.mark_processed(clip)
+    return len(tubes)
+
+def main():
+
+    _, size = sys.argv
+    size = (int(size), int(size))
+    main_path = '/data/lisa/data/faces/EmotiW/AFEW_2_Distribute/'
+    bx_path = '/data/lisa/data/faces/EmotiW/picasa_boxes/'
+    store_path = "/data/lisa/data/faces/EmotiW/picasa_face_tubes_packed/{}_{}/".format(*size)
+    emots = ["Angry", "Fear", "Happy", "Disgust", "Neutral", "Sad", "Surprise"]
+    sets = ["Train", "Val"]
+    params = {'distance_thr': .008,
+            'size_thr': 10,
+            'overlap_thr': 0.08,
+            'similar_thr': 0.97}
+
+    with TubeStore(store_path, shape = size + (3,), mode = 'a') as store:
+        # clips without any tube are recorded too
+        done = set(store.processed_clips())
+        for set_n in sets:
+            print set_n
+            for emot in emots:
+                print emot
+                clip_path = "{}{}/{}/".format(main_path, set_n, emot)
+                clips = get_clip_lists(clip_path)
+                bx = get_bounding_boxes("{}{}/{}/".format(bx_path, set_n, emot), clips)
+                for clip in clips:
+                    if clip in done:
+                        continue
+                    print "Extracting face-tubes for clip: {}".format(clip)
+                    try:
+                        extract_clip("{}{}.avi".format(clip_path, clip), bx[clip], store,
+                                    size, params, set = set_n, emotion = emot)
+                    except IOError, e:
+                        # not marked as processed, retried by the next run
+                        print "Failed {}: {}".format(clip, e)
+                # make the tubes of this emotion readable
+                store.flush()
+
+if __name__ == "__main__":
+    main()
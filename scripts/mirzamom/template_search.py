@@ -0,0 +1,184 @@
+"""
+Fast template search used to fill the gaps of face tubes on frames
+without a Picasa detection.
+
+The face found in the previous frame is compared to every candidate
+position of a search window in the current frame at once. Colour
+histograms of all the candidates are read from an integral histogram,
+so the cost of a candidate does not depend on the size of the box.
+"""
+
+import numpy
+from PIL import Image
+
+
+def load_frame(path):
+    """
+    Decode an image file into an uint8 (height, width, 3) RGB array
+    """
+
+    return numpy.asarray(Image.open(path).convert('RGB'))
+
+def clip_box(box, shape):
+    """
+    Clip a [x0, y0, x1, y1] box to the frame of an image of given shape
+    """
+
+    height, width = shape[:2]
+    x0 = min(max(int(box[0]), 0), width)
+    y0 = min(max(int(box[1]), 0), height)
+    x1 = min(max(int(box[2]), x0), width)
+    y1 = min(max(int(box[3]), y0), height)
+    return [x0, y0, x1, y1]
+
+def quantize(img, n_bins = 16):
+    """
+    Map every pixel channel to its histogram bin index
+
+    Params
+    -----
+    img: uint8 (height, width, channels) array
+    n_bins: number of bins per channel, must divide 256
+
+    Returns an int (height, width, channels) array whose values are
+    offset so that channel c uses bins [c * n_bins, (c + 1) * n_bins)
+    """
+
+    assert 256 % n_bins == 0
+    bins = img.astype('int32') // (256 // n_bins)
+    bins += numpy.arange(img.shape[2], dtype='int32') * n_bins
+    return bins
+
+def histogram(img, n_bins = 16):
+    """
+    Concatenated per-channel colour histogram of an image, the same
+    binning as `face_tube.similarness`
+    """
+
+    n_channels = img.shape[2]
+    return numpy.bincount(quantize(img, n_bins).ravel(),
+                    minlength = n_channels * n_bins).astype('float32')
+
+def integral_histogram(img, n_bins = 16):
+    """
+    Integral histogram of an image
+
+    Returns an int32 (height + 1, width + 1, channels * n_bins) array H
+    where H[y, x] is the histogram of img[:y, :x]. The histogram of any
+    box is then obtained with four lookups.
+    """
+
+    height, width, n_channels = img.shape
+    n_total = n_channels * n_bins
+    bins = quantize(img, n_bins)
+    rval = numpy.zeros((height + 1, width + 1, n_total), dtype='int32')
+    one_hot = rval[1:, 1:]
+    rows, cols = numpy.mgrid[:height, :width]
+    for c in xrange(n_channels):
+        one_hot[rows, cols, bins[:, :, c]] = 1
+    numpy.cumsum(rval, axis=0, out=rval)
+    numpy.cumsum(rval, axis=1, out=rval)
+    return rval
+
+def box_histograms(integral, x0, y0, width, height):
+    """
+    Histograms of many boxes of the same size
+
+    Params
+    -----
+    integral: output of `integral_histogram`
+    x0, y0: int arrays holding the top left corner of every box
+    width, height: size shared by all the boxes
+
+    Returns a float32 (n_boxes, n_bins) array
+    """
+
+    x1 = x0 + width
+    y1 = y0 + height
+    rval = (integral[y1, x1] - integral[y0, x1]
+            - integral[y1, x0] + integral[y0, x0])
+    return rval.astype('float32')
+
+def correlation(template, hists):
+    """
+    Correlation between one histogram and a set of histograms, as
+    computed by cv2.compareHist with method CV_COMP_CORREL. 1 is a perfect
+    match and -1 a complete mismatch.
+    """
+
+    template = template - template.mean()
+    hists = hists - hists.mean(axis=1)[:, numpy.newaxis]
+    num = numpy.dot(hists, template)
+    denom = numpy.sqrt((hists ** 2).sum(axis=1) * (template ** 2).sum())
+    rval = numpy.zeros_like(num)
+    valid = denom > 0
+    rval[valid] = num[valid] / denom[valid]
+    return rval
+
+def search_offsets(radius = 21, step = 3):
+    """
+    All the (x, y) displacements of the search window
+    """
+
+    steps = numpy.arange(-radius, radius + 1, step)
+    dx, dy = numpy.meshgrid(steps, steps)
+    return dx.ravel(), dy.ravel()
+
+def similarity_map(prev, curr, box, radius = 21, step = 3, n_bins = 16):
+    """
+    Similarity of the content of `box` in `prev` to every displaced copy
+    of the box in `curr`
+
+    Params
+    -----
+    prev: previous frame, uint8 (height, width, 3) array
+    curr: current frame, uint8 (height, width, 3) array
+    box: [x0, y0, x1, y1] box in the previous frame
+    radius: largest displacement, in pixels, along each axis
+    step: distance in pixels between two tried displacements
+
+    Returns (dx, dy, scores), one entry per displacement keeping the box
+    inside the current frame
+    """
+
+    box = clip_box(box, prev.shape)
+    width = box[2] - box[0]
+    height = box[3] - box[1]
+    dx, dy = search_offsets(radius, step)
+    if width == 0 or height == 0:
+        return dx[:0], dy[:0], numpy.zeros(0, dtype='float32')
+
+    template = histogram(prev[box[1]:box[3], box[0]:box[2]], n_bins)
+
+    # only build the integral histogram over the search window
+    window = clip_box([box[0] - radius, box[1] - radius,
+                    box[2] + radius, box[3] + radius], curr.shape)
+    integral = integral_histogram(curr[window[1]:window[3],
+                    window[0]:window[2]], n_bins)
+
+    x0 = box[0] + dx - window[0]
+    y0 = box[1] + dy - window[1]
+    inside = ((x0 >= 0) & (y0 >= 0) &
+                (x0 + width <= window[2] - window[0]) &
+                (y0 + height <= window[3] - window[1]))
+    dx, dy, x0, y0 = dx[inside], dy[inside], x0[inside], y0[inside]
+
+    hists = box_histograms(integral, x0, y0, width, height)
+    return dx, dy, correlation(template, hists)
+
+def find_box(prev, curr, box, similar_thr, radius = 21, step = 3, n_bins = 16):
+    """
+    Look for the face of `box` in `prev` around the same position in
+    `curr`. Returns the displaced box, or None if no candidate is more
+    similar than `similar_thr`
+    """
+
+    dx, dy, scores = similarity_map(prev, curr, box, radius, step, n_bins)
+    if len(scores) == 0:
+        return None
+    best = numpy.argmax(scores)
+    if scores[best] <= similar_thr:
+        return None
+    box = clip_box(box, prev.shape)
+    dx, dy = int(dx[best]), int(dy[best])
+    return [box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy]
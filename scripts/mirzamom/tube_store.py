@@ -0,0 +1,182 @@
+"""
+Packed storage of resized face tubes
+
+All the frames of all the tubes are appended to a single raw uint8
+file, and an index keeps for every tube its clip, tube number, first
+frame and length along with any extra information (set, emotion, ...).
+The frames are read back through a memory map, so loading a tube does
+not copy the whole store in memory.
+
+Layout of a store directory:
+    frames.bin: uint8 (n_frames, height, width, channels) C-ordered data
+    index.pkl: dict with keys 'shape', 'tubes' and 'processed' (the
+        clips marked as processed, including those without any tube)
+"""
+
+import os
+import pickle
+import numpy
+
+
+class TubeStore(object):
+    """
+    Params
+    -----
+    path: store directory
+    shape: (height, width, channels) of the frames, only needed when
+        creating a new store
+    mode: 'r' to read, 'a' to append to a new or existing store
+    """
+
+    def __init__(self, path, shape = None, mode = 'r'):
+
+        assert mode in ['r', 'a']
+        self.path = path
+        self.mode = mode
+        self.data_path = os.path.join(path, 'frames.bin')
+        self.index_path = os.path.join(path, 'index.pkl')
+
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'rb') as in_f:
+                index = pickle.load(in_f)
+            if shape is not None and tuple(shape) != index['shape']:
+                raise ValueError("Store {} holds frames of shape {}, "
+                    "got {}".format(path, index['shape'], tuple(shape)))
+            self.shape = index['shape']
+            self.tubes = index['tubes']
+            self.processed = set(index.get('processed',
+                                [tube['clip'] for tube in self.tubes]))
+        elif mode == 'a':
+            if shape is None:
+                raise ValueError("shape is needed to create a new store")
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.shape = tuple(shape)
+            self.tubes = []
+            self.processed = set()
+        else:
+            raise IOError("No tube store found in {}".format(path))
+
+        self.frame_size = int(numpy.prod(self.shape))
+        self.n_frames = sum([tube['length'] for tube in self.tubes])
+        self._keys = dict(((tube['clip'], tube['tube']), i)
+                            for i, tube in enumerate(self.tubes))
+        self._data = None
+        self._out = None
+        if mode == 'a':
+            # drop frames written after the last saved index
+            self._out = open(self.data_path, 'ab')
+            self._out.truncate(self.n_frames * self.frame_size)
+            self._out.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return len(self.tubes)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def keys(self):
+        return [(tube['clip'], tube['tube']) for tube in self.tubes]
+
+    def clips(self):
+        return sorted(set([tube['clip'] for tube in self.tubes]))
+
+    def mark_processed(self, clip):
+        """
+        Record that all the tubes of a clip were appended, saved in the
+        index with them at the next flush
+        """
+
+        assert self.mode == 'a'
+        self.processed.add(clip)
+
+    def processed_clips(self):
+        return sorted(self.processed)
+
+    def append(self, clip, tube, frames, **info):
+        """
+        Add a tube to the store
+
+        Params
+        -----
+        clip: clip id
+        tube: tube number within the clip
+        frames: uint8 (n_frames, height, width, channels) array
+        info: extra information saved in the index
+        """
+
+        assert self.mode == 'a'
+        if (clip, tube) in self._keys:
+            raise KeyError("Tube {} of clip {} is already stored".format(tube, clip))
+        frames = numpy.ascontiguousarray(frames, dtype = 'uint8')
+        if frames.shape[1:] != self.shape:
+            raise ValueError("Expected frames of shape {}, got {}".format(
+                                self.shape, frames.shape[1:]))
+
+        frames.tofile(self._out)
+        entry = dict(info)
+        entry.update({'clip': clip, 'tube': tube,
+                    'start': self.n_frames, 'length': len(frames)})
+        self._keys[(clip, tube)] = len(self.tubes)
+        self.tubes.append(entry)
+        self.n_frames += len(frames)
+        self._data = None
+
+    def flush(self):
+        """
+        Write the index, the tubes appended so far are then readable
+        """
+
+        assert self.mode == 'a'
+        self._out.flush()
+        os.fsync(self._out.fileno())
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as out_f:
+            pickle.dump({'shape': self.shape, 'tubes': self.tubes,
+                        'processed': sorted(self.processed)}, out_f,
+                        protocol = pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.index_path)
+
+    def close(self):
+
+        if self._out is not None:
+            self.flush()
+            self._out.close()
+            self._out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def data(self):
+        """
+        Memory map over all the stored frames
+        """
+
+        if self._data is None:
+            if self._out is not None:
+                self._out.flush()
+            if self.n_frames == 0:
+                return numpy.zeros((0,) + self.shape, dtype = 'uint8')
+            self._data = numpy.memmap(self.data_path, dtype = 'uint8', mode = 'r',
+                                shape = (self.n_frames,) + self.shape)
+        return self._data
+
+    def get(self, clip, tube):
+        """
+        Frames of a tube, as a read-only view in the memory map
+        """
+
+        entry = self.tubes[self._keys[(clip, tube)]]
+        return self.data[entry['start']:entry['start'] + entry['length']]
+
+    def get_clip(self, clip):
+        """
+        All the tubes of a clip, ordered by tube number
+        """
+
+        tubes = sorted([tube['tube'] for tube in self.tubes if tube['clip'] == clip])
+        return [self.get(clip, tube) for tube in tubes]